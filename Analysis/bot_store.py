@@ -0,0 +1,344 @@
+# encoding = 'utf-8'
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# The maximum number of bot id stores kept in the cache of one process
+bot_store_cache_size = 8
+
+# The loaded bot id stores, keyed by (path, mtime)
+bot_store_cache = OrderedDict()
+
+max_uint64_string = str(np.iinfo(np.uint64).max)
+
+# The number of decimals of the rounded footprints (latitude & longitude pairs) used by the bot detection
+footprint_decimals = 6
+
+# The number of batch counts kept by BotStatsAccumulator before they are combined
+pending_count_limit = 64
+
+
+def parse_id_array(id_values) -> tuple:
+    """
+    Parse the ids of the users to uint64
+    :param id_values: the ids of the users, such as a pandas series of id strings or an integer numpy array
+    :return: a tuple of two numpy arrays: the uint64 ids and whether each id is a non-negative integer. The ids
+    which are not integers are saved as 0
+    """
+    id_array = np.asarray(id_values)
+    if id_array.dtype.kind == 'u':
+        return id_array.astype(np.uint64), np.ones(len(id_array), dtype=bool)
+    if id_array.dtype.kind == 'i':
+        is_integer = id_array >= 0
+        return np.where(is_integer, id_array, 0).astype(np.uint64), is_integer
+    try:
+        # Fast path for the ids which all fit in int64, such as the Twitter and Weibo user ids
+        int_ids = id_array.astype(np.int64)
+        is_integer = int_ids >= 0
+        return np.where(is_integer, int_ids, 0).astype(np.uint64), is_integer
+    except (ValueError, TypeError, OverflowError):
+        pass
+    id_strings = pd.Series(id_array, dtype=object).astype(str).str.strip()
+    is_integer = (id_strings.str.fullmatch(r'\d{1,20}') & (
+        (id_strings.str.len() < len(max_uint64_string)) | (id_strings <= max_uint64_string))).values
+    uint_ids = np.zeros(len(id_strings), dtype=np.uint64)
+    uint_ids[is_integer] = id_strings.loc[is_integer].astype(np.uint64).values
+    return uint_ids, is_integer
+
+
+class BotIdStore(object):
+    """
+    The ids of the bot accounts saved as a sorted uint64 array. The array is memory-mapped from a .npy file, so
+    the worker processes share the pages of the file instead of unpickling their own copies of a python set
+    """
+
+    def __init__(self, sorted_ids: np.ndarray, other_ids: frozenset = frozenset(), store_file: str = None):
+        """
+        Initialize the bot id store
+        :param sorted_ids: a sorted uint64 numpy array saving the integer bot ids
+        :param other_ids: the bot ids which are not integers
+        :param store_file: the .npy file saving sorted_ids. None if the store is only kept in memory
+        """
+        self.sorted_ids = sorted_ids
+        self.other_ids = other_ids
+        self.store_file = store_file
+        self.ids_hash = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.store_file is not None:
+            state['sorted_ids'] = None  # memory-mapped again by the worker process
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.sorted_ids is None:
+            self.sorted_ids = np.load(self.store_file, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.sorted_ids) + len(self.other_ids)
+
+    def __repr__(self):
+        # Used by compute_config_hash: the stores saving the same ids have the same representation
+        return 'BotIdStore({})'.format(self.get_ids_hash())
+
+    def get_ids_hash(self) -> str:
+        """
+        Get the content hash of the bot ids
+        :return: the md5 hex digest of the bot ids
+        """
+        if self.ids_hash is None:
+            ids_hash = hashlib.md5(np.ascontiguousarray(self.sorted_ids).tobytes())
+            for other_id in sorted(self.other_ids):
+                ids_hash.update(other_id.encode('utf-8'))
+            self.ids_hash = ids_hash.hexdigest()
+        return self.ids_hash
+
+    def contains(self, id_values) -> np.ndarray:
+        """
+        Check whether the users are bot accounts, based on the binary search of the sorted ids. For a categorical
+        series, only its categories are checked
+        :param id_values: the ids of the users, such as the user_id_str column of a tweet dataframe
+        :return: a boolean numpy array. True if the user is a bot account. The missing ids are not bots
+        """
+        if isinstance(getattr(id_values, 'dtype', None), pd.CategoricalDtype):
+            category_is_bot = self.contains(id_values.cat.categories)
+            # The code of a missing id is -1, which takes the appended False
+            return np.append(category_is_bot, False)[id_values.cat.codes.values]
+        uint_ids, is_integer = parse_id_array(id_values)
+        is_bot = np.zeros(len(uint_ids), dtype=bool)
+        if len(self.sorted_ids) > 0:
+            positions = np.searchsorted(self.sorted_ids, uint_ids)
+            positions[positions == len(self.sorted_ids)] = 0
+            is_bot = is_integer & (self.sorted_ids[positions] == uint_ids)
+        if len(self.other_ids) > 0:
+            other_positions = np.flatnonzero(~is_integer)
+            is_bot[other_positions] = pd.Series(np.asarray(id_values, dtype=object)[other_positions]).astype(
+                str).isin(self.other_ids).values
+        return is_bot
+
+
+def create_bot_id_store(bot_ids) -> BotIdStore:
+    """
+    Create a bot id store kept in memory
+    :param bot_ids: a python set, list or numpy array saving the bot ids
+    :return: a BotIdStore
+    """
+    bot_id_array = np.array(list(bot_ids), dtype=object)
+    uint_ids, is_integer = parse_id_array(bot_id_array)
+    other_ids = frozenset(str(bot_id).strip() for bot_id in bot_id_array[~is_integer])
+    return BotIdStore(sorted_ids=np.unique(uint_ids[is_integer]), other_ids=other_ids)
+
+
+def convert_bot_id_file(bot_id_file: str) -> str:
+    """
+    Convert a .npy file saving the pickled bot id set (or array) to the sorted uint64 .npy file used by
+    BotIdStore. The bot ids which are not integers are saved to another small .npy file
+    :param bot_id_file: the .npy file saving the bot ids, such as hong_kong_bot_ids.npy
+    :return: the path of the sorted uint64 .npy file
+    """
+    store_file = '{}_sorted.npy'.format(os.path.splitext(bot_id_file)[0])
+    loaded_ids = np.load(bot_id_file, allow_pickle=True)
+    bot_ids = loaded_ids.item() if loaded_ids.ndim == 0 else loaded_ids.tolist()
+    bot_id_store = create_bot_id_store(bot_ids)
+    print('Converting {} bot ids saved in {}...'.format(len(bot_id_store), bot_id_file))
+    other_file = '{}_other.npy'.format(os.path.splitext(store_file)[0])
+    if len(bot_id_store.other_ids) > 0:
+        np.save(other_file, np.array(sorted(bot_id_store.other_ids), dtype=object), allow_pickle=True)
+    elif os.path.exists(other_file):
+        os.remove(other_file)
+    temp_file = '{}.{}.tmp.npy'.format(os.path.splitext(store_file)[0], os.getpid())
+    np.save(temp_file, bot_id_store.sorted_ids)
+    os.replace(temp_file, store_file)
+    return store_file
+
+
+def load_bot_ids(bot_ids) -> BotIdStore:
+    """
+    Load the bot ids of a city profile as a BotIdStore. For a .npy file, the sorted uint64 file is created next to
+    it once and memory-mapped afterwards. It is created again if the original file has been modified
+    :param bot_ids: a BotIdStore, a python set of bot ids, or the .npy file saving the pickled bot ids
+    :return: a BotIdStore
+    """
+    if isinstance(bot_ids, BotIdStore):
+        return bot_ids
+    if not isinstance(bot_ids, str):
+        return create_bot_id_store(bot_ids)
+    bot_id_mtime = os.path.getmtime(bot_ids)
+    cache_key = (os.path.abspath(bot_ids), bot_id_mtime)
+    if cache_key in bot_store_cache:
+        bot_store_cache.move_to_end(cache_key)
+        return bot_store_cache[cache_key]
+    store_file = '{}_sorted.npy'.format(os.path.splitext(bot_ids)[0])
+    if (not os.path.exists(store_file)) or (os.path.getmtime(store_file) < bot_id_mtime):
+        store_file = convert_bot_id_file(bot_ids)
+    other_file = '{}_other.npy'.format(os.path.splitext(store_file)[0])
+    other_ids = frozenset(np.load(other_file, allow_pickle=True).tolist()) if os.path.exists(
+        other_file) else frozenset()
+    bot_id_store = BotIdStore(sorted_ids=np.load(store_file, mmap_mode='r'), other_ids=other_ids,
+                              store_file=store_file)
+    bot_store_cache[cache_key] = bot_id_store
+    while len(bot_store_cache) > bot_store_cache_size:
+        bot_store_cache.popitem(last=False)
+    return bot_id_store
+
+
+def unique_id_pairs(user_ids: np.ndarray, tweet_ids: np.ndarray) -> tuple:
+    """
+    Sort the (user id, tweet id) pairs and remove the repeated ones
+    :param user_ids: the uint64 user ids
+    :param tweet_ids: the uint64 tweet ids of the same length
+    :return: a tuple of two uint64 numpy arrays: the user ids and tweet ids of the distinct pairs, sorted by the
+    user ids and then by the tweet ids
+    """
+    order = np.lexsort((tweet_ids, user_ids))
+    user_ids, tweet_ids = user_ids[order], tweet_ids[order]
+    is_new = np.ones(len(user_ids), dtype=bool)
+    is_new[1:] = (user_ids[1:] != user_ids[:-1]) | (tweet_ids[1:] != tweet_ids[:-1])
+    return user_ids[is_new], tweet_ids[is_new]
+
+
+def merge_id_pairs(id_pairs_list: list) -> tuple:
+    """
+    Merge the distinct (user id, tweet id) pairs of several batches
+    :param id_pairs_list: a list of (user ids, tweet ids) tuples returned by unique_id_pairs
+    :return: a tuple of the user ids and tweet ids of the distinct pairs
+    """
+    if len(id_pairs_list) == 0:
+        return np.array([], dtype=np.uint64), np.array([], dtype=np.uint64)
+    return unique_id_pairs(np.concatenate([user_ids for user_ids, _ in id_pairs_list]),
+                           np.concatenate([tweet_ids for _, tweet_ids in id_pairs_list]))
+
+
+def sum_footprint_counts(footprint_counts_list: list) -> pd.Series:
+    """
+    Sum the number of tweets posted by each user at each footprint in several batches
+    :param footprint_counts_list: a list of pandas series indexed by (user_id, lat, lon)
+    :return: a pandas series indexed by (user_id, lat, lon), saving the number of tweets
+    """
+    if len(footprint_counts_list) == 0:
+        return pd.Series([], dtype=np.int64, index=pd.MultiIndex.from_arrays(
+            [np.array([], dtype=object), np.array([], dtype=np.float64), np.array([], dtype=np.float64)],
+            names=['user_id', 'lat', 'lon']))
+    if len(footprint_counts_list) == 1:
+        return footprint_counts_list[0]
+    return pd.concat(footprint_counts_list).groupby(level=['user_id', 'lat', 'lon'], sort=False).sum()
+
+
+class BotStatsAccumulator(object):
+    """
+    The streaming statistics used by the bot detection: the number of tweets posted by each user at each rounded
+    footprint and the distinct tweet ids of each user. The (user id, tweet id) pairs are saved as sorted uint64
+    arrays. The counts of the batches are kept as runs which are merged when a run is not much larger than the
+    next one, so each count is merged a logarithmic number of times instead of at every combination. The
+    accumulator can be updated file by file, merged across the worker processes and the years, and pickled
+    between runs. The tweets repeated across the batches are counted at each footprint but only once by the
+    distinct ids, the same as find_bot_accounts.count_user_tweet
+    """
+
+    def __init__(self, decimals: int = footprint_decimals):
+        """
+        Initialize the accumulator
+        :param decimals: the number of decimals of the rounded latitudes and longitudes
+        """
+        self.decimals = decimals
+        self.footprint_runs, self.id_pair_runs = [], []
+        # The pairs whose user id or tweet id is not an integer, saved as (user_id, tweet_id) strings
+        self.other_id_pairs = set()
+        self.pending_counts, self.pending_id_pairs = [], []
+
+    def __getstate__(self):
+        self.combine_counts()
+        return self.__dict__.copy()
+
+    def add_tweets(self, user_ids, tweet_ids, lat_values, lon_values) -> None:
+        """
+        Count the tweets of one batch. The tweets without the user ids are ignored
+        :param user_ids: the ids of the users posting the tweets, such as the user_id_str column
+        :param tweet_ids: the ids of the tweets, such as the id_str column
+        :param lat_values: the latitudes of the tweets
+        :param lon_values: the longitudes of the tweets
+        :return: None
+        """
+        user_id_array = np.asarray(user_ids, dtype=object)
+        has_user = ~pd.isnull(user_id_array)
+        if not has_user.any():
+            return
+        batch_data = pd.DataFrame({'user_id': user_id_array[has_user],
+                                   'lat': np.round(np.asarray(lat_values, dtype=np.float64)[has_user], self.decimals),
+                                   'lon': np.round(np.asarray(lon_values, dtype=np.float64)[has_user], self.decimals)})
+        tweet_id_array = np.asarray(tweet_ids, dtype=object)[has_user]
+        uint_user_ids, user_is_integer = parse_id_array(batch_data['user_id'].values)
+        uint_tweet_ids, tweet_is_integer = parse_id_array(tweet_id_array)
+        is_integer = user_is_integer & tweet_is_integer
+        other_id_pairs = set(zip(batch_data['user_id'].values[~is_integer].astype(str),
+                                 tweet_id_array[~is_integer].astype(str)))
+        self.add_counts(batch_data.groupby(['user_id', 'lat', 'lon'], sort=False).size().astype(np.int64),
+                        unique_id_pairs(uint_user_ids[is_integer], uint_tweet_ids[is_integer]), other_id_pairs)
+
+    def add_counts(self, footprint_counts: pd.Series, id_pairs: tuple, other_id_pairs: set) -> None:
+        """
+        Add the counts of another accumulator with the same decimals
+        :param footprint_counts: a pandas series indexed by (user_id, lat, lon), saving the number of tweets
+        :param id_pairs: a tuple of the uint64 user ids and tweet ids of the distinct pairs
+        :param other_id_pairs: a set saving the (user_id, tweet_id) strings of the pairs which are not integers
+        :return: None
+        """
+        self.pending_counts.append(footprint_counts)
+        self.pending_id_pairs.append(id_pairs)
+        self.other_id_pairs.update(other_id_pairs)
+        if len(self.pending_counts) >= pending_count_limit:
+            self.combine_counts()
+
+    def combine_counts(self) -> None:
+        """
+        Combine the pending batch counts into a new run, and merge the last runs while the earlier one is at most
+        twice as large
+        :return: None
+        """
+        if len(self.pending_counts) == 0:
+            return
+        self.footprint_runs.append(sum_footprint_counts(self.pending_counts))
+        self.id_pair_runs.append(merge_id_pairs(self.pending_id_pairs))
+        self.pending_counts, self.pending_id_pairs = [], []
+        while len(self.footprint_runs) > 1 and len(self.footprint_runs[-2]) <= 2 * len(self.footprint_runs[-1]):
+            self.footprint_runs[-2:] = [sum_footprint_counts(self.footprint_runs[-2:])]
+        while len(self.id_pair_runs) > 1 and len(self.id_pair_runs[-2][0]) <= 2 * len(self.id_pair_runs[-1][0]):
+            self.id_pair_runs[-2:] = [merge_id_pairs(self.id_pair_runs[-2:])]
+
+    def get_partial(self) -> tuple:
+        """
+        Get the accumulated counts, which can be pickled and added to another accumulator
+        :return: a tuple of the footprint counts indexed by (user_id, lat, lon), the uint64 user ids and tweet ids
+        of the distinct pairs, and the set of the pairs which are not integers
+        """
+        self.combine_counts()
+        self.footprint_runs = [sum_footprint_counts(self.footprint_runs)]
+        self.id_pair_runs = [merge_id_pairs(self.id_pair_runs)]
+        return self.footprint_runs[0], self.id_pair_runs[0], self.other_id_pairs
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Create the user count dataframe, in the same format as find_bot_accounts.count_user_tweet. The most common
+        footprint percent is computed with the number of distinct tweet ids of each user
+        :return: a pandas dataframe saving the number of tweets and the most common footprint percent of each user
+        """
+        footprint_counts, (pair_user_ids, _), other_id_pairs = self.get_partial()
+        user_footprint_counts = footprint_counts.groupby(level='user_id', sort=False)
+        user_counts = user_footprint_counts.sum()
+        # The pairs are sorted by the user ids, so the distinct tweets of each user are found by binary search
+        uint_user_ids, user_is_integer = parse_id_array(user_counts.index.values)
+        distinct_tweet_counts = np.searchsorted(pair_user_ids, uint_user_ids, side='right') - np.searchsorted(
+            pair_user_ids, uint_user_ids, side='left')
+        distinct_tweet_counts[~user_is_integer] = 0
+        if len(other_id_pairs) > 0:
+            other_user_counts = pd.Series([user_id for user_id, _ in other_id_pairs]).value_counts()
+            distinct_tweet_counts = distinct_tweet_counts + pd.Series(user_counts.index.astype(str)).map(
+                other_user_counts).fillna(0).astype(np.int64).values
+        count_data = pd.DataFrame()
+        count_data['user_id'] = user_counts.index.values
+        count_data['count'] = user_counts.values
+        count_data['loc_percent'] = user_footprint_counts.max().values / distinct_tweet_counts
+        return count_data.sort_values(by='count', ascending=False, kind='mergesort').reset_index(drop=True)
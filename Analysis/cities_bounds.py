@@ -7,6 +7,8 @@ from data_paths import geocoded_save_path
 # The happyplaces and Weibo path should contain all the names
 # of cities as the folder name
 happyplaces_path = r'/home/data_center/Social_Media/happyplacestweets'
+# The parquet mirror of the happyplaces tweets, partitioned by city, year and month
+happyplaces_parquet_path = r'/home/data_center/Social_Media/happyplacestweets_parquet'
 weibo_path = r'/home/haoliang/projects/count_tweet/geocoded_weibos_heat_weibo'
 
 # Specify the shapefile path
@@ -348,6 +350,10 @@ cities_dict_china = {
     'zhengzhou': [zhengzhou_box, zhengzhou_timezone, zhengzhou_loc,
                   zhengzhou_area, zhengzhou_bot_ids, zhengzhou_city]}
 
+# The cell size (degree) of the mask grid used to find the points posted in the city. The cities with large and
+# complex borders answer most points by the grid. The other cities test each point against the border
+city_mask_resolution = {'netherlands': 0.01, 'wales': 0.01, 'tokyo': 0.005}
+
 if __name__ == '__main__':
     print(netherland_open_spaces)
     print(cities_dict_netherland.keys())
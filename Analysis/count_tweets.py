@@ -1,22 +1,24 @@
 # encoding = 'utf-8'
 import os
 import numpy as np
-from collections import defaultdict, Counter
-from datetime import datetime, timedelta
+from datetime import datetime
 import pytz
 import pandas as pd
 import geopandas as gpd
 
 import data_paths
-from cities_bounds import cities_dict_foreign, open_space_saving_path
-from utils import transform_time_string_to_utc_time, transform_string_time_to_datetime, merge_dict, \
-    create_dataframe_from_dict, sum_dataframe_list_count, column_dtype_dict
+from cities_bounds import cities_dict_foreign, open_space_saving_path, city_mask_resolution
+from utils import parse_created_at, create_hour_calendar, column_dtype_dict, HourlyCountAccumulator, \
+    group_cities_by_data_loc, sanitize_coordinates
+from tweet_store import iter_source_dataframes, find_id_sources, happyplaces_parquet_path
+from manifest import FileManifest, compute_config_hash
+from geometry_cache import load_geometry
+from bot_store import load_bot_ids
+from open_space_index import OpenSpaceIndex
+from scan_engine import SharedTweetScanner, HourlyCountAggregator, MonthlyCountAggregator, OpenSpaceAggregator, \
+    UserStatsAggregator
 from visualizations import create_day_plot_for_one_count, create_hour_weekday_plot
 
-# Cope with some bad latitude and longitude data
-lat_lon_start_tuple = tuple([str(val) for val in range(10)] + ['-'])
-print(lat_lon_start_tuple)
-
 # Used column names and data types
 considered_colnames = list(column_dtype_dict.keys())
 dtype_dict = {'user_id_str': str, 'id_str': str, 'text': str,
@@ -32,7 +34,9 @@ class CountTweets(object):
 
     saving_path_for_month = data_paths.count_tweet_month_path
 
-    def __init__(self, city_name, city_profile_dict, start_time, end_time, utc_or_not):
+    def __init__(self, city_name, city_profile_dict, start_time, end_time, utc_or_not,
+                 parquet_path=happyplaces_parquet_path, memory_limit_mb=None,
+                 manifest_path=data_paths.manifest_path):
         assert city_name in city_profile_dict, 'The name of the city is not right!'
         self.city_name = city_name  # the name of city
         self.city_bounding_box = city_profile_dict[city_name][0]  # load the predefined bounding box
@@ -44,249 +48,102 @@ class CountTweets(object):
         self.considered_quarter_list = ['Q1', 'Q2', 'Q3', 'Q4']
         self.start_time = start_time
         self.end_time = end_time
-        # load the detected bot ids
-        if type(city_profile_dict[city_name][4]) == set:
-            self.bot_ids = city_profile_dict[city_name][4]
-        elif type(city_profile_dict[city_name][4]) == str:
-            self.bot_ids = np.load(os.path.join(city_profile_dict[city_name][4]), allow_pickle=True).item()
+        self.parquet_path = parquet_path  # the parquet mirror of the tweets. None means reading the csv files
+        self.memory_limit_mb = memory_limit_mb  # the memory ceiling of one chunk. None means reading whole files
+        self.manifest_path = manifest_path  # the path saving the manifests. None means processing all the files
+        self.bot_ids = load_bot_ids(city_profile_dict[city_name][4])  # load the detected bot ids
 
-    def count_geocoded_tweets_hour(self):
+    def scan(self, aggregators: list, workers: int = 1) -> list:
+        """
+        Read each hourly file of the city once and feed the tweets to all the aggregators. The deduplication,
+        bot filtering, spatial join and time parsing are shared by the aggregators
+        :param aggregators: a list of aggregators defined in scan_engine, such as HourlyCountAggregator
+        :param workers: the number of worker processes used to read and process the hourly files
+        :return: the list of updated aggregators
+        """
+        updated_aggregators, = scan_cities_together([self], [aggregators], workers=workers)
+        return updated_aggregators
 
+    def load_manifest(self):
         """
-        Count the geocoded tweets (lat and lon) posted in each hour of the study time
-        :return: a pandas dataframe saving the number of tweets posted in each hour of the study time
+        Load the manifest saving the partial aggregates of the processed hourly files. Each setting of bot ids,
+        timezone and city shapefile has its own manifest
+        :return: a FileManifest. None if self.manifest_path is None
         """
+        if self.manifest_path is None:
+            return None
+        shapefile_mtime = os.path.getmtime(self.city_shapefile_loc) if os.path.exists(
+            self.city_shapefile_loc) else None
+        config_hash = compute_config_hash(self.bot_ids, self.count_in_utc, str(self.city_timezone),
+                                          self.city_shapefile_loc, shapefile_mtime)
+        return FileManifest(os.path.join(self.manifest_path, '{}_tweets_{}.pkl'.format(self.city_name,
+                                                                                      config_hash[:12])))
 
-        # Create a dictionary to save the number of tweets posted in each hour
-        considered_geocoded_time_count_dict = defaultdict()
+    def count_geocoded_tweets_hour(self, workers: int = 1):
 
-        # Count the tweets...
-        for year in self.considered_year_list:
-            csv_path = os.path.join(self.city_loc, year)
-            try:
-                for csv_file in os.listdir(csv_path):
-                    print('Coping with the file: {}'.format(csv_file))
-                    try:
-                        dataframe = pd.read_csv(open(os.path.join(csv_path, csv_file),
-                                                     encoding='utf-8',
-                                                     errors='ignore'),
-                                                usecols=considered_colnames,
-                                                dtype=dtype_dict)
-                        geocoded_dataframe = dataframe.loc[~dataframe['lat'].isnull()]
-                        # print(geocoded_dataframe['lat'].dtype.name)
-                        geocoded_without_duplicates = geocoded_dataframe.drop_duplicates(subset=['id_str'])
-                        geocoded_without_bot = geocoded_without_duplicates.loc[
-                            ~geocoded_without_duplicates['user_id_str'].isin(self.bot_ids)]
-                        # geocoded_in_box = self.find_tweet_in_bounding_box(geocoded_without_bot,
-                        #                                                   bounding_box_vals=self.city_bounding_box)
-                        geocoded_tweet_city = self.find_tweet_in_city(dataframe=geocoded_without_bot)
-
-                        # Process the dataframe with lat and lon
-                        if geocoded_tweet_city.shape[0] == 0:
-                            geocoded_tweet_counter = Counter()
-                        else:
-                            geocoded_tweet_city_copy = geocoded_tweet_city.copy()
-                            if self.count_in_utc:
-                                geocoded_tweet_city_copy['clean_time'] = geocoded_tweet_city_copy.apply(
-                                    lambda row: transform_time_string_to_utc_time(time_string=row['created_at']),
-                                    axis=1)
-                            else:
-                                geocoded_tweet_city_copy['clean_time'] = geocoded_tweet_city_copy.apply(
-                                    lambda row: transform_string_time_to_datetime(
-                                        time_string=row['created_at'], target_time_zone=self.city_timezone), axis=1)
-                            geocoded_tweet_city_copy['year_month_day_hour_weekday'] = geocoded_tweet_city_copy.apply(
-                                lambda row: str(row['clean_time'].year) + '_' + str(
-                                    row['clean_time'].month) + '_' + str(
-                                    row['clean_time'].day) + '_' + str(
-                                    row['clean_time'].hour) + '_' + str(row['clean_time'].weekday()), axis=1)
-
-                            geocoded_tweet_counter = Counter(geocoded_tweet_city_copy['year_month_day_hour_weekday'])
-                        considered_geocoded_time_count_dict = merge_dict(sum_dict=considered_geocoded_time_count_dict,
-                                                                         a_dict=geocoded_tweet_counter)
-                    except KeyError:
-                        print('The csv file: {} does not have any column names.Ignore'.format(csv_file))
-                    except ValueError:
-                        print('ValueError occurs for file: {}. Ignore.'.format(csv_file))
-                    except pd.errors.ParserError:
-                        print('Parser error occurred in file: {}. Ignore.'.format(csv_file))
-                print('The year: {} has been processed'.format(year))
-                print('Geocoded count dict: {}'.format(considered_geocoded_time_count_dict))
-            except FileNotFoundError:
-                print('There is no {} folder in local'.format(str(year)))
-        count_dataframe = create_dataframe_from_dict(dict_data=considered_geocoded_time_count_dict)
-        default_dataframe_each_hour = self.create_count_dataframe()
-        final_count = pd.merge(left=count_dataframe, right=default_dataframe_each_hour,
-                               on=['year', 'month', 'day', 'hour', 'weekday'], how='right')
-        final_count['total_count_x'] = final_count['total_count_x'].fillna(0)  # fill the NA as zero
-        final_count_droped = final_count.drop(['total_count_y'], axis=1)
-        final_count_renamed = final_count_droped.rename(columns={'total_count_x': 'total_count'})
-        return final_count_renamed
+        """
+        Count the geocoded tweets (lat and lon) posted in each hour of the study time
+        :param workers: the number of worker processes. The default 1 processes the hourly files serially
+        :return: a pandas dataframe saving the number of tweets posted in each hour of the study time
+        """
+        hourly_aggregator, = self.scan([HourlyCountAggregator(start_time=self.start_time, end_time=self.end_time,
+                                                              view='geocoded')], workers=workers)
+        return hourly_aggregator.to_dataframe()
 
-    def count_geocoded_place_tweets_hour(self):
+    def count_geocoded_place_tweets_hour(self, workers: int = 1):
 
         """
         Count the geocoded place tweets (place_lat and place_lon) posted in each hour of the study time
+        :param workers: the number of worker processes. The default 1 processes the hourly files serially
         :return: a pandas dataframe saving the number of tweets posted in each hour of the study time
         """
+        hourly_place_aggregator, = self.scan([HourlyCountAggregator(start_time=self.start_time,
+                                                                    end_time=self.end_time, view='place')],
+                                             workers=workers)
+        return hourly_place_aggregator.to_dataframe()
 
-        # Create a dictionary to save the number of tweets posted in each hour
-        geocoded_place_time_count_dict = defaultdict()
-
-        # Count the tweets...
-        for year in self.considered_year_list:
-            csv_path = os.path.join(self.city_loc, year)
-            try:
-                for csv_file in os.listdir(csv_path):
-                    print('Coping with the file: {}'.format(csv_file))
-                    try:
-                        dataframe = pd.read_csv(open(os.path.join(csv_path, csv_file), encoding='utf-8',
-                                                     errors='ignore'), usecols=considered_colnames,
-                                                dtype=dtype_dict)
-                        geocoded_place_dataframe = dataframe.loc[~dataframe['place_lat'].isnull()]
-                        geocoded_without_duplicates = geocoded_place_dataframe.drop_duplicates(subset=['id_str'])
-                        geocoded_without_bot = geocoded_without_duplicates.loc[
-                            ~geocoded_without_duplicates['user_id_str'].isin(self.bot_ids)]
-                        # geocoded_in_box = self.find_tweet_in_bounding_box(geocoded_without_bot,
-                        #                                                   bounding_box_vals=self.city_bounding_box)
-                        geocoded_place_tweet_city = self.find_tweet_place_in_city(geocoded_without_bot)
-
-                        # Process the dataframe with lat and lon
-                        if geocoded_place_tweet_city.shape[0] == 0:
-                            geocoded_tweet_counter = Counter()
-                        else:
-                            geocoded_tweet_city_copy = geocoded_place_tweet_city.copy()
-                            if self.count_in_utc:
-                                geocoded_tweet_city_copy['clean_time'] = geocoded_tweet_city_copy.apply(
-                                    lambda row: transform_time_string_to_utc_time(time_string=row['created_at']),
-                                    axis=1)
-                            else:
-                                geocoded_tweet_city_copy['clean_time'] = geocoded_tweet_city_copy.apply(
-                                    lambda row: transform_string_time_to_datetime(
-                                        time_string=row['created_at'], target_time_zone=self.city_timezone), axis=1)
-                            geocoded_tweet_city_copy['year_month_day_hour_weekday'] = geocoded_tweet_city_copy.apply(
-                                lambda row: str(row['clean_time'].year) + '_' + str(
-                                    row['clean_time'].month) + '_' + str(
-                                    row['clean_time'].day) + '_' + str(
-                                    row['clean_time'].hour) + '_' + str(row['clean_time'].weekday()), axis=1)
-                            geocoded_tweet_counter = Counter(geocoded_tweet_city_copy['year_month_day_hour_weekday'])
-                        geocoded_place_time_count_dict = merge_dict(sum_dict=geocoded_place_time_count_dict,
-                                                                    a_dict=geocoded_tweet_counter)
-                    except KeyError:
-                        print('The csv file: {} does not have any colnames.Ignore'.format(csv_file))
-                    except ValueError:
-                        print('ValueError occurs for file: {}. Ignore.'.format(csv_file))
-                    except pd.errors.ParserError:
-                        print('Parser error occurred in file: {}. Ignore.'.format(csv_file))
-                print('The year: {} has been processed'.format(year))
-                print('Geocoded count dict: {}'.format(geocoded_place_time_count_dict))
-            except FileNotFoundError:
-                print('There is no {} folder in local'.format(str(year)))
-        count_place_dataframe = create_dataframe_from_dict(dict_data=geocoded_place_time_count_dict)
-        default_dataframe_each_hour = self.create_count_dataframe()
-        final_count = pd.merge(left=count_place_dataframe, right=default_dataframe_each_hour,
-                               on=['year', 'month', 'day', 'hour', 'weekday'], how='right')
-        final_count['total_count_x'] = final_count['total_count_x'].fillna(0)  # fill the NA as zero
-        final_count_droped = final_count.drop(['total_count_y'], axis=1)
-        final_count_renamed = final_count_droped.rename(columns={'total_count_x': 'total_count'})
-        return final_count_renamed
-
-    def count_tweets_monthly(self):
+    def count_tweets_monthly(self, workers: int = 1):
         """
         Count the geocoded and all the tweets posted in one city
+        :param workers: the number of worker processes. The default 1 processes the hourly files serially
         Returns:
         """
-        print('Set up the counting dictionary...')
-        considered_geocoded_time_count_dict = defaultdict()
-        considered_all_time_count_dict = defaultdict()
-        key_vals = []
-        for year in self.considered_year_list:
-            for month in range(1, 13):
-                considered_geocoded_time_count_dict[str(year) + '_' + str(month)] = 0
-                considered_all_time_count_dict[str(year) + '_' + str(month)] = 0
-                key_vals.append(str(year) + '_' + str(month))
-        print('Done!')
-        for year in self.considered_year_list:
-            csv_path = os.path.join(self.city_loc, year)
-            try:
-                for csv_file in os.listdir(csv_path):
-                    print('Coping with the file: {}'.format(csv_file))
-                    try:
-                        dataframe = pd.read_csv(open(os.path.join(csv_path, csv_file), encoding='utf-8',
-                                                     errors='ignore'), usecols=considered_colnames, dtype=dtype_dict)
-                        geocoded_dataframe = dataframe.loc[~dataframe['lat'].isnull()]
-                        geocoded_place_dataframe = dataframe.loc[~dataframe['place_lat'].isnull()]
-
-                        geocoded_without_duplicates = geocoded_dataframe.drop_duplicates(subset=['id_str'])
-                        geocoded_without_bot = geocoded_without_duplicates.loc[
-                            ~geocoded_without_duplicates['user_id_str'].isin(self.bot_ids)]
-                        geocoded_tweet_city = self.find_tweet_in_city(geocoded_without_bot)
-
-                        geocoded_place_without_duplicates = geocoded_place_dataframe.drop_duplicates(
-                            subset=['id_str'])
-                        geocoded_place_without_bot = geocoded_place_without_duplicates.loc[
-                            ~geocoded_place_without_duplicates['user_id_str'].isin(self.bot_ids)]
-                        geocoded_place_tweet_city = self.find_tweet_place_in_city(geocoded_place_without_bot)
-
-                        # Process the dataframe with lat and lon
-                        if geocoded_tweet_city.shape[0] == 0:
-                            geocoded_tweet_city_copy = pd.DataFrame()
-                            geocoded_tweet_counter = Counter()
-                        else:
-                            geocoded_tweet_city_copy = geocoded_tweet_city.copy()
-                            if self.count_in_utc:
-                                geocoded_tweet_city_copy['clean_time'] = geocoded_tweet_city_copy.apply(
-                                    lambda row: transform_time_string_to_utc_time(time_string=row['created_at']),
-                                    axis=1)
-                            else:
-                                geocoded_tweet_city_copy['clean_time'] = geocoded_tweet_city_copy.apply(
-                                    lambda row: transform_string_time_to_datetime(time_string=row['created_at'],
-                                                                                  target_time_zone=self.city_timezone),
-                                    axis=1)
-                            geocoded_tweet_city_copy['year_month'] = geocoded_tweet_city_copy.apply(
-                                lambda row: str(row['clean_time'].year) + '_' + str(row['clean_time'].month), axis=1)
-                            geocoded_tweet_counter = Counter(geocoded_tweet_city_copy['year_month'])
-
-                        # Process the dataframe with place_lat and place_lon
-                        if geocoded_place_tweet_city.shape[0] == 0:
-                            geocoded_place_tweet_city_copy = pd.DataFrame()
-                        else:
-                            geocoded_place_tweet_city_copy = geocoded_place_tweet_city.copy()
-                            if self.count_in_utc:
-                                geocoded_place_tweet_city_copy['clean_time'] = geocoded_place_tweet_city_copy.apply(
-                                    lambda row: transform_time_string_to_utc_time(row['created_at']), axis=1)
-                            else:
-                                geocoded_place_tweet_city_copy['clean_time'] = geocoded_place_tweet_city_copy.apply(
-                                    lambda row: transform_string_time_to_datetime(row['created_at'],
-                                                                                  target_time_zone=self.city_timezone),
-                                    axis=1)
-                            geocoded_place_tweet_city_copy['year_month'] = geocoded_place_tweet_city_copy.apply(
-                                lambda row: str(row['clean_time'].year) + '_' + str(row['clean_time'].month), axis=1)
-
-                        combined_tweet = pd.concat([geocoded_tweet_city_copy, geocoded_place_tweet_city_copy], axis=0)
-                        if 'year_month' in combined_tweet:
-                            combined_tweet_without_duplicates = combined_tweet.drop_duplicates(subset='id_str')
-                            all_tweet_counter = Counter(combined_tweet_without_duplicates['year_month'])
-                        else:
-                            all_tweet_counter = Counter()
-                        considered_geocoded_time_count_dict = merge_dict(considered_geocoded_time_count_dict,
-                                                                         geocoded_tweet_counter)
-                        considered_all_time_count_dict = merge_dict(considered_all_time_count_dict, all_tweet_counter)
-                    except KeyError:
-                        print('The csv file: {} does not have any colnames.Ignore'.format(csv_file))
-                    except ValueError:
-                        print('ValueError occurs for file: {}. Ignore.'.format(csv_file))
-                    except pd.errors.ParserError:
-                        print('Parser error occurred in file: {}. Ignore.'.format(csv_file))
-                print('The year: {} has been processed'.format(year))
-                print('Geocoded count dict: {}'.format(considered_geocoded_time_count_dict))
-                print('All count dict: {}'.format(considered_all_time_count_dict))
-            except FileNotFoundError:
-                print('There is no {} folder in local'.format(str(year)))
-        # Save the counts to local directory
-        count_dataframe = pd.DataFrame(columns=['time', 'geocoded_count', 'all_count'])
-        count_dataframe['time'] = key_vals
-        count_dataframe['geocoded_count'] = [considered_geocoded_time_count_dict[key] for key in key_vals]
-        count_dataframe['all_count'] = [considered_all_time_count_dict[key] for key in key_vals]
+        monthly_aggregator, = self.scan([MonthlyCountAggregator()], workers=workers)
+        self.save_monthly_count(monthly_aggregator.to_dataframe(self))
+
+    def count_tweets_single_pass(self, open_space_data: gpd.GeoDataFrame = None, workers: int = 1) -> dict:
+        """
+        Compute the hourly geocoded counts, hourly place counts, monthly counts, user statistics and
+        (optionally) the tweets posted in open space with one pass over the tweets of the city
+        :param open_space_data: the open space shapefile of the city in epsg=4326. None means not
+        finding the tweets posted in open space
+        :param workers: the number of worker processes. The default 1 processes the hourly files serially
+        :return: a python dict saving the results. The monthly counts are also saved to local directory
+        """
+        aggregators = {'geocoded_hour': HourlyCountAggregator(start_time=self.start_time, end_time=self.end_time,
+                                                              view='geocoded'),
+                       'place_hour': HourlyCountAggregator(start_time=self.start_time, end_time=self.end_time,
+                                                           view='place'),
+                       'month': MonthlyCountAggregator(),
+                       'user_stats': UserStatsAggregator()}
+        if open_space_data is not None:
+            aggregators['open_space'] = OpenSpaceAggregator(open_space_index=OpenSpaceIndex(open_space_data))
+        self.scan(list(aggregators.values()), workers=workers)
+        result_dict = {'geocoded_hour': aggregators['geocoded_hour'].to_dataframe(),
+                       'place_hour': aggregators['place_hour'].to_dataframe(),
+                       'month': aggregators['month'].to_dataframe(self),
+                       'user_stats': aggregators['user_stats'].to_dataframe()}
+        if open_space_data is not None:
+            result_dict['open_space'] = aggregators['open_space'].to_dataframe()
+        self.save_monthly_count(result_dict['month'])
+        return result_dict
+
+    def save_monthly_count(self, count_dataframe: pd.DataFrame) -> None:
+        """
+        Save the monthly tweet count to the local directory
+        :param count_dataframe: the pandas dataframe saving the monthly count
+        :return: None
+        """
         if self.count_in_utc:
             count_dataframe.to_csv(os.path.join(self.saving_path_for_month, self.city_name + '(UTC)_tweet_count.csv'),
                                    encoding='utf-8')
@@ -294,6 +151,25 @@ class CountTweets(object):
             count_dataframe.to_csv(os.path.join(self.saving_path_for_month, self.city_name + 'tweet_count.csv'),
                                    encoding='utf-8')
 
+    def add_clean_time(self, dataframe: pd.DataFrame) -> pd.DataFrame:
+        """
+        Add the 'clean_time' column, the datetime object in UTC or the local time of the city, to the tweets.
+        The tweets with malformed time strings are removed
+        :param dataframe: a pandas dataframe saving the tweets
+        :return: a pandas dataframe with the 'clean_time' column
+        """
+        dataframe_copy = dataframe.copy()
+        if self.count_in_utc:
+            dataframe_copy['clean_time'] = parse_created_at(dataframe_copy['created_at'], target_time_zone=pytz.utc,
+                                                            convert_utc_time=False)
+        else:
+            dataframe_copy['clean_time'] = parse_created_at(dataframe_copy['created_at'],
+                                                            target_time_zone=self.city_timezone)
+        malformed_time = dataframe_copy['clean_time'].isnull()
+        if malformed_time.any():
+            print('{} tweets have malformed time strings. Ignore'.format(malformed_time.sum()))
+        return dataframe_copy.loc[~malformed_time]
+
     def get_tweets_from_id_set(self, tweet_id_set, save_path, save_filename):
         """
         Get the tweets by the tweet id(int64)
@@ -304,25 +180,17 @@ class CountTweets(object):
         Returns: None
         """
         select_data_list = []
-        for year in self.considered_year_list:
-            print('Coping with the year: {}'.format(year))
-            if year not in os.listdir(self.city_loc):
-                print('We have not collected tweets or do not consider tweets posted in {}'.format(year))
-                continue
-            csv_file_path = os.path.join(self.city_loc, year)
-            for file in os.listdir(csv_file_path):
-                try:
-                    dataframe = pd.read_csv(os.path.join(csv_file_path, file), encoding='utf-8',
-                                            usecols=considered_colnames, dtype=dtype_dict)
-                    assert dataframe['id_str'].dtype.name == 'int64', "The dtype of the column 'id_str' is not right!"
-                    dataframe_select = dataframe.loc[dataframe['id_str'].isin(tweet_id_set)]
-                    select_data_list.append(dataframe_select)
-                except ValueError:
-                    print('ValueError occurred when reading file: {}. Ignore'.format(file))
-                    continue
-                except pd.errors.ParserError:
-                    print('Parser error occurred in file: {}. Ignore.'.format(file))
-                    continue
+        # The tweet ids are saved as strings in both the csv files and the parquet mirror
+        tweet_id_str_set = {str(tweet_id) for tweet_id in tweet_id_set}
+        # Only the files saving the tweet ids are read
+        id_sources = find_id_sources(self.city_loc, self.considered_year_list, tweet_id_str_set, id_type='message',
+                                     parquet_path=self.parquet_path)
+        for file, dataframe in iter_source_dataframes(id_sources, usecols=considered_colnames, dtype=dtype_dict):
+            dataframe_select = dataframe.loc[dataframe['id_str'].isin(tweet_id_str_set)]
+            select_data_list.append(dataframe_select)
+        if len(select_data_list) == 0:
+            print('None of the tweet ids is found')
+            select_data_list.append(pd.DataFrame(columns=considered_colnames))
         result_dataframe = pd.concat(select_data_list, axis=0)
         result_dataframe_reindex = result_dataframe.reset_index(drop=True)
         result_dataframe_without_duplicates = result_dataframe_reindex.drop_duplicates(subset=['id_str'], keep='first')
@@ -366,26 +234,8 @@ class CountTweets(object):
         Create the count dataframe based on the starting time and the ending time
         :return: a pandas dataframe saving the default number of Weibos posted in each hour
         """
-        cur_time = self.start_time
-        result_dataframe = pd.DataFrame()
-        year_list, month_list, weekday_list = [], [], []
-        day_list, hour_list = [], []
-        while self.end_time != cur_time:
-            check_time_year, check_time_month = cur_time.year, cur_time.month
-            check_time_day, check_time_hour = cur_time.day, cur_time.hour
-            check_time_weekday = cur_time.weekday()
-            year_list.append(check_time_year)
-            month_list.append(check_time_month)
-            day_list.append(check_time_day)
-            hour_list.append(check_time_hour)
-            weekday_list.append(check_time_weekday)
-            cur_time = cur_time + timedelta(hours=1)
-        result_dataframe['year'] = year_list
-        result_dataframe['month'] = month_list
-        result_dataframe['day'] = day_list
-        result_dataframe['hour'] = hour_list
-        result_dataframe['weekday'] = weekday_list
-        result_dataframe['total_count'] = [0] * len(year_list)
+        result_dataframe = create_hour_calendar(self.start_time, self.end_time)
+        result_dataframe['total_count'] = 0
         return result_dataframe
 
     def find_tweet_in_city(self, dataframe):
@@ -394,27 +244,16 @@ class CountTweets(object):
         :param dataframe: a pandas dataframe saving the geocoded tweets
         :return: tweets posted in the city
         """
-        if (dataframe['lat'].dtype.name != 'float64') or (dataframe['lon'].dtype.name != 'float64'):
-            print('Something wrong with the datatype of latitude and longitude...')
-            dataframe_copy = dataframe.copy()
-            dataframe_copy['lat'] = dataframe_copy['lat'].astype(str)
-            dataframe_copy['lon'] = dataframe_copy['lon'].astype(str)
-            dataframe_copy_select = dataframe_copy[dataframe_copy['lat'].str.startswith(
-                lat_lon_start_tuple)]
-            dataframe_final = dataframe_copy_select[dataframe_copy_select['lon'].str.startswith(
-                lat_lon_start_tuple)].copy()
-            dataframe_final['lat'] = dataframe_final['lat'].astype(np.float64)
-            dataframe_final['lon'] = dataframe_final['lon'].astype(np.float64)
-        else:
-            dataframe_final = dataframe.copy()
-        geocoded_tweet_gdf = gpd.GeoDataFrame(dataframe_final,
-                                              geometry=gpd.points_from_xy(dataframe_final.lon,
-                                                                          dataframe_final.lat))
-        geocoded_tweet_gdf = geocoded_tweet_gdf.set_crs(epsg=4326, inplace=True)
-        city_shape = gpd.read_file(self.city_shapefile_loc)
-        city_shape_4326 = city_shape.to_crs(epsg=4326)
-        joined_data_final = CountTweets.spatial_join(tweet_gdf=geocoded_tweet_gdf, shape_area=city_shape_4326)
-        return joined_data_final.reset_index(drop=True)
+        dataframe_final = sanitize_coordinates(dataframe)
+        city_geometry = load_geometry(self.city_shapefile_loc,
+                                      mask_resolution=city_mask_resolution.get(self.city_name))
+        in_city = city_geometry.contains_points(dataframe_final['lon'], dataframe_final['lat'])
+        dataframe_in_city = dataframe_final.loc[in_city].drop_duplicates(subset=['id_str'])
+        geocoded_tweet_gdf = gpd.GeoDataFrame(dataframe_in_city,
+                                              geometry=gpd.points_from_xy(dataframe_in_city.lon,
+                                                                          dataframe_in_city.lat),
+                                              crs='epsg:4326')
+        return geocoded_tweet_gdf.reset_index(drop=True)
 
     @staticmethod
     def find_tweet_in_bounding_box(dataframe, bounding_box_vals):
@@ -429,20 +268,7 @@ class CountTweets(object):
         """
         lat_min, lat_max = bounding_box_vals[1], bounding_box_vals[3]
         lon_min, lon_max = bounding_box_vals[0], bounding_box_vals[2]
-        # Cope with some bad rows where the geoinformation is stored as a strange string
-        if (dataframe['lat'].dtype.name != 'float64') or (dataframe['lon'].dtype.name != 'float64'):
-            print('Something wrong with the datatype of latitude and longitude...')
-            dataframe_copy = dataframe.copy()
-            dataframe_copy['lat'] = dataframe_copy['lat'].astype(str)
-            dataframe_copy['lon'] = dataframe_copy['lon'].astype(str)
-            dataframe_copy_select = dataframe_copy[dataframe_copy['lat'].str.startswith(
-                lat_lon_start_tuple)]
-            dataframe_final = dataframe_copy_select[dataframe_copy_select['lon'].str.startswith(
-                lat_lon_start_tuple)].copy()
-            dataframe_final['lat'] = dataframe_final['lat'].astype(np.float64)
-            dataframe_final['lon'] = dataframe_final['lon'].astype(np.float64)
-        else:
-            dataframe_final = dataframe.copy()
+        dataframe_final = sanitize_coordinates(dataframe)
         decision1 = (dataframe_final['lat'] >= lat_min) & (dataframe_final['lat'] <= lat_max)
         decision2 = (dataframe_final['lon'] >= lon_min) & (dataframe_final['lon'] <= lon_max)
         data_in_city = dataframe_final[decision1 & decision2]
@@ -455,27 +281,12 @@ class CountTweets(object):
         :param dataframe: a pandas dataframe saving the geocoded tweets
         :return: tweets posted in the city
         """
-        if (dataframe['place_lat'].dtype.name != 'float64') or (dataframe['place_lon'].dtype.name != 'float64'):
-            print('Something wrong with the datatype of latitude and longitude...')
-            dataframe_copy = dataframe.copy()
-            dataframe_copy['place_lat'] = dataframe_copy['place_lat'].astype(str)
-            dataframe_copy['place_lon'] = dataframe_copy['place_lon'].astype(str)
-            dataframe_copy_select = dataframe_copy[dataframe_copy['place_lat'].str.startswith(
-                lat_lon_start_tuple)]
-            dataframe_final = dataframe_copy_select[dataframe_copy_select['place_lon'].str.startswith(
-                lat_lon_start_tuple)].copy()
-            dataframe_final['place_lat'] = dataframe_final['place_lat'].astype(np.float64)
-            dataframe_final['place_lon'] = dataframe_final['place_lon'].astype(np.float64)
-        else:
-            dataframe_final = dataframe.copy()
-        geocoded_tweet_gdf = gpd.GeoDataFrame(dataframe_final,
-                                              geometry=gpd.points_from_xy(dataframe_final.place_lon,
-                                                                          dataframe_final.place_lat))
-        geocoded_tweet_gdf = geocoded_tweet_gdf.set_crs(epsg=4326, inplace=True)
-        city_shape = gpd.read_file(self.city_shapefile_loc)
-        city_shape_4326 = city_shape.to_crs(epsg=4326)
-        joined_data_final = CountTweets.spatial_join(tweet_gdf=geocoded_tweet_gdf, shape_area=city_shape_4326)
-        return joined_data_final.reset_index(drop=True)
+        dataframe_final = sanitize_coordinates(dataframe, lat_colname='place_lat', lon_colname='place_lon')
+        city_geometry = load_geometry(self.city_shapefile_loc,
+                                      mask_resolution=city_mask_resolution.get(self.city_name))
+        in_city = city_geometry.contains_points(dataframe_final['place_lon'], dataframe_final['place_lat'])
+        dataframe_in_city = dataframe_final.loc[in_city].drop_duplicates(subset=['id_str'])
+        return dataframe_in_city.reset_index(drop=True)
 
     @staticmethod
     def find_tweet_place_in_bounding_box(dataframe, bounding_box_vals):
@@ -490,44 +301,37 @@ class CountTweets(object):
         """
         lat_min, lat_max = bounding_box_vals[1], bounding_box_vals[3]
         lon_min, lon_max = bounding_box_vals[0], bounding_box_vals[2]
-        # Cope with some bad rows where the geoinformation is stored as a strange string
-        if (dataframe['place_lat'].dtype.name != 'float64') or (dataframe['place_lon'].dtype.name != 'float64'):
-            print('The geoinformation of this dataframe is not saved correctly')
-            dataframe_copy = dataframe.copy()
-            dataframe_copy['place_lat'] = dataframe['place_lat'].astype(str)
-            dataframe_copy['place_lon'] = dataframe['place_lon'].astype(str)
-            dataframe_copy_select = dataframe_copy[dataframe_copy['place_lat'].str.startswith(
-                lat_lon_start_tuple)]
-            dataframe_final = dataframe_copy_select[dataframe_copy_select['place_lon'].str.startswith(
-                lat_lon_start_tuple)].copy()
-            dataframe_final['place_lat'] = dataframe_final['place_lat'].astype(np.float64)
-            dataframe_final['place_lon'] = dataframe_final['place_lon'].astype(np.float64)
-        else:
-            dataframe_final = dataframe.copy()
+        dataframe_final = sanitize_coordinates(dataframe, lat_colname='place_lat', lon_colname='place_lon')
         decision1 = (dataframe_final['place_lat'] >= lat_min) & (dataframe_final['place_lat'] <= lat_max)
         decision2 = (dataframe_final['place_lon'] >= lon_min) & (dataframe_final['place_lon'] <= lon_max)
         data_in_city = dataframe_final[decision1 & decision2]
         assert type(data_in_city) == pd.DataFrame, 'The output type of dataframe is not right.'
         return data_in_city.reset_index(drop=True)
 
-    @staticmethod
-    def spatial_join(tweet_gdf, shape_area):
-        """
-        Find the tweets posted in one city's open space
-        :param tweet_gdf: the geopandas dataframe saving the tweets
-        :param shape_area: the shapefile of a studied area, such as city, open space, etc
-        :return: tweets posted in open space
-        """
-        assert tweet_gdf.crs == shape_area.crs, 'The coordinate systems do not match!'
-        joined_data = gpd.sjoin(left_df=tweet_gdf, right_df=shape_area, op='within')
-        joined_data_final = joined_data.drop_duplicates(subset=['id_str'])
-        return joined_data_final
+
+def scan_cities_together(count_objs: list, aggregators_list: list, workers: int = 1) -> list:
+    """
+    Read the hourly files shared by several cities once, such as a city and the metropolitan area around it, and
+    feed the tweets to the aggregators of each city. Each city keeps its own manifest
+    :param count_objs: a list of CountTweets objects reading the same data directory
+    :param aggregators_list: a list saving the aggregators of each city, in the order of count_objs
+    :param workers: the number of worker processes used to read and process the hourly files
+    :return: a list saving the updated aggregators of each city
+    """
+    manifests = [count_obj.load_manifest() for count_obj in count_objs]
+    updated_aggregators_list = SharedTweetScanner(list(zip(count_objs, aggregators_list, manifests))).scan(
+        workers=workers)
+    for manifest in manifests:
+        if manifest is not None:
+            manifest.save()
+    return updated_aggregators_list
 
 
 class CountTweetsOpenSpace(object):
 
     def __init__(self, city_name: str, data_loc: str, start_time: datetime, end_time: datetime, utc_or_not: bool,
-                 timezone: pytz.timezone, save_loc: str, save_filename: str, bot_ids: set):
+                 timezone: pytz.timezone, save_loc: str, save_filename: str, bot_ids,
+                 manifest_path: str = data_paths.manifest_path):
         """
         Count the tweets posted in one city's open space
         :param city_name: the name of the studied city
@@ -538,6 +342,8 @@ class CountTweetsOpenSpace(object):
         :param timezone: the timezone of the studied city
         :param save_loc: the save location in the local directory
         :param save_filename: the save filename
+        :param bot_ids: the ids of the bot accounts: a BotIdStore, a python set or the .npy file saving them
+        :param manifest_path: the path saving the manifests. None means processing all the files
         """
         self.city_name = city_name
         self.data_loc = data_loc
@@ -547,7 +353,43 @@ class CountTweetsOpenSpace(object):
         self.end_time = end_time
         self.count_in_utc = utc_or_not
         self.save_filename = save_filename
-        self.bot_ids = bot_ids
+        self.bot_ids = load_bot_ids(bot_ids)
+        self.manifest_path = manifest_path
+
+    def load_manifest(self):
+        """
+        Load the manifest saving the hourly count of the processed open space files. Each setting of bot ids,
+        timezone and study time has its own manifest
+        :return: a FileManifest. None if self.manifest_path is None
+        """
+        if self.manifest_path is None:
+            return None
+        config_hash = compute_config_hash(self.bot_ids, self.count_in_utc, str(self.timezone),
+                                          self.start_time, self.end_time)
+        return FileManifest(os.path.join(self.manifest_path, '{}_open_space_{}.pkl'.format(self.city_name,
+                                                                                          config_hash[:12])))
+
+    def count_open_space_file(self, file: str) -> tuple:
+        """
+        Count the number of tweets saved in one open space file posted in each hour of the study time
+        :param file: the name of the csv file saving the tweets posted in open space
+        :return: a tuple of the hour indices with tweets and the number of tweets posted in these hours
+        """
+        print('Analyzing the file {} saving the tweets posted in open space...'.format(file))
+        dataframe = pd.read_csv(os.path.join(self.data_loc, file), encoding='utf-8',
+                                usecols=considered_colnames, dtype=dtype_dict)
+        dataframe_without_bot = dataframe.loc[~self.bot_ids.contains(dataframe['user_id_str'])]
+        # Get the local time of each tweet
+        if self.count_in_utc:
+            clean_time = parse_created_at(dataframe_without_bot['created_at'], target_time_zone=pytz.utc,
+                                          convert_utc_time=False)
+        else:
+            clean_time = parse_created_at(dataframe_without_bot['created_at'], target_time_zone=self.timezone)
+        # Count the number of tweets in each hour
+        print('Counting the number of tweets posted in each hour...')
+        accumulator = HourlyCountAccumulator(start_time=self.start_time, end_time=self.end_time)
+        accumulator.add_times(clean_time.dropna())
+        return accumulator.get_sparse_counts()
 
     def count_tweets_hourly(self, day_title: str, hour_title: str, weekday_title: str, day_filename: str,
                             hour_filename: str, weekday_filename: str) -> pd.DataFrame:
@@ -555,60 +397,28 @@ class CountTweetsOpenSpace(object):
         Count the number of tweets posted in each hour of a open space in the studied city
         :return: None. The result is saved in the specified local directory
         """
-        result_dataframe_list = []
-        # start_time = datetime(2016, 5, 1, 0, 0, 0, tzinfo=self.timezone)
-        # end_time = datetime(2020, 12, 31, 0, 0, 0, tzinfo=self.timezone)
-        for file in os.listdir(self.data_loc):
-            cur_time = self.start_time
-			# consider csv files and filename must contain city name
-            if (file.endswith('.csv')) and (self.city_name in file):
-                print('Analyzing the file {} saving the tweets posted in open space...'.format(file))
-                dataframe = pd.read_csv(os.path.join(self.data_loc, file), encoding='utf-8',
-                                        usecols=considered_colnames, dtype=dtype_dict)
-                dataframe_without_bot = dataframe.loc[~dataframe['user_id_str'].isin(self.bot_ids)]
-                # Get the local time and year, month, day, hour attributes
-                print('Coping with the time attributes...')
-                if self.count_in_utc:
-                    dataframe_without_bot['clean_time'] = dataframe_without_bot.apply(
-                        lambda row: transform_time_string_to_utc_time(row['created_at']), axis=1)
-                else:
-                    dataframe_without_bot['clean_time'] = dataframe_without_bot.apply(
-                        lambda row: transform_string_time_to_datetime(row['created_at'],
-                                                                      target_time_zone=self.timezone), axis=1)
-                dataframe_without_bot['year'] = dataframe_without_bot.apply(lambda row: row['clean_time'].year, axis=1)
-                dataframe_without_bot['month'] = dataframe_without_bot.apply(lambda row: row['clean_time'].month,
-                                                                             axis=1)
-                dataframe_without_bot['day'] = dataframe_without_bot.apply(lambda row: row['clean_time'].day, axis=1)
-                dataframe_without_bot['hour'] = dataframe_without_bot.apply(lambda row: row['clean_time'].hour, axis=1)
-                print('Done!')
-
-                # Count the number of tweets in each hour
-                print('Counting the number of tweets posted in each hour...')
-                result_count_list = []
-                result_time_list = []
-
-                while self.end_time != cur_time:
-                    print('Coping with the time: {}'.format(cur_time))
-                    check_time_year, check_time_month = cur_time.year, cur_time.month
-                    check_time_day, check_time_hour = cur_time.day, cur_time.hour
-                    dataframe_year_month = dataframe_without_bot.loc[
-                        (dataframe_without_bot['year'] == check_time_year) & (
-                                dataframe_without_bot['month'] == check_time_month)]
-                    dataframe_day_hour = dataframe_year_month.loc[
-                        (dataframe_year_month['day'] == check_time_day) & (dataframe_year_month['hour'] ==
-                                                                           check_time_hour)]
-                    result_time_list.append(cur_time)
-                    result_count_list.append(dataframe_day_hour.shape[0])
-                    cur_time = cur_time + timedelta(hours=1)
-                result_dataframe = pd.DataFrame(columns=['year', 'month', 'day', 'hour', 'open_space_count'])
-                result_dataframe['year'] = [timestamp.year for timestamp in result_time_list]
-                result_dataframe['month'] = [timestamp.month for timestamp in result_time_list]
-                result_dataframe['day'] = [timestamp.day for timestamp in result_time_list]
-                result_dataframe['hour'] = [timestamp.hour for timestamp in result_time_list]
-                result_dataframe['weekday'] = [timestamp.weekday() for timestamp in result_time_list]
-                result_dataframe['open_space_count'] = result_count_list
-                result_dataframe_list.append(result_dataframe)
-        combined_result_dataframe = sum_dataframe_list_count(result_dataframe_list)
+        accumulator = HourlyCountAccumulator(start_time=self.start_time, end_time=self.end_time)
+        manifest = self.load_manifest()
+        # consider csv files and filename must contain city name
+        considered_files = [file for file in os.listdir(self.data_loc) if
+                            (file.endswith('.csv')) and (self.city_name in file)]
+        if manifest is not None:
+            manifest.keep_only({(os.path.join(self.data_loc, file), None) for file in considered_files})
+        for file in considered_files:
+            file_path = os.path.join(self.data_loc, file)
+            partials = manifest.get_partials(file_path, ['open_space_hour_counts']) if manifest is not None else None
+            if partials is not None:
+                print('The file {} has not been changed. Reuse the saved count'.format(file))
+                accumulator.add_sparse_counts(*partials[0])
+                continue
+            file_stat = os.stat(file_path)  # taken before reading, so a file appended meanwhile is read again
+            hour_counts = self.count_open_space_file(file)
+            if manifest is not None:
+                manifest.set_partials(file_path, file_stat, ['open_space_hour_counts'], [hour_counts])
+            accumulator.add_sparse_counts(*hour_counts)
+        if manifest is not None:
+            manifest.save()
+        combined_result_dataframe = accumulator.to_dataframe(count_colname='open_space_count')
         if self.count_in_utc:
             print('Counting the number of tweets on each day...')
             create_day_plot_for_one_count(combined_result_dataframe, title=day_title,
@@ -647,37 +457,54 @@ class CountTweetsOpenSpace(object):
         return combined_result_dataframe
 
 
-def main_count_tweets(count_in_utc: bool = True, considered_city_names=None):
+def main_count_tweets(count_in_utc: bool = True, considered_city_names=None, workers: int = 1,
+                      cities_profile: dict = cities_dict_foreign, memory_limit_mb: float = None):
     """
     Main function to count the tweets in both the city and the open space
     :param count_in_utc: count the tweets in UTC time or not
     :param considered_city_names: a set containing the names of processed cities
+    :param workers: the number of worker processes used to count the tweets posted in each city
+    :param cities_profile: a python dictionary saving the profile of each city, such as cities_dict_netherland
+    :param memory_limit_mb: the memory ceiling (MB) of one chunk. If given, the hourly files are read chunk by
+    chunk. None means reading each hourly file at once
     :return: None. The tweet count summary and figures have been saved to local directory
     """
     if considered_city_names is None:
         considered_city_names = {}
-    for city in cities_dict_foreign:
-        if city in considered_city_names:
+    # The cities sharing one data directory, such as a city and its metropolitan area, are scanned together
+    for city_group in group_cities_by_data_loc(considered_city_names, cities_profile):
+        count_obj_dict = {}
+        for city in city_group:
+            if count_in_utc:
+                timezone = pytz.utc
+            else:
+                timezone = cities_profile[city][1]
+            count_obj_dict[city] = CountTweets(city_name=city, city_profile_dict=cities_profile,
+                                               start_time=datetime(2016, 5, 1, tzinfo=timezone),
+                                               end_time=datetime(2020, 12, 31, tzinfo=timezone),
+                                               utc_or_not=count_in_utc, memory_limit_mb=memory_limit_mb)
+
+        # Count the tweets posted within each city
+        print("Counting the tweets posted in: {}".format(', '.join(city_group)))
+        count_objs = [count_obj_dict[city] for city in city_group]
+        updated_aggregators_list = scan_cities_together(
+            count_objs, [[HourlyCountAggregator(start_time=count_obj.start_time, end_time=count_obj.end_time,
+                                                view='geocoded')] for count_obj in count_objs], workers=workers)
+        geocoded_count_dict = {city: aggregators[0].to_dataframe()
+                               for city, aggregators in zip(city_group, updated_aggregators_list)}
+
+        for city in city_group:
             print("Coping with the city: {}".format(city))
 
             if count_in_utc:
                 timezone = pytz.utc
             else:
-                timezone = cities_dict_foreign[city][1]
+                timezone = cities_profile[city][1]
 
-            if type(cities_dict_foreign[city][4]) == set:
-                city_bot_ids = cities_dict_foreign[city][4]
-            elif type(cities_dict_foreign[city][4]) == str:
-                city_bot_ids = np.load(cities_dict_foreign[city][4], allow_pickle=True).item()
-            else:
-                raise ValueError("The bot ids are not loaded correctly!")
-
-            # Count the tweets posted within the city
-            count_obj = CountTweets(city_name=city, city_profile_dict=cities_dict_foreign,
-                                    start_time=datetime(2016, 5, 1, tzinfo=timezone),
-                                    end_time=datetime(2020, 12, 31, tzinfo=timezone),
-                                    utc_or_not=count_in_utc)
-            geocoded_count_dataframe = count_obj.count_geocoded_tweets_hour()
+            city_bot_ids = load_bot_ids(cities_profile[city][4])
+
+            count_obj = count_obj_dict[city]
+            geocoded_count_dataframe = geocoded_count_dict[city]
             if os.path.exists(os.path.join(data_paths.count_daily_hour_path, city)):
                 if count_obj.count_in_utc:
                     geocoded_count_dataframe.to_csv(os.path.join(data_paths.count_daily_hour_path, city,
@@ -712,8 +539,8 @@ def main_count_tweets(count_in_utc: bool = True, considered_city_names=None):
                 weekday_filename='{}_open_space_weekday.png'.format(city))
 
             # Combine the result and save
-            count_final = pd.merge(left=geocoded_count_dataframe, right=combined_open_space_dataframe,
-                                   on=['year', 'month', 'day', 'hour', 'weekday'])
+            # Both dataframes are indexed by the same hour calendar
+            count_final = geocoded_count_dataframe.join(combined_open_space_dataframe[['open_space_count']])
             count_final['percent'] = (count_final['open_space_count'] / count_final['total_count']).replace(
                 to_replace=[np.inf, np.nan], value=-9999)  # For the situations when no tweet is posted in the city
             if os.path.exists(os.path.join(data_paths.count_daily_hour_path, city)):
@@ -731,8 +558,6 @@ def main_count_tweets(count_in_utc: bool = True, considered_city_names=None):
                 else:
                     count_final.to_csv((os.path.join(data_paths.count_daily_hour_path, city,
                                                      '{}_count_combine.csv'.format(city))))
-        else:
-            print('Tweets posted in {} have been counted'.format(city))
 
 
 if __name__ == '__main__':
@@ -3,25 +3,22 @@
 import os
 import numpy as np
 import pytz
-from collections import defaultdict, Counter
-from datetime import datetime, timedelta
+import multiprocessing as mp
+from datetime import datetime
 import pandas as pd
 
-# For spatial analysis
-import geopandas as gpd
-
 # For path and functions for visualizations
 import data_paths
-from cities_bounds import cities_dict_china, open_space_saving_path
-from utils import transform_string_time_to_datetime, merge_dict, create_dataframe_from_dict, sum_dataframe_list_count
+from cities_bounds import cities_dict_china, open_space_saving_path, city_mask_resolution
+from utils import parse_created_at, create_hour_calendar, split_into_batches, batches_per_worker, \
+    HourlyCountAccumulator, sanitize_coordinates
+from geometry_cache import load_geometry
+from bot_store import load_bot_ids
+from tweet_store import to_compact_dataframe
+from id_index import update_csv_id_index
 from visualizations import create_day_plot_for_one_count, create_hour_weekday_plot
 
 
-# Cope with some bad latitude and longitude data
-lat_lon_start_tuple = tuple([str(val) for val in range(10)] + ['-'])
-print(lat_lon_start_tuple)
-
-
 class CountWeibos(object):
     """
     Count the number of geocoded Weibos posted in one city
@@ -35,11 +32,7 @@ class CountWeibos(object):
         self.city_timezone = city_profile_dict[city_name][1]
         self.city_loc = city_profile_dict[city_name][2]
         self.city_open_space = city_profile_dict[city_name][3]
-        if type(city_profile_dict[city_name][4]) == str:
-            self.bot_ids = np.load(city_profile_dict[city_name][4],
-                                   allow_pickle=True)
-        else:
-            self.bot_ids = city_profile_dict[city_name][4]
+        self.bot_ids = load_bot_ids(city_profile_dict[city_name][4])
         self.start_time = start_time
         self.end_time = end_time
         self.save_loc = save_loc
@@ -47,62 +40,56 @@ class CountWeibos(object):
         self.utc_or_not = utc_or_not
         self.city_shapefile_loc = city_profile_dict[city_name][5]
 
-    def count_geocoded_weibos_hour(self):
+    def count_weibo_file(self, csv_file: str) -> np.ndarray:
+        """
+        Count the geocoded weibos (lat and lon) saved in one csv file
+        :param csv_file: the name of the csv file saved in the city data directory
+        :return: a numpy array saving the number of Weibos posted in each hour of the study time
+        """
+        accumulator = HourlyCountAccumulator(start_time=self.start_time, end_time=self.end_time)
+        print('Counting the Weibos posted in city for file: {}'.format(csv_file))
+        dataframe = pd.read_csv(os.path.join(self.city_loc, csv_file), encoding='utf-8', index_col=0, dtype='str')
+        # Map the Weibo columns onto the compact schema shared with the tweets
+        data_renamed = to_compact_dataframe(dataframe)
+        geocoded_dataframe = data_renamed.loc[~data_renamed['lat'].isnull()]
+        geocoded_without_duplicates = geocoded_dataframe.drop_duplicates(subset=['id_str'])
+        geocoded_without_bot = geocoded_without_duplicates.loc[
+            ~self.bot_ids.contains(geocoded_without_duplicates['user_id_str'])]
+        geocoded_weibo_city = self.find_weibo_in_city(dataframe=geocoded_without_bot)
+
+        # Process the dataframe with lat and lon
+        local_time = parse_created_at(geocoded_weibo_city['created_at'], target_time_zone=self.city_timezone,
+                                      convert_utc_time=False)
+        # Ignore the Weibos with malformed time strings
+        accumulator.add_times(local_time.dropna())
+        return accumulator.counts
+
+    def count_geocoded_weibos_hour(self, workers: int = 1):
 
         """
         Count the geocoded weibos (lat and lon) posted in each hour of the study time
+        :param workers: the number of worker processes. If workers > 1, the csv files are split into batches and
+        the partial counts returned by the worker processes are summed
         :return: a pandas dataframe saving the number of Weibos posted in each hour of the study time
         """
 
-        # Create a dictionary to save the number of Weibos posted in each hour
-        considered_geocoded_time_count_dict = defaultdict()
-
         # Count the Weibos...
-        csv_path = self.city_loc
-        for csv_file in list(filter(lambda f: f.endswith('.csv'), os.listdir(csv_path))):
+        csv_files = list(filter(lambda f: f.endswith('.csv'), os.listdir(self.city_loc)))
+        accumulator = HourlyCountAccumulator(start_time=self.start_time, end_time=self.end_time)
+        if workers <= 1 or len(csv_files) <= 1:
+            accumulator.add_counts(count_weibo_files(self, csv_files))
+        else:
+            file_batches = split_into_batches(csv_files, batch_num=workers * batches_per_worker)
+            pool = mp.Pool(processes=workers)
             try:
-                print('Counting the Weibos posted in city for file: {}'.format(csv_file))
-                dataframe = pd.read_csv(os.path.join(csv_path, csv_file), encoding='utf-8', index_col=0, dtype='str')
-                geocoded_dataframe = dataframe.loc[~dataframe['lat'].isnull()]
-                data_renamed = geocoded_dataframe.rename(columns={'latitude': 'lat', 'longitude': 'lon',
-                                                                  'weibo_id': 'id_str',
-                                                                  'author_id': 'user_id_str'})
-                geocoded_without_duplicates = data_renamed.drop_duplicates(subset=['id_str'])
-                geocoded_without_bot = geocoded_without_duplicates.loc[
-                    ~geocoded_without_duplicates['user_id_str'].isin(self.bot_ids)]
-                geocoded_weibo_city = self.find_weibo_in_city(dataframe=geocoded_without_bot)
-
-                # Process the dataframe with lat and lon
-                if geocoded_weibo_city.shape[0] == 0:
-                    geocoded_weibo_counter = Counter()
-                else:
-                    geocoded_weibo_city_copy = geocoded_weibo_city.copy()
-                    geocoded_weibo_city_copy['local_time'] = geocoded_weibo_city_copy.apply(
-                        lambda row: transform_string_time_to_datetime(
-                            time_string=row['created_at'], target_time_zone=self.city_timezone,
-                            convert_utc_time=False), axis=1)
-                    geocoded_weibo_city_copy['year_month_day_hour_weekday'] = geocoded_weibo_city_copy.apply(
-                        lambda row: str(row['local_time'].year) + '_' + str(
-                            row['local_time'].month) + '_' + str(
-                            row['local_time'].day) + '_' + str(
-                            row['local_time'].hour) + '_' + str(row['local_time'].weekday()), axis=1)
-                    geocoded_weibo_counter = Counter(geocoded_weibo_city_copy['year_month_day_hour_weekday'])
-                considered_geocoded_time_count_dict = merge_dict(sum_dict=considered_geocoded_time_count_dict,
-                                                                 a_dict=geocoded_weibo_counter)
-            #except KeyError:
-                #print('The csv file: {} does not have any colnames.Ignore'.format(csv_file))
-            except ValueError:
-                print('ValueError occurs for file: {}. Ignore.'.format(csv_file))
-            except pd.errors.ParserError:
-                print('Parser error occurred in file: {}. Ignore.'.format(csv_file))
-        # print('Geocoded count dict: {}'.format(considered_geocoded_time_count_dict))
-        count_dataframe = create_dataframe_from_dict(dict_data=considered_geocoded_time_count_dict)
-        default_dataframe_each_hour = self.create_count_dataframe()
-        final_count = pd.merge(left=count_dataframe, right=default_dataframe_each_hour,
-                               on=['year', 'month', 'day', 'hour', 'weekday'], how='right')
-        final_count['total_count_x'] = final_count['total_count_x'].fillna(0)
-        final_count_droped = final_count.drop(['total_count_y'], axis=1)
-        final_count_renamed = final_count_droped.rename(columns={'total_count_x': 'total_count'})
+                batch_processes = [pool.apply_async(count_weibo_files, args=(self, file_batch))
+                                   for file_batch in file_batches]
+                for batch_process in batch_processes:
+                    accumulator.add_counts(batch_process.get())
+            finally:
+                pool.close()
+                pool.join()
+        final_count_renamed = accumulator.to_dataframe(count_colname='total_count')
         # Save the combined file to the local directory
         print('Done!')
         if os.path.exists(os.path.join(self.save_loc, self.city_name)):
@@ -119,26 +106,8 @@ class CountWeibos(object):
         Create the count dataframe based on the starting time and the ending time
         :return: a pandas dataframe saving the default number of Weibos posted in each hour
         """
-        cur_time = self.start_time
-        result_dataframe = pd.DataFrame()
-        year_list, month_list, weekday_list = [], [], []
-        day_list, hour_list = [], []
-        while self.end_time != cur_time:
-            check_time_year, check_time_month = cur_time.year, cur_time.month
-            check_time_day, check_time_hour = cur_time.day, cur_time.hour
-            check_time_weekday = cur_time.weekday()
-            year_list.append(check_time_year)
-            month_list.append(check_time_month)
-            day_list.append(check_time_day)
-            hour_list.append(check_time_hour)
-            weekday_list.append(check_time_weekday)
-            cur_time = cur_time + timedelta(hours=1)
-        result_dataframe['year'] = year_list
-        result_dataframe['month'] = month_list
-        result_dataframe['day'] = day_list
-        result_dataframe['hour'] = hour_list
-        result_dataframe['weekday'] = weekday_list
-        result_dataframe['total_count'] = [0] * len(year_list)
+        result_dataframe = create_hour_calendar(self.start_time, self.end_time)
+        result_dataframe['total_count'] = 0
         return result_dataframe
 
     def get_weibo_from_id_set(self, weibo_id_set, save_path, save_filename):
@@ -152,13 +121,15 @@ class CountWeibos(object):
         """
         select_data_list = []
         csv_file_path = os.path.join(self.city_loc, 'weibos')
-        for file in list(filter(lambda f: f.endswith('.csv'), os.listdir(csv_file_path))):
+        # Only the files saving the weibo ids are read
+        id_index = update_csv_id_index(csv_file_path, message_id_colname='weibo_id', user_id_colname='author_id')
+        for file, _, _ in id_index.find_sources(weibo_id_set, id_type='message'):
             try:
                 dataframe = pd.read_csv(os.path.join(csv_file_path, file), encoding='utf-8', index_col=0, dtype='str')
                 data_renamed = dataframe.rename(columns={'latitude': 'lat', 'longitude': 'lon', 'weibo_id': 'id_str'})
                 geocoded_weibo_city = data_renamed.drop_duplicates(subset=['id_str'])
                 geocoded_weibo_city['id_str'] = geocoded_weibo_city['id_str'].astype(np.int64)
-                dataframe_select = dataframe.loc[dataframe['id_str'].isin(weibo_id_set)]
+                dataframe_select = geocoded_weibo_city.loc[geocoded_weibo_city['id_str'].isin(weibo_id_set)]
                 select_data_list.append(dataframe_select)
             except ValueError:
                 print('ValueError occurred when reading file: {}. Ignore'.format(file))
@@ -166,6 +137,9 @@ class CountWeibos(object):
             except pd.errors.ParserError:
                 print('Parser error occurred in file: {}. Ignore.'.format(file))
                 continue
+        if len(select_data_list) == 0:
+            print('None of the weibo ids is found')
+            select_data_list.append(pd.DataFrame())
         result_dataframe = pd.concat(select_data_list, axis=0)
         result_dataframe_reindex = result_dataframe.reset_index(drop=True)
         result_dataframe_reindex.to_csv(os.path.join(save_path, save_filename),
@@ -180,26 +154,12 @@ class CountWeibos(object):
         """
         assert 'lat' in dataframe, "The dataframe should contain latitude info"
         assert 'lon' in dataframe, "The dataframe should contain longitude info"
-        if (dataframe['lat'].dtype.name != 'float64') or (dataframe['lon'].dtype.name != 'float64'):
-            dataframe_copy = dataframe.copy()
-            dataframe_copy['lat'] = dataframe_copy['lat'].astype(str)
-            dataframe_copy['lon'] = dataframe_copy['lon'].astype(str)
-            dataframe_copy_select = dataframe_copy[dataframe_copy['lat'].str.startswith(
-                lat_lon_start_tuple)]
-            dataframe_final = dataframe_copy_select[dataframe_copy_select['lon'].str.startswith(
-                lat_lon_start_tuple)].copy()
-            dataframe_final['lat'] = dataframe_final['lat'].astype(np.float64)
-            dataframe_final['lon'] = dataframe_final['lon'].astype(np.float64)
-        else:
-            dataframe_final = dataframe.copy()
-        geocoded_tweet_gdf = gpd.GeoDataFrame(dataframe_final,
-                                              geometry=gpd.points_from_xy(dataframe_final.lon,
-                                                                          dataframe_final.lat))
-        geocoded_tweet_gdf = geocoded_tweet_gdf.set_crs(epsg=4326, inplace=True)
-        city_shape = gpd.read_file(self.city_shapefile_loc)
-        city_shape_4326 = city_shape.to_crs(epsg=4326)
-        joined_data_final = CountWeibos.spatial_join(tweet_gdf=geocoded_tweet_gdf, shape_area=city_shape_4326)
-        return joined_data_final.reset_index(drop=True)
+        dataframe_final = sanitize_coordinates(dataframe)
+        city_geometry = load_geometry(self.city_shapefile_loc,
+                                      mask_resolution=city_mask_resolution.get(self.city_name))
+        in_city = city_geometry.contains_points(dataframe_final['lon'], dataframe_final['lat'])
+        dataframe_in_city = dataframe_final.loc[in_city].drop_duplicates(subset=['id_str'])
+        return dataframe_in_city.reset_index(drop=True)
 
 
     def find_weibo_in_bounding_box(self, dataframe):
@@ -213,20 +173,7 @@ class CountWeibos(object):
         """
         lat_min, lat_max = self.bounding_box_vals[1], self.bounding_box_vals[3]
         lon_min, lon_max = self.bounding_box_vals[0], self.bounding_box_vals[2]
-        # Cope with some bad rows where the geoinformation is stored as a strange string
-        if (dataframe['lat'].dtype.name != 'float64') or (dataframe['lon'].dtype.name != 'float64'):
-            print('Something wrong with the datatype of latitude and longitude...')
-            dataframe_copy = dataframe.copy()
-            dataframe_copy['lat'] = dataframe_copy['lat'].astype(str)
-            dataframe_copy['lon'] = dataframe_copy['lon'].astype(str)
-            dataframe_copy_select = dataframe_copy[dataframe_copy['lat'].str.startswith(
-                lat_lon_start_tuple)]
-            dataframe_final = dataframe_copy_select[dataframe_copy_select['lon'].str.startswith(
-                lat_lon_start_tuple)].copy()
-            dataframe_final['lat'] = dataframe_final['lat'].astype(np.float64)
-            dataframe_final['lon'] = dataframe_final['lon'].astype(np.float64)
-        else:
-            dataframe_final = dataframe.copy()
+        dataframe_final = sanitize_coordinates(dataframe)
         decision1 = (dataframe_final['lat'] >= lat_min) & (dataframe_final['lat'] <= lat_max)
         decision2 = (dataframe_final['lon'] >= lon_min) & (dataframe_final['lon'] <= lon_max)
         data_in_city = dataframe_final[decision1 & decision2]
@@ -234,18 +181,24 @@ class CountWeibos(object):
         return data_in_city.reset_index(drop=True)
 
 
-    @staticmethod
-    def spatial_join(tweet_gdf, shape_area):
-        """
-        Find the tweets posted in one city's open space
-        :param tweet_gdf: the geopandas dataframe saving the tweets
-        :param shape_area: the shapefile of a studied area, such as city, open space, etc
-        :return: tweets posted in open space
-        """
-        assert tweet_gdf.crs == shape_area.crs, 'The coordinate systems do not match!'
-        joined_data = gpd.sjoin(left_df=tweet_gdf, right_df=shape_area, op='within')
-        joined_data_final = joined_data.drop_duplicates(subset=['id_str'])
-        return joined_data_final
+def count_weibo_files(count_weibo_obj: CountWeibos, csv_files: list) -> np.ndarray:
+    """
+    Count the geocoded weibos saved in a batch of csv files. Used by the worker processes
+    :param count_weibo_obj: the CountWeibos object of the studied city
+    :param csv_files: a list of csv files saved in the city data directory
+    :return: a numpy array saving the number of Weibos posted in each hour of the study time
+    """
+    accumulator = HourlyCountAccumulator(start_time=count_weibo_obj.start_time, end_time=count_weibo_obj.end_time)
+    for csv_file in csv_files:
+        try:
+            accumulator.add_counts(count_weibo_obj.count_weibo_file(csv_file))
+        #except KeyError:
+            #print('The csv file: {} does not have any colnames.Ignore'.format(csv_file))
+        except ValueError:
+            print('ValueError occurs for file: {}. Ignore.'.format(csv_file))
+        except pd.errors.ParserError:
+            print('Parser error occurred in file: {}. Ignore.'.format(csv_file))
+    return accumulator.counts
 
 
 class CountWeibosOpenSpace(object):
@@ -274,9 +227,7 @@ class CountWeibosOpenSpace(object):
         self.end_time = end_time
         self.save_loc = save_loc
         self.save_filename = save_filename
-        bot_ids = np.load(os.path.join(os.getcwd(), "weibo_bots_final.npy"),
-                          allow_pickle=True)
-        self.bot_ids = bot_ids
+        self.bot_ids = load_bot_ids(os.path.join(os.getcwd(), "weibo_bots_final.npy"))
 
     def count_weibos_hourly(self, day_title: str, hour_title: str,
                             weekday_title: str, day_filename: str,
@@ -286,48 +237,18 @@ class CountWeibosOpenSpace(object):
         Count the number of Weibos posted in each hour of a open space in the studied city
         :return: None. The result is saved in the specified local directory
         """
-        result_dataframe_list = []
+        accumulator = HourlyCountAccumulator(start_time=self.start_time, end_time=self.end_time)
         for file in os.listdir(self.data_loc):
-            cur_time = self.start_time
             if file.endswith('.csv'):
                 print('Counting the Weibos posted in open space for file: {}'.format(file))
                 dataframe = pd.read_csv(os.path.join(self.data_loc, file), encoding='utf-8', index_col=0, dtype='str')
-                # Get the local time and year, month, day, hour attributes
-                dataframe['local_time'] = dataframe.apply(
-                    lambda row: transform_string_time_to_datetime(row['created_at'], target_time_zone=self.timezone,
-                                                                  convert_utc_time=False), axis=1)
-                dataframe['year'] = dataframe.apply(lambda row: row['local_time'].year, axis=1)
-                dataframe['month'] = dataframe.apply(lambda row: row['local_time'].month, axis=1)
-                dataframe['day'] = dataframe.apply(lambda row: row['local_time'].day, axis=1)
-                dataframe['hour'] = dataframe.apply(lambda row: row['local_time'].hour, axis=1)
-                print('Done!')
-
+                # Get the local time of each Weibo
+                local_time = parse_created_at(dataframe['created_at'], target_time_zone=self.timezone,
+                                              convert_utc_time=False)
                 # Count the number of Weibos in each hour
                 print('Counting the number of Weibos posted in each hour...')
-                result_count_list = []
-                result_time_list = []
-
-                while self.end_time != cur_time:
-                    check_time_year, check_time_month = cur_time.year, cur_time.month
-                    check_time_day, check_time_hour = cur_time.day, cur_time.hour
-                    dataframe_year_month = dataframe.loc[
-                        (dataframe['year'] == check_time_year) & (dataframe['month'] == check_time_month)]
-                    dataframe_day_hour = dataframe_year_month.loc[
-                        (dataframe_year_month['day'] == check_time_day) & (
-                                dataframe_year_month['hour'] == check_time_hour)]
-                    result_time_list.append(cur_time)
-                    result_count_list.append(dataframe_day_hour.shape[0])
-                    cur_time = cur_time + timedelta(hours=1)
-
-                result_dataframe = pd.DataFrame(columns=['year', 'month', 'day', 'hour', 'open_space_count'])
-                result_dataframe['year'] = [timestamp.year for timestamp in result_time_list]
-                result_dataframe['month'] = [timestamp.month for timestamp in result_time_list]
-                result_dataframe['day'] = [timestamp.day for timestamp in result_time_list]
-                result_dataframe['hour'] = [timestamp.hour for timestamp in result_time_list]
-                result_dataframe['weekday'] = [timestamp.weekday() for timestamp in result_time_list]
-                result_dataframe['open_space_count'] = result_count_list
-                result_dataframe_list.append(result_dataframe)
-        combined_result_dataframe = sum_dataframe_list_count(result_dataframe_list)
+                accumulator.add_times(local_time.dropna())
+        combined_result_dataframe = accumulator.to_dataframe(count_colname='open_space_count')
 
         # Create the hour, day, and weekday plots
         print('Plotting the number of Weibos on each day...')
@@ -350,13 +271,15 @@ class CountWeibosOpenSpace(object):
         return combined_result_dataframe
 
 
-def main_count_weibos(count_in_utc: bool, count_cities_mainland: set):
+def main_count_weibos(count_in_utc: bool, count_cities_mainland: set, workers: int = 1):
     """
     Main function to count the Weibos posted in the Chinese mainland city and
     open space
     :param: count_in_utc: whether count in utc or not
     :param: count_cities_mainland: a Python set saving the considered Chinese
     cities
+    :param: workers: the number of worker processes used to count the Weibos
+    posted in each city
     :return: None. The tweet counting in each hour is saved to local directory.
     The created figures are saved to the local directory.
     """
@@ -381,7 +304,7 @@ def main_count_weibos(count_in_utc: bool, count_cities_mainland: set):
                 save_loc=data_paths.count_daily_hour_path,
                 save_filename=city + '_open_space_hour.csv',
                 utc_or_not=True)
-            geocoded_count_data = count_weibo_obj.count_geocoded_weibos_hour()
+            geocoded_count_data = count_weibo_obj.count_geocoded_weibos_hour(workers=workers)
             geocoded_open_space_data = count_weibo_open_space.count_weibos_hourly(
                 day_title='Number of Weibos Posted in {} Open Space on Each Day'.format(city),
                 hour_title='Number of Weibos Posted in {} Open Space in Each Hour'.format(city),
@@ -389,8 +312,8 @@ def main_count_weibos(count_in_utc: bool, count_cities_mainland: set):
                 day_filename='{}_open_space_day.png'.format(city),
                 hour_filename='{}_open_space_hour.png'.format(city),
                 weekday_filename='{}_open_space_weekday.png'.format(city))
-            final_data = pd.merge(left=geocoded_count_data, right=geocoded_open_space_data,
-                                  on=['year', 'month', 'day', 'hour', 'weekday'])
+            # Both dataframes are indexed by the same hour calendar
+            final_data = geocoded_count_data.join(geocoded_open_space_data[['open_space_count']])
             final_data['percent'] = (final_data['open_space_count']/final_data['total_count']).replace(
                 to_replace=[np.inf, np.nan], value=-9999)  # For the situations when no tweet is posted in the city
             if os.path.exists(os.path.join(data_paths.count_daily_hour_path, city)):
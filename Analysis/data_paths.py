@@ -6,6 +6,8 @@ count_tweet_month_path = os.path.join(project_code_path, 'count_tweets_month')
 count_tweet_quarter_path = os.path.join(project_code_path, 'count_tweets_quarter')
 count_daily_hour_path = os.path.join(project_code_path, 'count_tweets_daily_hour')
 figures_path = os.path.join(project_code_path, 'figures')
+# the manifests recording the processed files and their partial aggregates
+manifest_path = os.path.join(project_code_path, 'manifests')
 
 # raster save path
 raster_save_path = r'XXX'
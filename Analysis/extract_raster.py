@@ -2,14 +2,14 @@ import os
 import rasterio
 import geopandas as gpd
 import pandas as pd
-import numpy as np
 from pyproj import Transformer
 import pytz
 
 from data_paths import ndvi_path, raster_save_path
 from cities_bounds import cities_dict_foreign, open_space_saving_path,cities_dict_china, cities_dict_netherland
-from utils import column_dtype_dict, read_csv_columns, transform_string_time_to_datetime, get_time_attributes
+from utils import column_dtype_dict, read_csv_columns, parse_created_at, get_time_attributes
 from spatial_analysis import FindTweetsOpenSpace
+from bot_store import load_bot_ids
 
 
 def raster_overview(path: str, file_name: str):
@@ -28,7 +28,7 @@ def raster_overview(path: str, file_name: str):
 
 
 def compute_raster_for_points(point_filename: str, raster_filename: str,
-                              bot_ids: set,
+                              bot_ids,
                               read_csv_file: bool = True,
                               process_tweet: bool = True):
     """
@@ -37,7 +37,7 @@ def compute_raster_for_points(point_filename: str, raster_filename: str,
     https://gis.stackexchange.com/questions/317391/python-extract-raster-values-at-point-locations/324830
     :param point_filename: the full path to the point filename
     :param raster_filename: the full path of the NDVI raster .tif file
-    :param bot_ids: a python set containing the bot ids
+    :param bot_ids: the bot ids: a BotIdStore, a python set or the .npy file saving them
     :param read_csv_file: boolean. read the csv file or not
     :return: the point shapefile with raster value
     """
@@ -66,7 +66,7 @@ def compute_raster_for_points(point_filename: str, raster_filename: str,
 
     else:
         pts = gpd.read_file(point_filename)
-    pts_without_bot = pts.loc[~pts['user_id_str'].isin(bot_ids)].copy()
+    pts_without_bot = pts.loc[~load_bot_ids(bot_ids).contains(pts['user_id_str'])].copy()
     pts_processed = FindTweetsOpenSpace.preprocess_geoinfo(pts_without_bot)
 
     pts_processed.index = range(len(pts_processed))
@@ -105,21 +105,17 @@ def main_foreign_raster(save_path, considered_cities=None,
                     output_file = compute_raster_for_points(
                         point_filename=os.path.join(city_open_space_tweet_path, csv_file),
                         raster_filename=os.path.join(ndvi_path, 'netherlands_NDVI.tif'),
-                        bot_ids=set(np.load(city_profile[city][4],
-                                        allow_pickle=True).tolist()),
+                        bot_ids=load_bot_ids(city_profile[city][4]),
                         read_csv_file=True, process_tweet=True)
                 else:
                     output_file = compute_raster_for_points(
                         point_filename=os.path.join(city_open_space_tweet_path, csv_file),
                         raster_filename=os.path.join(ndvi_path, '{}_NDVI.tif'.format(city)),
-                        bot_ids=set(np.load(city_profile[city][4],
-                                        allow_pickle=True).tolist()),
+                        bot_ids=load_bot_ids(city_profile[city][4]),
                         read_csv_file=True, process_tweet=True)
 
-                output_file['utc_time'] = output_file.apply(
-                    lambda row: transform_string_time_to_datetime(row['created_at'],
-                                                                  convert_utc_time=True,
-                                                                  target_time_zone=pytz.utc), axis=1)
+                output_file['utc_time'] = parse_created_at(output_file['created_at'], convert_utc_time=True,
+                                                           target_time_zone=pytz.utc)
                 output_file_with_time = get_time_attributes(output_file, datetime_obj_colname='utc_time')
 
                 if os.path.exists(os.path.join(save_path, city)):
@@ -157,7 +153,7 @@ def main_china_raster(save_path: str, considered_cities=None,
             csv_files = [file for file in os.listdir(
                 city_open_space_weibo_path) if (
                     file.endswith('.csv')) and (city in file)]
-            weibo_bot_ids = np.load("weibo_bots_final.npy", allow_pickle=True)
+            weibo_bot_ids = load_bot_ids("weibo_bots_final.npy")
             print('Considered csv files: {}'.format(csv_files))
             # Get the raster value for each geocoded tweet
             for csv_file in csv_files:
@@ -169,10 +165,9 @@ def main_china_raster(save_path: str, considered_cities=None,
                     bot_ids=weibo_bot_ids,
                     read_csv_file=True, process_tweet=False)
 
-                output_file['utc_time'] = output_file.apply(
-                    lambda row: transform_string_time_to_datetime(
-                        row['created_at'], convert_utc_time=True,
-                        target_time_zone=pytz.utc), axis=1)
+                output_file['utc_time'] = parse_created_at(
+                    output_file['created_at'], convert_utc_time=True,
+                    target_time_zone=pytz.utc)
                 output_file_with_time = get_time_attributes(
                     output_file, datetime_obj_colname='utc_time')
 
@@ -2,7 +2,6 @@
 import pandas as pd
 import os
 import numpy as np
-from collections import Counter
 from datetime import datetime
 import pytz
 
@@ -11,76 +10,32 @@ from matplotlib import pyplot as plt
 
 # Load the count tweet class and city profile
 from count_tweets import CountTweets
+from scan_engine import UserStatsAggregator
 from cities_bounds import cities_dict_foreign
 
 
-def get_all_geocoded_tweets_in_city(city_name: str, saving_path: str, save_filename: str):
-    """
-    Get all the geocoded tweets posted in a city
-    :param city_name: the name of a city
-    :param saving_path: the saving path
-    :param save_filename: the saved filename
-    :return: None. The created dataframe is saved to a local directory
-    """
-    assert city_name in cities_dict_foreign, 'The city name should be in the city profile dictionary'
-    city_tweet_obj = CountTweets(city_name=city_name, city_profile_dict=cities_dict_foreign,
-                                 start_time=datetime(2016, 5, 1, tzinfo=pytz.utc),
-                                 end_time=datetime(2020, 12, 31, tzinfo=pytz.utc),
-                                 utc_or_not=True)
-    dataframe_list = []
-    for considered_year in city_tweet_obj.considered_year_list:
-        print('Coping with the year: {}'.format(considered_year))
-        csv_path = os.path.join(city_tweet_obj.city_loc, considered_year)
-        try:
-            for csv_file_name in os.listdir(csv_path):
-                print('Coping with the file: {}'.format(csv_file_name))
-                try:
-                    dataframe = pd.read_csv(open(os.path.join(csv_path, csv_file_name),
-                                                 encoding='utf-8', errors='ignore'),
-                                            usecols=['user_id_str', 'id_str', 'lat', 'lon'],
-                                            dtype={'user_id_str': str, 'id_str': str})
-                    geocoded_dataframe = dataframe.loc[~dataframe['lat'].isnull()]
-                    geocoded_without_duplicates = geocoded_dataframe.drop_duplicates(subset=['id_str'])
-                    geocoded_tweet_city = city_tweet_obj.find_tweet_in_city(geocoded_without_duplicates)
-                    dataframe_list.append(geocoded_tweet_city)
-                except KeyError:
-                    print('The csv file: {} does not have any column names. Ignore'.format(csv_file_name))
-                except ValueError:
-                    print('ValueError occurs for file: {}. Ignore.'.format(csv_file_name))
-                except pd.errors.ParserError:
-                    print('Parser error occurred in file: {}. Ignore.'.format(csv_file_name))
-            print('The year: {} has been processed'.format(considered_year))
-            concat_geocoded_data = pd.concat(dataframe_list, axis=0)
-            concat_geocoded_data.to_csv(os.path.join(saving_path, considered_year + save_filename), encoding='utf-8')
-            # Release memory
-            del concat_geocoded_data
-            dataframe_list = []
-        except FileNotFoundError:
-            print('There is no {} folder in local'.format(str(considered_year)))
-
-
 def count_user_tweet(dataframe: pd.DataFrame):
     """
     Count the users and the number of tweets they post.
-    Bot accounts are likely to post many tweets in a long time
+    Bot accounts are likely to post many tweets in a long time. The tweet count, the distinct tweet count and the
+    number of tweets posted at the most common location of all the users are computed with one pass of groupby
+    over the factorized user ids
     :param dataframe: a tweet dataframe
     :return: a pandas dataframe saving the number of tweets posted by each user
     """
-    user_set = set(dataframe['user_id_str'])
-    user_list, tweet_count_list, tweet_pos_percent_list = [], [], []
-    for user in user_set:
-        data_select = dataframe.loc[dataframe['user_id_str'] == user].copy()
-        if data_select.shape[0] > 0:
-            user_list.append(user)
-            data_select['pos'] = data_select.apply(lambda row: (row.lat, row.lon), axis=1)
-            _, most_common_count = Counter(data_select['pos']).most_common()[0]
-            tweet_count_list.append(data_select.shape[0])
-            tweet_pos_percent_list.append(most_common_count / len(set(data_select['id_str'])))
+    user_data = dataframe.loc[dataframe['user_id_str'].notnull()]
+    user_codes, user_ids = pd.factorize(user_data['user_id_str'])
+    tweet_count = np.bincount(user_codes, minlength=len(user_ids))
+    distinct_tweet_count = user_data['id_str'].groupby(user_codes).nunique(dropna=False).reindex(
+        range(len(user_ids))).values
+    location_count = user_data.groupby([user_codes, user_data['lat'], user_data['lon']], sort=False,
+                                       dropna=False).size()
+    most_common_count = location_count.groupby(level=0).max().reindex(range(len(user_ids))).values
     count_data = pd.DataFrame()
-    count_data['user_id'] = user_list
-    count_data['count'] = tweet_count_list
-    count_data['loc_percent'] = tweet_pos_percent_list
-    count_data_final = count_data.sort_values(by='count', ascending=False).reset_index(drop=True)
+    count_data['user_id'] = np.asarray(user_ids, dtype=object)
+    count_data['count'] = tweet_count
+    count_data['loc_percent'] = most_common_count / distinct_tweet_count
+    count_data_final = count_data.sort_values(by='count', ascending=False, kind='mergesort').reset_index(drop=True)
     return count_data_final
 
 
@@ -108,27 +63,35 @@ def get_bot_users(count_dataframe: pd.DataFrame, save_path: str, save_filename:
     np.save(os.path.join(save_path, save_filename), bot_ids)
 
 
-def merge_bot_ids(city_name: str, bot_id_path: str) -> None:
+def find_bot_users_in_city(city_name: str, save_path: str, years: list = None, workers: int = 1,
+                           memory_limit_mb: float = None) -> pd.DataFrame:
     """
-    Merge the detected bot ids locally
+    Find the bot accounts of a city with the tweets posted in all the considered years. The tweet counts of the
+    users and their footprints are accumulated while the hourly files are read, so the geocoded tweets are not
+    saved to the intermediate csv files. The counts of each file are saved in the manifest, so a rerun only reads
+    the new or modified files
     :param city_name: the name of a city
-    :param bot_id_path: the path saving the bot ids
-    :return: None. The bot ids are saved to local directory
+    :param save_path: the path saving the bot ids
+    :param years: the considered years, such as ['2018', '2019']. None means all the years of CountTweets
+    :param workers: the number of worker processes used to read the hourly files
+    :param memory_limit_mb: the memory ceiling (MB) of one chunk. None means reading each hourly file at once
+    :return: a pandas dataframe saving the number of tweets and the most common location percent of each user
     """
-    year_list = ['2016', '2017', '2018', '2020']
-    bot_id_files = [file for file in os.listdir(bot_id_path) if (city_name in file) and
-                    (file.endswith('.npy'))]
-    bot_id_files_filtered = []
-    for file in bot_id_files:
-        if file[:4] in year_list:
-            bot_id_files_filtered.append(file)
-
-    bot_id_list = []
-    for file in bot_id_files_filtered:
-        bot_ids = np.load(os.path.join(bot_id_path, file), allow_pickle=True).item()
-        bot_id_list.extend(bot_ids)
-    bot_id_set = set(bot_id_list)
-    np.save(os.path.join(bot_id_path, '{}_bot_ids.npy'.format(city_name)), bot_id_set)
+    assert city_name in cities_dict_foreign, 'The city name should be in the city profile dictionary'
+    # The bot accounts are counted, so the city is scanned without the bot ids
+    city_profile = list(cities_dict_foreign[city_name])
+    city_profile[4] = set()
+    city_tweet_obj = CountTweets(city_name=city_name, city_profile_dict={city_name: city_profile},
+                                 start_time=datetime(2016, 5, 1, tzinfo=pytz.utc),
+                                 end_time=datetime(2020, 12, 31, tzinfo=pytz.utc),
+                                 utc_or_not=True, memory_limit_mb=memory_limit_mb)
+    if years is not None:
+        city_tweet_obj.considered_year_list = list(years)
+    user_stats_aggregator, = city_tweet_obj.scan([UserStatsAggregator()], workers=workers)
+    user_counts = user_stats_aggregator.to_dataframe()
+    print('User tweet counting done! {} users are found'.format(user_counts.shape[0]))
+    get_bot_users(count_dataframe=user_counts, save_path=save_path, save_filename='{}_bot_ids.npy'.format(city_name))
+    return user_counts
 
 
 def plot_tweet_count_dist(count_dataframe: pd.DataFrame, percentile: float):
@@ -155,35 +118,12 @@ def plot_tweet_count_dist(count_dataframe: pd.DataFrame, percentile: float):
 
 
 if __name__ == '__main__':
-	# For example:
+    # For example:
     considered_cities = {'kuala_lumper', 'greater_kuala_lumper', 'hong_kong'}
-    # Get all the geocoded tweets posted in the cities
-    for city in cities_dict_foreign:
-        print('Coping with the city: {}'.format(city))
-        if city in considered_cities:
-            get_all_geocoded_tweets_in_city(city_name=city,
-                                            saving_path=cities_dict_foreign[city][2],
-                                            save_filename='{}_geocoded_tweets.csv'.format(city))
-        else:
-            print('The city {} has been processed.'.format(city))
-
+    # Find the bot accounts with the tweets posted in all the years
     for city in cities_dict_foreign:
         print('Coping with the city: {}'.format(city))
         if city in considered_cities:
-            geocoded_data_path = os.path.join(cities_dict_foreign[city][2])
-            geocoded_files = [file for file in os.listdir(geocoded_data_path) if (
-                file.endswith('.csv')) and (city in file)]
-            for csv_file in geocoded_files:
-                year = csv_file[:4]
-                print('Coping with the year: {}'.format(year))
-                print('Coping with the file: {}'.format(csv_file))
-                geocoded_tweets = pd.read_csv(os.path.join(geocoded_data_path, csv_file),
-                                              usecols=['user_id_str', 'id_str', 'lat', 'lon'],
-                                              dtype={'user_id_str': str, 'id_str': str})
-                user_counts = count_user_tweet(geocoded_tweets)
-                print('User tweet counting done!')
-                get_bot_users(count_dataframe=user_counts, save_path=geocoded_data_path,
-                              save_filename=year+'_'+city+'_bot_ids.npy')
-            merge_bot_ids(city_name=city, bot_id_path=geocoded_data_path)
+            find_bot_users_in_city(city_name=city, save_path=cities_dict_foreign[city][2])
         else:
             print('This time we do not consider {}'.format(city))
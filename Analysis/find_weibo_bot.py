@@ -1,11 +1,23 @@
 import os
 import time
+import shutil
+import tempfile
 from collections import Counter
 import multiprocessing as mp
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from cities_bounds import weibo_path
+from utils import split_into_batches
+from bot_store import convert_bot_id_file
+from id_index import update_csv_id_index
+
+# The author store of the candidate bot accounts: one parquet file for each partition and the offset index
+author_partition_filename = 'weibos_{}.parquet'
+author_index_filename = 'author_index.parquet'
+author_row_group_size = 100000
 
 
 def compute_threshold(count_dataframe: pd.DataFrame):
@@ -35,7 +47,8 @@ def count_user_weibo(dataframe: pd.DataFrame):
 
 def get_weibos_from_users(user_arr, data_path=weibo_path):
     """
-    Get weibos posted by a set of users.
+    Get weibos posted by a set of users. Only the files saving the Weibos of the users are read, based on the
+    id index of data_path
     :param user_arr: the array containing the user ids
     :param data_path: the data path saving the collected Weibos
     :return: a pandas dataframe saving the tweets posted by interested users
@@ -43,57 +56,195 @@ def get_weibos_from_users(user_arr, data_path=weibo_path):
 
     dataframe_list = []
     print("Coping with the id arr: {}".format(user_arr))
-    for index, file in enumerate(os.listdir(data_path)):
+    id_index = update_csv_id_index(data_path, message_id_colname='weibo_id', user_id_colname='author_id')
+    for index, (file, _, _) in enumerate(id_index.find_sources(user_arr, id_type='user')):
         print('Coping with the {}th file'.format(index+1))
         dataframe = pd.read_csv(os.path.join(data_path, file),
                                 encoding='utf-8', index_col=0)
         dataframe_select = dataframe.loc[dataframe['author_id'].isin(user_arr)]
         dataframe_list.append(dataframe_select)
+    if len(dataframe_list) == 0:
+        return pd.DataFrame()
     concat_data = pd.concat(dataframe_list, axis=0).reset_index(drop=True)
     return concat_data
 
 
-def parallelize(cpu_num: int, id_arr: np.array, save_path: str):
+def route_weibos_to_partitions(weibo_files: list, candidate_partitions: pd.Series, partition_path: str,
+                               batch_index: int, data_path=weibo_path) -> None:
+    """
+    Read a batch of Weibo files once and route the Weibos posted by the candidate users to the partition files.
+    Each batch writes its own partition files, named partition_{partition}_{batch_index}.csv
+    :param weibo_files: the names of the Weibo files in this batch
+    :param candidate_partitions: a pandas series indexed by the candidate author ids, saving their partitions
+    :param partition_path: the path saving the partition files
+    :param batch_index: the index of this batch
+    :param data_path: the data path saving the collected Weibos
+    :return: None. The partition files are saved to partition_path
+    """
+    written_partitions = set()
+    for file in weibo_files:
+        print('Coping with the file: {}'.format(file))
+        dataframe = pd.read_csv(os.path.join(data_path, file), encoding='utf-8', index_col=0)
+        candidate_positions = candidate_partitions.index.get_indexer(dataframe['author_id'])
+        dataframe_select = dataframe.loc[candidate_positions >= 0]
+        partitions = candidate_partitions.values[candidate_positions[candidate_positions >= 0]]
+        for partition, partition_data in dataframe_select.groupby(partitions, sort=False):
+            partition_data.to_csv(os.path.join(partition_path, 'partition_{}_{}.csv'.format(partition, batch_index)),
+                                  mode='a' if partition in written_partitions else 'w',
+                                  header=partition not in written_partitions, encoding='utf-8')
+            written_partitions.add(partition)
+
+
+def save_partition_weibos(partition_files: list, save_path: str, partition: int) -> pd.DataFrame:
+    """
+    Save the Weibos of one partition to a parquet file of the author store. The Weibos are sorted by the author
+    ids, so the Weibos of each author are saved contiguously
+    :param partition_files: the partition files of this partition, in the order of the batches
+    :param save_path: the path of the author store
+    :param partition: the index of this partition
+    :return: a pandas dataframe saving the offset index of the authors in this partition: the author_id, the
+    parquet file and the start and end rows of the Weibos of each author
+    """
+    partition_data = pd.concat([pd.read_csv(file, encoding='utf-8', index_col=0) for file in partition_files],
+                               axis=0)
+    # The stable sort keeps the Weibos of each author in the order of the files
+    partition_data = partition_data.sort_values(by='author_id', kind='mergesort').reset_index(drop=True)
+    save_filename = author_partition_filename.format(partition)
+    pq.write_table(pa.Table.from_pandas(partition_data, preserve_index=False), os.path.join(save_path, save_filename),
+                   row_group_size=author_row_group_size)
+    author_ids, start_rows = np.unique(partition_data['author_id'].values, return_index=True)
+    end_rows = np.append(start_rows[1:], partition_data.shape[0])
+    return pd.DataFrame({'author_id': author_ids, 'file': save_filename, 'start': start_rows, 'end': end_rows})
+
+
+def load_author_index(store_path: str) -> pd.DataFrame:
+    """
+    Load the offset index of the author store
+    :param store_path: the path of the author store created by parallelize
+    :return: a pandas dataframe saving the author_id, the parquet file and the start and end rows of each author
+    """
+    return pd.read_parquet(os.path.join(store_path, author_index_filename))
+
+
+def read_author_weibos(store_path: str, author_id, author_index: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Read the Weibos posted by one author from the author store. Only the row groups saving the Weibos of the
+    author are read
+    :param store_path: the path of the author store created by parallelize
+    :param author_id: the id of the author
+    :param author_index: the offset index returned by load_author_index. None means loading it
+    :return: a pandas dataframe saving the Weibos posted by the author. Empty if the author is not in the store
+    """
+    if author_index is None:
+        author_index = load_author_index(store_path)
+    author_rows = author_index.loc[author_index['author_id'] == author_id]
+    if author_rows.shape[0] == 0:
+        return pd.DataFrame()
+    file, start_row, end_row = author_rows.iloc[0][['file', 'start', 'end']]
+    parquet_file = pq.ParquetFile(os.path.join(store_path, file))
+    row_group_ends = np.cumsum([parquet_file.metadata.row_group(index).num_rows
+                                for index in range(parquet_file.num_row_groups)])
+    first_group = int(np.searchsorted(row_group_ends, start_row, side='right'))
+    last_group = int(np.searchsorted(row_group_ends, end_row - 1, side='right'))
+    group_start_row = row_group_ends[first_group - 1] if first_group > 0 else 0
+    author_table = parquet_file.read_row_groups(list(range(first_group, last_group + 1)))
+    return author_table.slice(start_row - group_start_row, end_row - start_row).to_pandas()
+
+
+def parallelize(cpu_num: int, id_arr: np.array, save_path: str, partition_num: int = None,
+                data_path=weibo_path):
     """
     Parallelize the processes of finding the tweets. Run the codes as:
         parallelize(cpu_num=20, id_arr=weibo_ids, save_path=saving_path)
+    Each Weibo file is read once: the Weibos posted by the candidate authors are routed to the partition
+    files, and each partition is then saved by one worker process to a parquet file of the author store. The
+    offset index of the authors is saved to author_index.parquet
     :param cpu_num: the number of cpus used to run
     :param id_arr: the numpy array saving author ids
-    :param save_path: the path used to save the generated data
-    :return: None. The generated dataframe is saved to a directory
+    :param save_path: the path of the author store
+    :param partition_num: the number of partitions of the authors. None means using cpu_num partitions
+    :param data_path: the data path saving the collected Weibos
+    :return: None. The author store is saved to save_path
     """
+    if partition_num is None:
+        partition_num = cpu_num
+    candidate_ids = pd.unique(np.asarray(id_arr))
+    # The authors are assigned to the partitions in turn, which balances the number of authors in each partition
+    candidate_partitions = pd.Series(np.arange(len(candidate_ids)) % partition_num, index=candidate_ids)
+    weibo_file_batches = split_into_batches(sorted(os.listdir(data_path)), batch_num=cpu_num)
+    partition_path = tempfile.mkdtemp(prefix='weibo_partitions_')
     pool = mp.Pool(processes=cpu_num)
-    id_arr_chunks = np.array_split(id_arr, cpu_num)
-    # Apply the function in parallel
-    chunk_processes = [pool.apply_async(get_weibos_from_users,
-                                        args=(user_id_arr, weibo_path))
-                       for user_id_arr in id_arr_chunks]
-    chunk_results = [chunk.get() for chunk in chunk_processes]
-    for result in chunk_results:
-        for author_id, dataframe in result.groupby('author_id'):
-            dataframe.to_csv(os.path.join(
-                save_path, '{}.csv'.format(author_id)))
+    try:
+        route_processes = [pool.apply_async(route_weibos_to_partitions,
+                                            args=(weibo_files, candidate_partitions, partition_path, batch_index,
+                                                  data_path))
+                           for batch_index, weibo_files in enumerate(weibo_file_batches)]
+        for route_process in route_processes:
+            route_process.get()
+        print('The Weibos of the candidate authors are routed to {} partitions'.format(partition_num))
+        partition_file_dict = {}
+        for partition in range(partition_num):
+            partition_files = [os.path.join(partition_path, 'partition_{}_{}.csv'.format(partition, batch_index))
+                               for batch_index in range(len(weibo_file_batches))]
+            partition_files = [file for file in partition_files if os.path.exists(file)]
+            if len(partition_files) > 0:
+                partition_file_dict[partition] = partition_files
+        save_processes = [pool.apply_async(save_partition_weibos, args=(partition_files, save_path, partition))
+                          for partition, partition_files in partition_file_dict.items()]
+        author_index = pd.concat([save_process.get() for save_process in save_processes],
+                                 axis=0).reset_index(drop=True)
+        author_index.to_parquet(os.path.join(save_path, author_index_filename), index=False)
+        print('The Weibos of {} authors are saved to {}'.format(author_index.shape[0], save_path))
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(partition_path, ignore_errors=True)
 
 
-def get_user_count_dataframe(weibo_data_path: str):
+def count_file_users(weibo_files: list, data_path: str) -> tuple:
+    """
+    Count the Weibos posted by each user in a batch of Weibo files. Used by the worker processes
+    :param weibo_files: the names of the Weibo files in this batch
+    :param data_path: the path containing the weibo data
+    :return: a tuple of two numpy arrays: the author ids and the number of Weibos posted by each of them
+    """
+    author_id_list = []
+    for file in weibo_files:
+        print('Coping with the file: {}'.format(file))
+        author_id_list.append(pd.read_csv(os.path.join(data_path, file), encoding='utf-8',
+                                          usecols=['author_id'])['author_id'].values)
+    if len(author_id_list) == 0:
+        return np.array([]), np.array([], dtype=np.int64)
+    author_codes, author_ids = pd.factorize(np.concatenate(author_id_list))
+    return np.asarray(author_ids), np.bincount(author_codes[author_codes >= 0], minlength=len(author_ids))
+
+
+def get_user_count_dataframe(weibo_data_path: str, workers: int = 1):
     """
     Count the users and the number of weibos they post given a data path.
-    Bot accounts are likely to post many tweets in a long time
+    Bot accounts are likely to post many tweets in a long time. The author ids of each batch of files are
+    factorized and counted with np.bincount, and the batch counts are summed over one global integer space of
+    the author ids
     :param weibo_data_path: the path containing the weibo data
+    :param workers: the number of worker processes. The default 1 reads the files serially
     :return: a pandas dataframe saving the number of weibos posted by each user
     """
-    weibo_files = os.listdir(weibo_data_path)
-    sum_weibo_user_count = pd.DataFrame()
-    for file in weibo_files:
-        print('Coping with the file: {}'.format(file))
-        weibo_dataframe = pd.read_csv(os.path.join(weibo_data_path, file),
-                                      encoding='utf-8', index_col=0)
-        count_dataframe = count_user_weibo(dataframe=weibo_dataframe)
-        count_dataframe = count_dataframe.set_index(['author_id'])
-        sum_weibo_user_count = sum_weibo_user_count.add(count_dataframe,
-                                                        fill_value=0)
-    sum_weibo_user_reindex = sum_weibo_user_count.reset_index()
-    return sum_weibo_user_reindex
+    weibo_files = sorted(os.listdir(weibo_data_path))
+    if workers <= 1:
+        batch_counts = [count_file_users(weibo_files, weibo_data_path)]
+    else:
+        pool = mp.Pool(processes=workers)
+        try:
+            batch_processes = [pool.apply_async(count_file_users, args=(batch, weibo_data_path))
+                               for batch in split_into_batches(weibo_files, batch_num=workers)]
+            batch_counts = [batch_process.get() for batch_process in batch_processes]
+        finally:
+            pool.close()
+            pool.join()
+    author_codes, author_ids = pd.factorize(np.concatenate([author_ids for author_ids, _ in batch_counts]))
+    author_counts = np.bincount(author_codes, weights=np.concatenate([counts for _, counts in batch_counts]),
+                                minlength=len(author_ids)).astype(np.int64)
+    return pd.DataFrame({'author_id': np.asarray(author_ids), 'count': author_counts})
 
 
 def find_bot_accounts(count_dataframe):
@@ -112,24 +263,22 @@ def find_bot_accounts(count_dataframe):
 
 def get_final_bot_ids(user_data_path: str):
     """
-    Get the final bot ids based on geographic footprints
-    :param: user_data_path: the Weibo data path
+    Get the final bot ids based on geographic footprints. The Weibos of each author are saved contiguously in the
+    author store, so the most common footprint percent of all the authors in a parquet file is computed at once
+    :param: user_data_path: the path of the author store created by parallelize
     :return: a numpy array saving the final bot ids
     """
-    files = os.listdir(user_data_path)
+    author_index = load_author_index(user_data_path)
     bot_id_list = []
-    for file in files:
+    for file, file_index in author_index.groupby('file', sort=False):
         print('Coping with the file: {}'.format(file))
-        dataframe = pd.read_csv(os.path.join(user_data_path, file),
-                                index_col=0, encoding='utf-8')
-        dataframe['pos'] = dataframe.apply(
-            lambda row: (row.lat, row.lon), axis=1)
-        _, most_common_count = Counter(
-            dataframe['pos']).most_common()[0]
-        percent = most_common_count/len(set(dataframe['weibo_id']))
-        if percent >= 0.6:
-            author_id = list(dataframe['author_id'])[0]
-            bot_id_list.append(author_id)
+        dataframe = pd.read_parquet(os.path.join(user_data_path, file), columns=['weibo_id', 'lat', 'lon'])
+        author_codes = np.repeat(np.arange(file_index.shape[0]), (file_index['end'] - file_index['start']).values)
+        weibo_count = dataframe['weibo_id'].groupby(author_codes).nunique(dropna=False)
+        most_common_count = dataframe.groupby([author_codes, dataframe['lat'], dataframe['lon']], sort=False,
+                                              dropna=False).size().groupby(level=0).max()
+        percent = (most_common_count / weibo_count).sort_index().values
+        bot_id_list.extend(file_index['author_id'].values[percent >= 0.6])
     return np.array(bot_id_list)
 
 
@@ -138,7 +287,7 @@ if __name__ == '__main__':
     cur_dir = os.getcwd()
     saving_path = os.path.join(cur_dir, 'weibo_from_users')
     # Get the number of tweets posted by each user
-    count_data = get_user_count_dataframe(weibo_data_path=weibo_path)
+    count_data = get_user_count_dataframe(weibo_data_path=weibo_path, workers=20)
     count_data.to_csv("count_weibo_user.csv", encoding='utf-8')
     count_data = pd.read_csv("count_weibo_user.csv", index_col=0,
                              encoding='utf-8')
@@ -152,5 +301,7 @@ if __name__ == '__main__':
     final_bot_accounts = get_final_bot_ids(
         user_data_path=saving_path)
     np.save("weibo_bots_final.npy", final_bot_accounts)
+    # Save the sorted bot id store used by the Weibo counting codes
+    convert_bot_id_file("weibo_bots_final.npy")
     end_time = time.time()
     print("Total time: {}".format((end_time - start_time)/3600))
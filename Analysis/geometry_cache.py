@@ -0,0 +1,195 @@
+# encoding = 'utf-8'
+import os
+from collections import OrderedDict
+import numpy as np
+import geopandas as gpd
+import shapely
+from shapely.geometry import box
+from shapely.prepared import prep
+try:
+    from shapely import contains_xy, prepare  # shapely >= 2.0
+except ImportError:
+    from shapely.vectorized import contains as contains_xy  # shapely 1.x
+    prepare = None
+
+# The maximum number of shapefiles kept in the cache of one process
+geometry_cache_size = 8
+
+# The loaded shapefiles, keyed by (path, mtime, target crs, encoding). The least recently used one is dropped first
+geometry_cache = OrderedDict()
+
+# The state of a cell in the mask grid
+outside_cell, inside_cell, boundary_cell = 0, 1, 2
+
+
+class CityMaskGrid(object):
+    """
+    A grid of the cells covering the bounds of a geometry. Each cell is wholly outside, wholly inside or on the
+    boundary of the geometry, so only the points in the boundary cells need an exact test
+    """
+
+    def __init__(self, min_x: float, min_y: float, resolution: float, cell_states: np.ndarray):
+        """
+        Initialize the mask grid
+        :param min_x: the minimum x of the grid
+        :param min_y: the minimum y of the grid
+        :param resolution: the cell size, in the unit of the crs
+        :param cell_states: a 2D numpy array (row for y, column for x) saving the state of each cell
+        """
+        self.min_x = min_x
+        self.min_y = min_y
+        self.resolution = resolution
+        self.cell_states = cell_states
+        self.row_num, self.col_num = cell_states.shape
+
+    def get_cell_states(self, x_values: np.ndarray, y_values: np.ndarray) -> np.ndarray:
+        """
+        Get the state of the cell of each point
+        :param x_values: the x coordinates of the points within the bounds of the grid
+        :param y_values: the y coordinates of the points within the bounds of the grid
+        :return: a numpy array saving the cell state of each point
+        """
+        cols = np.clip(np.floor((x_values - self.min_x) / self.resolution).astype(np.int64), 0, self.col_num - 1)
+        rows = np.clip(np.floor((y_values - self.min_y) / self.resolution).astype(np.int64), 0, self.row_num - 1)
+        return self.cell_states[rows, cols]
+
+
+class CachedGeometry(object):
+    """
+    A shapefile loaded and reprojected once, with its union, prepared geometry and bounds
+    """
+
+    def __init__(self, shape_data: gpd.GeoDataFrame):
+        """
+        Initialize the cached geometry
+        :param shape_data: the geopandas dataframe of the shapefile in the target crs
+        """
+        self.shape_data = shape_data
+        self.mask_grid = None  # set by load_geometry if a mask resolution is given
+        self.union = shape_data.unary_union
+        self.prepared = prep(self.union)
+        if prepare is not None:
+            prepare(self.union)
+        # The bounds in (min_x, min_y, max_x, max_y)
+        self.bounds = tuple(shape_data.total_bounds)
+
+    def contains_points(self, x_values, y_values) -> np.ndarray:
+        """
+        Check whether the points are within the geometry. The points outside the bounds are rejected first. If
+        the geometry has a mask grid, the points in the cells wholly inside or outside the geometry are answered
+        by the grid. The remaining points are tested against the geometry
+        :param x_values: the x coordinates of the points, such as the longitudes
+        :param y_values: the y coordinates of the points, such as the latitudes
+        :return: a boolean numpy array. True if the point is within the geometry. The points with missing
+        coordinates are not within the geometry
+        """
+        x_values = np.asarray(x_values, dtype=np.float64)
+        y_values = np.asarray(y_values, dtype=np.float64)
+        min_x, min_y, max_x, max_y = self.bounds
+        in_bounds = (x_values >= min_x) & (x_values <= max_x) & (y_values >= min_y) & (y_values <= max_y)
+        in_geometry = np.zeros(len(x_values), dtype=bool)
+        candidate_index = np.flatnonzero(in_bounds)
+        if self.mask_grid is not None and len(candidate_index) > 0:
+            cell_states = self.mask_grid.get_cell_states(x_values[candidate_index], y_values[candidate_index])
+            in_geometry[candidate_index[cell_states == inside_cell]] = True
+            candidate_index = candidate_index[cell_states == boundary_cell]
+        if len(candidate_index) > 0:
+            target = self.union if prepare is not None else self.prepared
+            in_geometry[candidate_index] = contains_xy(target, x_values[candidate_index], y_values[candidate_index])
+        return in_geometry
+
+
+def create_mask_grid(cached_geometry: CachedGeometry, resolution: float) -> CityMaskGrid:
+    """
+    Create the mask grid of a geometry. Each cell is enlarged by a tiny margin before the test, so that the
+    points near the cell edges are answered correctly regardless of the rounding errors
+    :param cached_geometry: a CachedGeometry
+    :param resolution: the cell size, in the unit of the crs
+    :return: a CityMaskGrid
+    """
+    min_x, min_y, max_x, max_y = cached_geometry.bounds
+    col_num = max(int(np.ceil((max_x - min_x) / resolution)), 1)
+    row_num = max(int(np.ceil((max_y - min_y) / resolution)), 1)
+    print('Creating the {} x {} mask grid...'.format(row_num, col_num))
+    margin = resolution * 1e-6
+    cols, rows = np.meshgrid(np.arange(col_num), np.arange(row_num))
+    cell_min_x = min_x + cols.ravel() * resolution - margin
+    cell_min_y = min_y + rows.ravel() * resolution - margin
+    cell_max_x, cell_max_y = cell_min_x + resolution + 2 * margin, cell_min_y + resolution + 2 * margin
+    if prepare is not None:
+        cells = shapely.box(cell_min_x, cell_min_y, cell_max_x, cell_max_y)
+        inside = shapely.contains_properly(cached_geometry.union, cells)
+        touched = shapely.intersects(cached_geometry.union, cells)
+    else:
+        cells = [box(*cell_bounds) for cell_bounds in zip(cell_min_x, cell_min_y, cell_max_x, cell_max_y)]
+        inside = np.array([cached_geometry.prepared.contains_properly(cell) for cell in cells], dtype=bool)
+        touched = np.array([cached_geometry.prepared.intersects(cell) for cell in cells], dtype=bool)
+    cell_states = np.full(len(cells), outside_cell, dtype=np.int8)
+    cell_states[touched] = boundary_cell
+    cell_states[inside] = inside_cell
+    return CityMaskGrid(min_x=min_x, min_y=min_y, resolution=resolution,
+                        cell_states=cell_states.reshape(row_num, col_num))
+
+
+def load_mask_grid(shapefile_path: str, cached_geometry: CachedGeometry, resolution: float,
+                   epsg: int) -> CityMaskGrid:
+    """
+    Load the mask grid saved next to the shapefile. The grid is created and saved if it does not exist or the
+    shapefile has been modified
+    :param shapefile_path: the path to the shapefile
+    :param cached_geometry: the CachedGeometry of the shapefile
+    :param resolution: the cell size, in the unit of the crs
+    :param epsg: the epsg code of the crs
+    :return: a CityMaskGrid
+    """
+    grid_file = '{}_mask_{}_{}.npz'.format(os.path.splitext(shapefile_path)[0], epsg, resolution)
+    shapefile_mtime = os.path.getmtime(shapefile_path)
+    if os.path.exists(grid_file):
+        saved_grid = np.load(grid_file)
+        if (float(saved_grid['shapefile_mtime']) == shapefile_mtime) and (
+                tuple(saved_grid['bounds']) == cached_geometry.bounds):
+            return CityMaskGrid(min_x=cached_geometry.bounds[0], min_y=cached_geometry.bounds[1],
+                                resolution=resolution, cell_states=saved_grid['cell_states'])
+    mask_grid = create_mask_grid(cached_geometry, resolution=resolution)
+    temp_file = '{}.{}.tmp'.format(grid_file, os.getpid())
+    try:
+        with open(temp_file, 'wb') as opened_file:
+            np.savez_compressed(opened_file, cell_states=mask_grid.cell_states, shapefile_mtime=shapefile_mtime,
+                                bounds=np.array(cached_geometry.bounds))
+        os.replace(temp_file, grid_file)
+        print('The mask grid is saved to {}'.format(grid_file))
+    except OSError:
+        print('The mask grid cannot be saved to {}. Use it without saving'.format(grid_file))
+    return mask_grid
+
+
+def load_geometry(shapefile_path: str, epsg: int = 4326, encoding: str = None,
+                  mask_resolution: float = None) -> CachedGeometry:
+    """
+    Load a shapefile and reproject it to the target crs. The result is cached for each process and reloaded if the
+    shapefile has been modified
+    :param shapefile_path: the path to the shapefile, such as the city or open space shapefile
+    :param epsg: the epsg code of the target crs
+    :param encoding: the encoding of the shapefile attributes. None means using the default encoding
+    :param mask_resolution: the cell size of the mask grid used by contains_points, in the unit of the target
+    crs. None means testing each point against the geometry
+    :return: a CachedGeometry. The shape_data should not be modified by the caller
+    """
+    cache_key = (os.path.abspath(shapefile_path), os.path.getmtime(shapefile_path), epsg, encoding)
+    if cache_key in geometry_cache:
+        geometry_cache.move_to_end(cache_key)
+        cached_geometry = geometry_cache[cache_key]
+    else:
+        if encoding is None:
+            shape_data = gpd.read_file(shapefile_path)
+        else:
+            shape_data = gpd.read_file(shapefile_path, encoding=encoding)
+        cached_geometry = CachedGeometry(shape_data.to_crs(epsg=epsg))
+        geometry_cache[cache_key] = cached_geometry
+        while len(geometry_cache) > geometry_cache_size:
+            geometry_cache.popitem(last=False)
+    if mask_resolution is not None and (cached_geometry.mask_grid is None or
+                                        cached_geometry.mask_grid.resolution != mask_resolution):
+        cached_geometry.mask_grid = load_mask_grid(shapefile_path, cached_geometry, resolution=mask_resolution,
+                                                   epsg=epsg)
+    return cached_geometry
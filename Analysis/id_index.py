@@ -0,0 +1,219 @@
+# encoding = 'utf-8'
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+
+import data_paths
+from bot_store import parse_id_array
+
+# The id types supported by the id index: the tweet (or Weibo) ids and the user ids
+id_types = ['message', 'user']
+
+
+def build_id_pairs(id_values_list: list, first_position: int = 0) -> tuple:
+    """
+    Build the (id, source position) pairs of a list of sources. Each id is kept once for each source. The ids
+    which are not integers are not indexed
+    :param id_values_list: a list saving the ids found in each source, such as the id_str column of each file
+    :param first_position: the position of the first source
+    :return: a tuple of two numpy arrays: the uint64 ids and the positions of their sources, and the number of
+    distinct ids which are not integers
+    """
+    id_arrays, position_arrays = [], []
+    skipped_num = 0
+    for offset, id_values in enumerate(id_values_list):
+        distinct_ids = pd.unique(np.asarray(id_values, dtype=object))
+        uint_ids, is_integer = parse_id_array(distinct_ids)
+        skipped_num += int((~is_integer & ~pd.isnull(distinct_ids)).sum())
+        id_arrays.append(np.unique(uint_ids[is_integer]))
+        position_arrays.append(np.full(len(id_arrays[-1]), first_position + offset, dtype=np.int64))
+    if len(id_arrays) == 0:
+        return np.array([], dtype=np.uint64), np.array([], dtype=np.int64), skipped_num
+    return np.concatenate(id_arrays), np.concatenate(position_arrays), skipped_num
+
+
+def sort_id_pairs(ids: np.ndarray, positions: np.ndarray) -> tuple:
+    """
+    Sort the (id, source position) pairs by the ids and then by the positions
+    :param ids: the uint64 ids
+    :param positions: the positions of their sources
+    :return: a tuple of the sorted ids and positions
+    """
+    order = np.lexsort((positions, ids))
+    return ids[order], positions[order]
+
+
+class IdIndex(object):
+    """
+    A lookup index mapping the tweet (or Weibo) ids and the user ids to the sources saving them. A source is a csv
+    file or a row group of a parquet partition. The (id, source position) pairs are saved as arrays sorted by the
+    ids, so the sources of an id are found by binary search. The sources whose ids cannot be read are unindexed and
+    returned by every lookup
+    """
+
+    def __init__(self, source_records: list, id_pairs: dict, unindexed_records: list = None):
+        """
+        Initialize the id index
+        :param source_records: the records of the indexed sources, such as [csv filename, size, mtime] lists or
+        the row groups of a parquet partition
+        :param id_pairs: a dict mapping each id type ('message' or 'user') to the sorted (ids, positions) tuple
+        :param unindexed_records: the records of the sources whose ids cannot be read. None means no such source
+        """
+        self.source_records = source_records
+        self.id_pairs = id_pairs
+        self.unindexed_records = [] if unindexed_records is None else unindexed_records
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('unindexed_records', [])  # the indexes saved without the unindexed sources
+
+    def find_sources(self, id_values, id_type: str = 'message') -> list:
+        """
+        Find the sources saving the given ids
+        :param id_values: the ids, such as a python set of tweet ids
+        :param id_type: 'message' for the tweet (or Weibo) ids or 'user' for the user ids
+        :return: a sorted list saving the records of the sources, the unindexed sources included
+        """
+        assert id_type in id_types, 'The id type should be one of {}'.format(id_types)
+        ids, positions = self.id_pairs[id_type]
+        uint_ids, is_integer = parse_id_array(np.array(list(id_values), dtype=object))
+        uint_ids = np.unique(uint_ids[is_integer])
+        start_indices = np.searchsorted(ids, uint_ids, side='left')
+        end_indices = np.searchsorted(ids, uint_ids, side='right')
+        found_positions = set()
+        for start_index, end_index in zip(start_indices, end_indices):
+            found_positions.update(positions[start_index:end_index].tolist())
+        return sorted([self.source_records[position] for position in found_positions] + self.unindexed_records)
+
+    def select_sources(self, kept_positions: list):
+        """
+        Create the id index of a subset of the sources, such as the sources which have not been modified
+        :param kept_positions: the sorted positions of the kept sources
+        :return: an IdIndex
+        """
+        position_map = np.full(len(self.source_records), -1, dtype=np.int64)
+        position_map[np.asarray(kept_positions, dtype=np.int64)] = np.arange(len(kept_positions))
+        id_pairs = {}
+        for id_type, (ids, positions) in self.id_pairs.items():
+            new_positions = position_map[positions]
+            kept = new_positions >= 0
+            id_pairs[id_type] = (ids[kept], new_positions[kept])
+        return IdIndex([self.source_records[position] for position in kept_positions], id_pairs)
+
+    def add_sources(self, source_records: list, id_values_dict: dict):
+        """
+        Create the id index with some new sources added
+        :param source_records: the records of the new sources
+        :param id_values_dict: a dict mapping each id type to a list saving the ids found in each new source
+        :return: an IdIndex
+        """
+        id_pairs = {}
+        for id_type in id_types:
+            new_ids, new_positions, skipped_num = build_id_pairs(id_values_dict[id_type],
+                                                                 first_position=len(self.source_records))
+            if skipped_num > 0:
+                print('{} {} ids are not integers and are not indexed'.format(skipped_num, id_type))
+            ids, positions = self.id_pairs[id_type]
+            id_pairs[id_type] = sort_id_pairs(np.concatenate([ids, new_ids]),
+                                              np.concatenate([positions, new_positions]))
+        return IdIndex(self.source_records + list(source_records), id_pairs)
+
+
+def create_id_index(source_records: list, id_values_dict: dict) -> IdIndex:
+    """
+    Create the id index of a list of sources
+    :param source_records: the records of the sources
+    :param id_values_dict: a dict mapping each id type to a list saving the ids found in each source
+    :return: an IdIndex
+    """
+    empty_index = IdIndex([], {id_type: (np.array([], dtype=np.uint64), np.array([], dtype=np.int64))
+                               for id_type in id_types})
+    return empty_index.add_sources(source_records, id_values_dict)
+
+
+def save_id_index(id_index: IdIndex, index_file: str) -> None:
+    """
+    Save the id index to the local directory
+    :param id_index: an IdIndex
+    :param index_file: the pickle file saving the id index
+    :return: None
+    """
+    index_dir = os.path.dirname(index_file)
+    if index_dir and not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    temp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+    with open(temp_file, 'wb') as opened_file:
+        pickle.dump(id_index, opened_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, index_file)
+
+
+def load_id_index(index_file: str) -> IdIndex:
+    """
+    Load the id index saved by save_id_index
+    :param index_file: the pickle file saving the id index
+    :return: an IdIndex
+    """
+    with open(index_file, 'rb') as opened_file:
+        return pickle.load(opened_file)
+
+
+def get_csv_index_file(csv_path: str, index_path: str = data_paths.manifest_path) -> str:
+    """
+    Get the file saving the id index of a csv directory. The index is not saved in the csv directory, whose files
+    are listed by the readers
+    :param csv_path: the directory saving the csv files
+    :param index_path: the path saving the id indexes
+    :return: the path of the id index file
+    """
+    path_hash = hashlib.md5(os.path.abspath(csv_path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(index_path, '{}_{}_id_index.pkl'.format(os.path.basename(os.path.normpath(csv_path)),
+                                                                path_hash))
+
+
+def update_csv_id_index(csv_path: str, message_id_colname: str = 'id_str', user_id_colname: str = 'user_id_str',
+                        index_path: str = data_paths.manifest_path) -> IdIndex:
+    """
+    Update the id index of the csv files saved in a directory. Only the new or modified csv files are read, and
+    the removed files are dropped from the index. The files whose ids cannot be read are not saved in the index,
+    so they are read again by the next update, and they are returned by every lookup of this index
+    :param csv_path: the directory saving the csv files, such as the yearly folder of the tweets
+    :param message_id_colname: the column saving the tweet (or Weibo) ids, such as 'id_str' or 'weibo_id'
+    :param user_id_colname: the column saving the user ids, such as 'user_id_str' or 'author_id'
+    :param index_path: the path saving the id indexes
+    :return: an IdIndex whose source records are [csv filename, size, mtime] lists
+    """
+    index_file = get_csv_index_file(csv_path, index_path=index_path)
+    if os.path.exists(index_file):
+        id_index = load_id_index(index_file)
+    else:
+        id_index = create_id_index([], {id_type: [] for id_type in id_types})
+    current_records = []
+    for csv_file in sorted(os.listdir(csv_path)):
+        if csv_file.endswith('.csv'):
+            file_stat = os.stat(os.path.join(csv_path, csv_file))
+            current_records.append([csv_file, file_stat.st_size, file_stat.st_mtime])
+    saved_positions = {tuple(record): position for position, record in enumerate(id_index.source_records)}
+    kept_positions = sorted(saved_positions[tuple(record)] for record in current_records
+                            if tuple(record) in saved_positions)
+    new_records = [record for record in current_records if tuple(record) not in saved_positions]
+    if len(new_records) == 0 and len(kept_positions) == len(id_index.source_records):
+        return id_index
+    print('Indexing the ids of {} csv files in {}...'.format(len(new_records), csv_path))
+    id_values_dict = {id_type: [] for id_type in id_types}
+    indexed_records, unindexed_records = [], []
+    for record in new_records:
+        try:
+            with open(os.path.join(csv_path, record[0]), encoding='utf-8', errors='ignore') as opened_file:
+                dataframe = pd.read_csv(opened_file, usecols=[message_id_colname, user_id_colname], dtype=str)
+        except (ValueError, pd.errors.ParserError):
+            print('The ids of the csv file: {} cannot be read. It is read by every lookup'.format(record[0]))
+            unindexed_records.append(record)
+            continue
+        indexed_records.append(record)
+        id_values_dict['message'].append(dataframe[message_id_colname].values)
+        id_values_dict['user'].append(dataframe[user_id_colname].values)
+    id_index = id_index.select_sources(kept_positions).add_sources(indexed_records, id_values_dict)
+    save_id_index(id_index, index_file)
+    return IdIndex(id_index.source_records, id_index.id_pairs, unindexed_records=unindexed_records)
@@ -1,17 +1,16 @@
 import os
-from spatial_analysis import main_foreign
-from count_tweets import main_count_tweets
-from cities_bounds import cities_dict_foreign, open_space_saving_path
-from extract_raster import main_foreign_raster
-
-from data_paths import raster_save_path
+from cities_bounds import cities_dict_foreign
+from tweet_store import main_convert_parquet
+from scheduler import schedule_foreign_cities
 
 if __name__ == '__main__':
     considered_cities_set = {'hong_kong'}
-    print('Finding the tweets posted in open space...')
-    main_foreign(considered_cities=considered_cities_set, cities_profile=cities_dict_foreign,
-                 save_threshold=30000, open_space_save_path=open_space_saving_path)
-    print('Counting the tweets in the cities and open spaces...')
-    main_count_tweets(count_in_utc=True, considered_city_names=considered_cities_set)
-    print('Computing the raster values...')
-    main_foreign_raster(save_path=raster_save_path, considered_cities=considered_cities_set)
\ No newline at end of file
+    print('Refreshing the parquet mirror of the raw tweets...')
+    main_convert_parquet(considered_cities=considered_cities_set, cities_profile=cities_dict_foreign)
+    # Find the tweets posted in open space, count the tweets in the cities and open spaces and compute the
+    # raster values. Different cities are processed at the same time
+    print('Processing the cities...')
+    scheduler = schedule_foreign_cities(considered_cities=considered_cities_set, cities_profile=cities_dict_foreign,
+                                        max_workers=4, save_threshold=30000, count_in_utc=True,
+                                        status_path=os.path.join(os.getcwd(), 'foreign_task_status.csv'))
+    print(scheduler.run())
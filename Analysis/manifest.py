@@ -0,0 +1,160 @@
+# encoding = 'utf-8'
+import os
+import pickle
+import hashlib
+
+# The size of the blocks read when computing the content hash of a file
+hash_block_size = 1 << 20
+# The version of the manifest format. The manifests saved by the other versions are rebuilt, since the partial
+# aggregates saved in them have a different format
+manifest_version = 3
+
+
+def compute_file_hash(file_path: str) -> str:
+    """
+    Compute the content hash of a file
+    :param file_path: the full path to the file
+    :return: the md5 hex digest of the file content
+    """
+    file_hash = hashlib.md5()
+    with open(file_path, 'rb') as opened_file:
+        for block in iter(lambda: opened_file.read(hash_block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def compute_config_hash(*config_values) -> str:
+    """
+    Compute the hash of the configuration used to create the partial aggregates, such as the bot ids and the
+    timezone. Sets are sorted first so that the hash does not depend on the iteration order
+    :param config_values: the configuration values
+    :return: the md5 hex digest of the configuration
+    """
+    config_hash = hashlib.md5()
+    for value in config_values:
+        if isinstance(value, (set, frozenset)):
+            value = sorted(str(item) for item in value)
+        config_hash.update(repr(value).encode('utf-8'))
+    return config_hash.hexdigest()
+
+
+class FileManifest(object):
+    """
+    A persistent record of the processed files of a city. For each file, the manifest saves the size and mtime
+    taken before reading it, the content hash if it has been computed, and the partial aggregates computed from
+    it, so that the reruns only process the new or modified files
+    """
+
+    def __init__(self, manifest_file: str):
+        """
+        Load the manifest. A new manifest is created if the file does not exist or is saved by another version
+        :param manifest_file: the pickle file saving the manifest
+        """
+        self.manifest_file = manifest_file
+        self.entries = {}
+        self.hash_cache = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'rb') as opened_file:
+                saved_manifest = pickle.load(opened_file)
+            if isinstance(saved_manifest, dict) and saved_manifest.get('version') == manifest_version:
+                self.entries = saved_manifest['entries']
+            else:
+                print('The manifest {} is saved by another version. Rebuild it'.format(manifest_file))
+        self.reused_num, self.processed_num = 0, 0
+
+    def get_file_hash(self, file_path: str, file_stat: os.stat_result) -> str:
+        """
+        Get the content hash of a file. Each file is hashed at most once for one run
+        :param file_path: the full path to the file
+        :param file_stat: the os.stat of the file taken before hashing it
+        :return: the content hash of the file
+        """
+        if file_path not in self.hash_cache:
+            self.hash_cache[file_path] = (file_stat.st_size, file_stat.st_mtime, compute_file_hash(file_path))
+        return self.hash_cache[file_path][2]
+
+    def is_unchanged(self, file_path: str, entry: dict) -> bool:
+        """
+        Check whether a file is the same as the one recorded in an entry. The size and mtime are checked first.
+        If the mtime has changed but the size has not, the content hash decides. An entry without the content
+        hash is regarded as modified in this case
+        :param file_path: the full path to the file
+        :param entry: the entry of the file saved in the manifest
+        :return: True if the file has not been modified
+        """
+        file_stat = os.stat(file_path)
+        if file_stat.st_size != entry['size']:
+            return False
+        if file_stat.st_mtime == entry['mtime']:
+            return True
+        if self.get_file_hash(file_path, file_stat) == entry['hash']:
+            entry['mtime'] = file_stat.st_mtime  # the file is touched but not modified
+            return True
+        return False
+
+    def get_partials(self, file_path: str, partial_keys: list, row_group: int = None):
+        """
+        Get the saved partial aggregates of a file
+        :param file_path: the full path to the file
+        :param partial_keys: the keys of the needed partial aggregates
+        :param row_group: the row group of a parquet partition. None for the csv files
+        :return: a list of partial aggregates in the order of partial_keys. None if the file is new or modified,
+        or if any partial aggregate is missing
+        """
+        entry = self.entries.get((file_path, row_group))
+        if entry is None or not self.is_unchanged(file_path, entry):
+            return None
+        if any(partial_key not in entry['partials'] for partial_key in partial_keys):
+            return None
+        self.reused_num += 1
+        return [entry['partials'][partial_key] for partial_key in partial_keys]
+
+    def set_partials(self, file_path: str, file_stat: os.stat_result, partial_keys: list, partials: list,
+                     row_group: int = None) -> None:
+        """
+        Save the partial aggregates of a file. The partial aggregates computed from an older version of the
+        file are dropped. The file is not hashed here: the content hash is only saved if it has been computed by
+        is_unchanged for the same size and mtime
+        :param file_path: the full path to the file
+        :param file_stat: the os.stat of the file taken before reading it, so the file appended during the
+        reading is processed again by the next run
+        :param partial_keys: the keys of the partial aggregates
+        :param partials: a list of partial aggregates in the order of partial_keys
+        :param row_group: the row group of a parquet partition. None for the csv files
+        :return: None
+        """
+        entry = self.entries.get((file_path, row_group))
+        if entry is None or (entry['size'], entry['mtime']) != (file_stat.st_size, file_stat.st_mtime):
+            hash_record = self.hash_cache.get(file_path)
+            file_hash = None
+            if hash_record is not None and hash_record[:2] == (file_stat.st_size, file_stat.st_mtime):
+                file_hash = hash_record[2]
+            entry = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'hash': file_hash, 'partials': {}}
+            self.entries[(file_path, row_group)] = entry
+        entry['partials'].update(zip(partial_keys, partials))
+        self.processed_num += 1
+
+    def keep_only(self, file_keys: set) -> None:
+        """
+        Remove the entries of the files which no longer exist
+        :param file_keys: a set of (file_path, row_group) tuples of the current files
+        :return: None
+        """
+        for file_key in list(self.entries.keys()):
+            if file_key not in file_keys:
+                del self.entries[file_key]
+
+    def save(self) -> None:
+        """
+        Save the manifest to the local directory
+        :return: None
+        """
+        manifest_dir = os.path.dirname(self.manifest_file)
+        if manifest_dir and not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        temp_file = self.manifest_file + '.tmp'
+        with open(temp_file, 'wb') as opened_file:
+            pickle.dump({'version': manifest_version, 'entries': self.entries}, opened_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, self.manifest_file)
+        print('The manifest {} is saved: {} files reused, {} files processed'.format(
+            self.manifest_file, self.reused_num, self.processed_num))
@@ -0,0 +1,182 @@
+# encoding = 'utf-8'
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+try:
+    from shapely import STRtree, contains, prepare, points  # shapely >= 2.0
+except ImportError:
+    STRtree = None  # shapely 1.x: use the spatial join of geopandas
+
+# The maximum number of open space indexes kept in the cache of one process
+open_space_index_cache_size = 4
+
+# The loaded open space indexes, keyed by (path, mtime, target crs, encoding)
+open_space_index_cache = OrderedDict()
+
+# The labels of the points outside the city and the points in the city but not in open space. The points in open
+# space are labeled by the position of their open space polygon
+outside_city_label, city_label = -2, -1
+
+
+class OpenSpaceIndex(object):
+    """
+    An STRtree of the open space polygons of a city, answering which polygon each point is posted in. The tree is
+    built and the polygons are prepared once when first queried; the pickled index only saves the polygons and
+    their attributes
+    """
+
+    def __init__(self, open_space_data: gpd.GeoDataFrame):
+        """
+        Initialize the open space index
+        :param open_space_data: the open space shapefile of the city
+        """
+        self.crs = open_space_data.crs
+        self.attributes = pd.DataFrame(open_space_data.drop(columns=open_space_data.geometry.name))
+        self.polygons = np.array(list(open_space_data.geometry), dtype=object)
+        # The partial aggregates saved in the manifests are only valid for the same open space geometries
+        self.geometry_hash = hashlib.md5(b''.join(polygon.wkb for polygon in self.polygons)).hexdigest()
+        self.tree = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tree'] = None
+        return state
+
+    def get_tree(self):
+        """
+        Get the STRtree of the prepared open space polygons
+        :return: a shapely STRtree
+        """
+        if self.tree is None:
+            prepare(self.polygons)
+            self.tree = STRtree(self.polygons)
+        return self.tree
+
+    def query_xy(self, x_values, y_values) -> tuple:
+        """
+        Find the open space polygon each point is posted in. If a point is within several polygons, the first
+        one in the shapefile is used
+        :param x_values: the x coordinates of the points, such as the longitudes
+        :param y_values: the y coordinates of the points, such as the latitudes
+        :return: a tuple of two numpy arrays: the positions of the points within open space and the positions of
+        their polygons
+        """
+        x_values = np.asarray(x_values, dtype=np.float64)
+        y_values = np.asarray(y_values, dtype=np.float64)
+        if STRtree is None:
+            point_data = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x_values, y_values), crs=self.crs)
+            polygon_data = gpd.GeoDataFrame(geometry=list(self.polygons), crs=self.crs)
+            joined_data = gpd.sjoin(left_df=point_data, right_df=polygon_data, op='within')
+            point_positions, polygon_positions = joined_data.index.values, joined_data['index_right'].values
+        else:
+            point_geometries = points(x_values, y_values)
+            # Find the candidate polygons by the bounding boxes and test them with the prepared polygons
+            point_positions, polygon_positions = self.get_tree().query(point_geometries)
+            within = contains(self.polygons[polygon_positions], point_geometries[point_positions])
+            point_positions, polygon_positions = point_positions[within], polygon_positions[within]
+        order = np.lexsort((polygon_positions, point_positions))
+        point_positions, polygon_positions = point_positions[order], polygon_positions[order]
+        first_match = np.ones(len(point_positions), dtype=bool)
+        first_match[1:] = point_positions[1:] != point_positions[:-1]
+        return point_positions[first_match], polygon_positions[first_match]
+
+    def join_attributes(self, tweet_gdf: gpd.GeoDataFrame, polygon_positions: np.ndarray) -> gpd.GeoDataFrame:
+        """
+        Add the attributes of the open space polygons to the tweets. The result has the same columns as the
+        spatial join of geopandas: the index (index_right) and the attributes of the polygon are added to each
+        tweet, with the _left and _right suffixes for the shared column names
+        :param tweet_gdf: the geopandas dataframe saving the tweets posted in open space
+        :param polygon_positions: the position of the open space polygon of each tweet
+        :return: a geopandas dataframe saving the tweets posted in open space
+        """
+        matched_attributes = self.attributes.iloc[polygon_positions]
+        shared_columns = [column for column in matched_attributes.columns if column in tweet_gdf.columns]
+        joined_data = tweet_gdf.rename(columns={column: column + '_left' for column in shared_columns})
+        joined_data['index_right'] = matched_attributes.index.values
+        for column in matched_attributes.columns:
+            colname = column + '_right' if column in shared_columns else column
+            joined_data[colname] = matched_attributes[column].values
+        return joined_data
+
+    def find_tweets_in_open_space(self, tweet_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """
+        Find the tweets posted in open space
+        :param tweet_gdf: the geopandas dataframe saving the tweets, with the 'lat' and 'lon' columns in the
+        same crs as the open space
+        :return: a geopandas dataframe saving the tweets posted in open space
+        """
+        assert tweet_gdf.crs == self.crs, 'The coordinate systems do not match!'
+        point_positions, polygon_positions = self.query_xy(tweet_gdf['lon'], tweet_gdf['lat'])
+        joined_data = self.join_attributes(tweet_gdf.iloc[point_positions], polygon_positions)
+        return joined_data.drop_duplicates(subset=['id_str'])
+
+
+def classify_points(city_geometry, open_space_index: OpenSpaceIndex, x_values, y_values) -> np.ndarray:
+    """
+    Classify the points with one pass: the points outside the city are labeled by outside_city_label, and only
+    the points in the city are queried against the open space index
+    :param city_geometry: the CachedGeometry of the city shapefile
+    :param open_space_index: the OpenSpaceIndex of the open space of the city
+    :param x_values: the x coordinates of the points, such as the longitudes
+    :param y_values: the y coordinates of the points, such as the latitudes
+    :return: a numpy array saving the label of each point: outside_city_label, city_label, or the position of
+    the open space polygon the point is posted in
+    """
+    x_values = np.asarray(x_values, dtype=np.float64)
+    y_values = np.asarray(y_values, dtype=np.float64)
+    labels = np.full(len(x_values), outside_city_label, dtype=np.int64)
+    city_positions = np.flatnonzero(city_geometry.contains_points(x_values, y_values))
+    labels[city_positions] = city_label
+    if len(city_positions) > 0:
+        point_positions, polygon_positions = open_space_index.query_xy(x_values[city_positions],
+                                                                       y_values[city_positions])
+        labels[city_positions[point_positions]] = polygon_positions
+    return labels
+
+
+def load_open_space_index(shapefile_path: str, epsg: int = 4326, encoding: str = None) -> OpenSpaceIndex:
+    """
+    Load the open space index of a shapefile. The index is saved next to the shapefile, so it is created once
+    and reused across the files and runs. It is created again if the shapefile has been modified
+    :param shapefile_path: the path to the open space shapefile
+    :param epsg: the epsg code of the target crs
+    :param encoding: the encoding of the shapefile attributes. None means using the default encoding
+    :return: an OpenSpaceIndex
+    """
+    shapefile_mtime = os.path.getmtime(shapefile_path)
+    cache_key = (os.path.abspath(shapefile_path), shapefile_mtime, epsg, encoding)
+    if cache_key in open_space_index_cache:
+        open_space_index_cache.move_to_end(cache_key)
+        return open_space_index_cache[cache_key]
+    index_file = '{}_index_{}.pkl'.format(os.path.splitext(shapefile_path)[0], epsg)
+    open_space_index = None
+    if os.path.exists(index_file):
+        with open(index_file, 'rb') as opened_file:
+            saved_index = pickle.load(opened_file)
+        if saved_index['shapefile_mtime'] == shapefile_mtime and saved_index['encoding'] == encoding:
+            open_space_index = saved_index['open_space_index']
+    if open_space_index is None:
+        print('Creating the open space index of {}...'.format(shapefile_path))
+        if encoding is None:
+            open_space_data = gpd.read_file(shapefile_path)
+        else:
+            open_space_data = gpd.read_file(shapefile_path, encoding=encoding)
+        open_space_index = OpenSpaceIndex(open_space_data.to_crs(epsg=epsg))
+        temp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+        try:
+            with open(temp_file, 'wb') as opened_file:
+                pickle.dump({'shapefile_mtime': shapefile_mtime, 'encoding': encoding,
+                             'open_space_index': open_space_index}, opened_file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, index_file)
+            print('The open space index is saved to {}'.format(index_file))
+        except OSError:
+            print('The open space index cannot be saved to {}. Use it without saving'.format(index_file))
+    open_space_index_cache[cache_key] = open_space_index
+    while len(open_space_index_cache) > open_space_index_cache_size:
+        open_space_index_cache.popitem(last=False)
+    return open_space_index
@@ -0,0 +1,481 @@
+# encoding = 'utf-8'
+from collections import defaultdict, Counter
+from datetime import datetime
+import os
+import functools
+import multiprocessing as mp
+import pandas as pd
+
+from utils import merge_dict, split_into_batches, batches_per_worker, HourlyCountAccumulator
+from tweet_store import list_tweet_sources, iter_source_chunks, get_chunksize, considered_colnames, \
+    compact_colnames, dtype_dict
+from open_space_index import OpenSpaceIndex
+from bot_store import BotStatsAccumulator, footprint_decimals
+
+
+class ScanBatch(object):
+    """
+    The tweets saved in one hourly file, or one chunk of it in the streaming mode. The views used by the
+    aggregators (deduplication, bot filtering, spatial join and time parsing) are computed at most once for
+    each batch
+    """
+
+    def __init__(self, dataframe: pd.DataFrame, count_obj):
+        """
+        Initialize the batch
+        :param dataframe: the tweet dataframe read from one hourly file, in the compact schema of tweet_store
+        :param count_obj: the CountTweets object offering the city shapefile, bot ids and timezone
+        """
+        self.dataframe = dataframe
+        self.count_obj = count_obj
+        self.views = {}
+
+    def get_view(self, view_name: str) -> pd.DataFrame:
+        """
+        Get a view of the tweets in this batch. The following views are supported:
+        'geocoded_with_bots': the geocoded tweets (lat and lon) posted in the city, bot accounts included
+        'geocoded': the geocoded tweets (lat and lon) posted in the city by non-bot users, with 'clean_time'
+        'place': the geocoded place tweets (place_lat and place_lon) posted in the city by non-bot users,
+        with 'clean_time'
+        :param view_name: the name of the view
+        :return: a pandas dataframe saving the tweets of this view
+        """
+        if view_name not in self.views:
+            self.views[view_name] = self.build_view(view_name)
+        return self.views[view_name]
+
+    def build_view(self, view_name: str) -> pd.DataFrame:
+        """
+        Build a view of the tweets in this batch
+        :param view_name: the name of the view
+        :return: a pandas dataframe saving the tweets of this view
+        """
+        if view_name == 'geocoded_with_bots':
+            geocoded_dataframe = self.dataframe.loc[~self.dataframe['lat'].isnull()]
+            geocoded_without_duplicates = geocoded_dataframe.drop_duplicates(subset=['id_str'])
+            return self.count_obj.find_tweet_in_city(geocoded_without_duplicates)
+        elif view_name == 'geocoded':
+            geocoded_tweet_city = self.get_view('geocoded_with_bots')
+            geocoded_without_bot = geocoded_tweet_city.loc[
+                ~self.count_obj.bot_ids.contains(geocoded_tweet_city['user_id_str'])]
+            return self.count_obj.add_clean_time(geocoded_without_bot)
+        elif view_name == 'place':
+            geocoded_place_dataframe = self.dataframe.loc[~self.dataframe['place_lat'].isnull()]
+            geocoded_place_without_duplicates = geocoded_place_dataframe.drop_duplicates(subset=['id_str'])
+            geocoded_place_without_bot = geocoded_place_without_duplicates.loc[
+                ~self.count_obj.bot_ids.contains(geocoded_place_without_duplicates['user_id_str'])]
+            geocoded_place_tweet_city = self.count_obj.find_tweet_place_in_city(geocoded_place_without_bot)
+            return self.count_obj.add_clean_time(geocoded_place_tweet_city)
+        raise ValueError('The view {} is not supported'.format(view_name))
+
+
+class HourlyCountAggregator(object):
+    """
+    Count the tweets posted in each hour of the study time
+    """
+
+    keep_text = False
+
+    def __init__(self, start_time: datetime, end_time: datetime, view: str = 'geocoded'):
+        """
+        Initialize the aggregator
+        :param start_time: the start time of the study time
+        :param end_time: the end time of the study time (not included)
+        :param view: the counted view, 'geocoded' for the lat and lon tweets or 'place' for the place tweets
+        """
+        self.view = view
+        self.accumulator = HourlyCountAccumulator(start_time=start_time, end_time=end_time)
+        # the key of the partial aggregates saved in the manifest
+        self.cache_key = 'hourly_{}_{}_{}'.format(view, start_time.isoformat(), end_time.isoformat())
+
+    def empty_copy(self):
+        """
+        Create an empty aggregator with the same setting
+        :return: a HourlyCountAggregator
+        """
+        return HourlyCountAggregator(start_time=self.accumulator.start_time, end_time=self.accumulator.end_time,
+                                     view=self.view)
+
+    def update(self, batch: ScanBatch) -> None:
+        """
+        Count the tweets of one batch
+        :param batch: a ScanBatch
+        :return: None
+        """
+        self.accumulator.add_times(batch.get_view(self.view)['clean_time'])
+
+    def get_partial(self) -> tuple:
+        """
+        Get the partial aggregate, which can be pickled and merged by another aggregator
+        :return: a tuple of the hour indices with tweets and the number of tweets posted in these hours
+        """
+        return self.accumulator.get_sparse_counts()
+
+    def merge_partial(self, partial: tuple) -> None:
+        """
+        Merge a partial aggregate, such as the one returned by a worker process
+        :param partial: a partial aggregate returned by get_partial
+        :return: None
+        """
+        hour_index, counts = partial
+        self.accumulator.add_sparse_counts(hour_index, counts)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Create the hourly count dataframe
+        :return: a pandas dataframe saving the number of tweets posted in each hour of the study time
+        """
+        return self.accumulator.to_dataframe(count_colname='total_count')
+
+
+class MonthlyCountAggregator(object):
+    """
+    Count the geocoded tweets and all the tweets (geocoded or place) posted in each month
+    """
+
+    keep_text = False
+
+    def __init__(self):
+        self.geocoded_count_dict = defaultdict()
+        self.all_count_dict = defaultdict()
+        self.cache_key = 'monthly'
+
+    def empty_copy(self):
+        """
+        Create an empty aggregator with the same setting
+        :return: a MonthlyCountAggregator
+        """
+        return MonthlyCountAggregator()
+
+    def update(self, batch: ScanBatch) -> None:
+        """
+        Count the tweets of one batch
+        :param batch: a ScanBatch
+        :return: None
+        """
+        month_dataframe_list = []
+        for view in ['geocoded', 'place']:
+            dataframe = batch.get_view(view)
+            if dataframe.shape[0] == 0:
+                continue
+            month_dataframe = pd.DataFrame({'id_str': dataframe['id_str']})
+            month_dataframe['year_month'] = dataframe['clean_time'].dt.year.astype(str) + '_' + \
+                dataframe['clean_time'].dt.month.astype(str)
+            if view == 'geocoded':
+                self.geocoded_count_dict = merge_dict(self.geocoded_count_dict,
+                                                      Counter(month_dataframe['year_month']))
+            month_dataframe_list.append(month_dataframe)
+        if len(month_dataframe_list) > 0:
+            combined_tweet = pd.concat(month_dataframe_list, axis=0)
+            combined_tweet_without_duplicates = combined_tweet.drop_duplicates(subset='id_str')
+            self.all_count_dict = merge_dict(self.all_count_dict,
+                                             Counter(combined_tweet_without_duplicates['year_month']))
+
+    def get_partial(self) -> tuple:
+        """
+        Get the partial aggregate, which can be pickled and merged by another aggregator
+        :return: a tuple of the geocoded count dict and the all count dict
+        """
+        return dict(self.geocoded_count_dict), dict(self.all_count_dict)
+
+    def merge_partial(self, partial: tuple) -> None:
+        """
+        Merge a partial aggregate, such as the one returned by a worker process
+        :param partial: a partial aggregate returned by get_partial
+        :return: None
+        """
+        geocoded_count_dict, all_count_dict = partial
+        self.geocoded_count_dict = merge_dict(self.geocoded_count_dict, Counter(geocoded_count_dict))
+        self.all_count_dict = merge_dict(self.all_count_dict, Counter(all_count_dict))
+
+    def to_dataframe(self, count_obj) -> pd.DataFrame:
+        """
+        Create the monthly count dataframe
+        :param count_obj: the CountTweets object offering the considered years
+        :return: a pandas dataframe saving the number of geocoded tweets and all tweets posted in each month
+        """
+        key_vals = [str(year) + '_' + str(month) for year in count_obj.considered_year_list
+                    for month in range(1, 13)]
+        count_dataframe = pd.DataFrame(columns=['time', 'geocoded_count', 'all_count'])
+        count_dataframe['time'] = key_vals
+        count_dataframe['geocoded_count'] = [self.geocoded_count_dict.get(key, 0) for key in key_vals]
+        count_dataframe['all_count'] = [self.all_count_dict.get(key, 0) for key in key_vals]
+        return count_dataframe
+
+
+class OpenSpaceAggregator(object):
+    """
+    Find the geocoded tweets posted in the open space of a city
+    """
+
+    # the text columns are kept in the tweets posted in open space
+    keep_text = True
+
+    def __init__(self, open_space_index: OpenSpaceIndex):
+        """
+        Initialize the aggregator
+        :param open_space_index: the index of the open space of the city, in epsg=4326
+        """
+        self.open_space_index = open_space_index
+        self.dataframe_list = []
+        # The partial aggregates saved in the manifest are only valid for the same open space geometries
+        self.cache_key = 'open_space_{}'.format(open_space_index.geometry_hash)
+
+    def empty_copy(self):
+        """
+        Create an empty aggregator with the same setting
+        :return: an OpenSpaceAggregator
+        """
+        return OpenSpaceAggregator(open_space_index=self.open_space_index)
+
+    def update(self, batch: ScanBatch) -> None:
+        """
+        Find the tweets of one batch posted in open space
+        :param batch: a ScanBatch
+        :return: None
+        """
+        tweets_in_city = batch.get_view('geocoded_with_bots')
+        if tweets_in_city.shape[0] == 0:
+            return
+        self.dataframe_list.append(self.open_space_index.find_tweets_in_open_space(tweets_in_city))
+
+    def get_partial(self) -> list:
+        """
+        Get the partial aggregate, which can be pickled and merged by another aggregator
+        :return: a list of geopandas dataframes saving the tweets posted in open space
+        """
+        return list(self.dataframe_list)
+
+    def merge_partial(self, partial: list) -> None:
+        """
+        Merge a partial aggregate, such as the one returned by a worker process
+        :param partial: a partial aggregate returned by get_partial
+        :return: None
+        """
+        self.dataframe_list.extend(partial)
+
+    def to_dataframe(self):
+        """
+        Combine the tweets posted in open space
+        :return: a geopandas dataframe saving the tweets posted in open space. None if no tweet is found
+        """
+        if len(self.dataframe_list) == 0:
+            return None
+        return pd.concat(self.dataframe_list, axis=0)
+
+
+class UserStatsAggregator(object):
+    """
+    Count the geocoded tweets posted by each user in the city and the footprints used by the bot detection.
+    Bot accounts are included
+    """
+
+    keep_text = False
+
+    def __init__(self, decimals: int = footprint_decimals):
+        """
+        Initialize the aggregator
+        :param decimals: the number of decimals of the rounded footprints
+        """
+        self.accumulator = BotStatsAccumulator(decimals=decimals)
+        self.cache_key = 'user_stats_distinct_{}'.format(decimals)
+
+    def empty_copy(self):
+        """
+        Create an empty aggregator with the same setting
+        :return: a UserStatsAggregator
+        """
+        return UserStatsAggregator(decimals=self.accumulator.decimals)
+
+    def update(self, batch: ScanBatch) -> None:
+        """
+        Count the tweets of one batch
+        :param batch: a ScanBatch
+        :return: None
+        """
+        dataframe = batch.get_view('geocoded_with_bots')
+        self.accumulator.add_tweets(dataframe['user_id_str'], dataframe['id_str'], dataframe['lat'], dataframe['lon'])
+
+    def get_partial(self) -> tuple:
+        """
+        Get the partial aggregate, which can be pickled and merged by another aggregator
+        :return: a tuple of the number of tweets posted by each user at each footprint, the uint64 user ids and
+        tweet ids of the distinct pairs, and the set of the pairs which are not integers
+        """
+        footprint_counts, id_pairs, other_id_pairs = self.accumulator.get_partial()
+        return footprint_counts.copy(), id_pairs, set(other_id_pairs)
+
+    def merge_partial(self, partial: tuple) -> None:
+        """
+        Merge a partial aggregate, such as the one returned by a worker process
+        :param partial: a partial aggregate returned by get_partial
+        :return: None
+        """
+        footprint_counts, id_pairs, other_id_pairs = partial
+        self.accumulator.add_counts(footprint_counts, id_pairs, other_id_pairs)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Create the user count dataframe, in the same format as find_bot_accounts.count_user_tweet
+        :return: a pandas dataframe saving the number of tweets and the most common location percent of each user
+        """
+        return self.accumulator.to_dataframe()
+
+
+def scan_shared_tweet_sources(scan_jobs: list, source_jobs: list) -> list:
+    """
+    Compute the partial aggregates of each tweet source for the cities sharing one data directory. Each source is
+    read once and each batch of it is fed to the aggregators of all the cities needing it. If reading or
+    processing a source fails, the batches already counted are discarded and the source is ignored, the same as
+    reading it at once. Used by the worker processes
+    :param scan_jobs: a list of (count_obj, aggregators) tuples, one for each city. Only the settings of the
+    aggregators are used
+    :param source_jobs: a list of (source, job_indices) tuples. The job_indices are the positions of the scan jobs
+    needing the partial aggregates of the source
+    :return: a list of (source, file_stat, job_partials, failed_job_indices) tuples. The file_stat is the os.stat
+    of the source file taken before reading it. The job_partials is a dict mapping each job index to the partial
+    aggregates of the source, in the order of the aggregators of that job. The failed_job_indices is a set saving
+    the jobs for which the source is ignored. Their partial aggregates are empty and should not be saved to the
+    manifests
+    """
+    memory_limits = [count_obj.memory_limit_mb for count_obj, _ in scan_jobs if count_obj.memory_limit_mb is not None]
+    chunksize = get_chunksize(min(memory_limits) if memory_limits else None)
+    # The tweets are read in the compact schema. The text columns are only read if an aggregator keeps them
+    keep_text = any(aggregator.keep_text for _, aggregators in scan_jobs for aggregator in aggregators)
+    usecols = considered_colnames if keep_text else compact_colnames
+    source_partials = []
+    for source, job_indices in source_jobs:
+        print('Coping with the file: {}'.format(source.name))
+        file_stat = os.stat(source.path)
+        job_aggregators = {job_index: [aggregator.empty_copy() for aggregator in scan_jobs[job_index][1]]
+                           for job_index in job_indices}
+        failed_job_indices = set()
+        try:
+            for dataframe in iter_source_chunks(source, usecols=usecols, dtype=dtype_dict, chunksize=chunksize,
+                                                compact=True):
+                for job_index in job_indices:
+                    if job_index in failed_job_indices:
+                        continue
+                    batch = ScanBatch(dataframe, scan_jobs[job_index][0])
+                    try:
+                        for aggregator in job_aggregators[job_index]:
+                            aggregator.update(batch)
+                    except KeyError:
+                        print('The csv file: {} does not have any column names.Ignore'.format(source.name))
+                        failed_job_indices.add(job_index)
+                    except ValueError:
+                        print('ValueError occurs for file: {}. Ignore.'.format(source.name))
+                        failed_job_indices.add(job_index)
+        except KeyError:
+            print('The csv file: {} does not have any column names. Ignore'.format(source.name))
+            failed_job_indices.update(job_indices)
+        except ValueError:
+            print('ValueError occurs for file: {}. Ignore.'.format(source.name))
+            failed_job_indices.update(job_indices)
+        for job_index in failed_job_indices:
+            job_aggregators[job_index] = [aggregator.empty_copy() for aggregator in scan_jobs[job_index][1]]
+        source_partials.append((source, file_stat, {job_index: [aggregator.get_partial() for aggregator in aggregators]
+                                         for job_index, aggregators in job_aggregators.items()},
+                                failed_job_indices))
+    return source_partials
+
+
+class SharedTweetScanner(object):
+    """
+    Read each hourly file once for several cities sharing the same data directory, such as a city and the
+    metropolitan area around it, and feed the tweets to the aggregators of each city
+    """
+
+    def __init__(self, scan_jobs: list):
+        """
+        Initialize the scanner
+        :param scan_jobs: a list of (count_obj, aggregators, manifest) tuples, one for each city. Each aggregator
+        has the update(batch), get_partial() and merge_partial(partial) methods. If the manifest is given, the
+        saved partial aggregates of the city are reused. All the count objects should read the same files
+        """
+        source_settings = {(count_obj.city_loc, count_obj.parquet_path, tuple(count_obj.considered_year_list))
+                           for count_obj, _, _ in scan_jobs}
+        assert len(source_settings) == 1, 'The cities scanned together should share the same tweet files!'
+        self.scan_jobs = scan_jobs
+
+    def scan(self, workers: int = 1) -> list:
+        """
+        Scan the tweets posted in the cities
+        :param workers: the number of worker processes. If workers > 1, the hourly files are split into batches
+        and each worker process returns the partial aggregates of the files in a batch. The partials are always
+        merged in the order of the files, giving the same result as the serial scan
+        :return: a list saving the aggregators of each city, which have been updated by all the hourly files
+        """
+        first_count_obj = self.scan_jobs[0][0]
+        sources = list_tweet_sources(first_count_obj.city_loc, first_count_obj.considered_year_list,
+                                     parquet_path=first_count_obj.parquet_path)
+        job_cache_keys = [[aggregator.cache_key for aggregator in aggregators] for _, aggregators, _ in self.scan_jobs]
+        job_partials_dicts = [{} for _ in self.scan_jobs]
+        for job_index, (_, _, manifest) in enumerate(self.scan_jobs):
+            if manifest is None:
+                continue
+            manifest.keep_only({(source.path, source.row_group) for source in sources})
+            for source in sources:
+                partials = manifest.get_partials(source.path, job_cache_keys[job_index], row_group=source.row_group)
+                if partials is not None:
+                    job_partials_dicts[job_index][source] = partials
+        # A source is read if any city still needs its partial aggregates
+        source_jobs = []
+        for source in sources:
+            job_indices = [job_index for job_index, partials_dict in enumerate(job_partials_dicts)
+                           if source not in partials_dict]
+            if len(job_indices) > 0:
+                source_jobs.append((source, job_indices))
+        print('{} files to process, {} files reused'.format(len(source_jobs), len(sources) - len(source_jobs)))
+
+        # The partials are merged as soon as they are returned, in the order of the files. Only the partials of
+        # the files which have not been merged are kept in memory
+        job_settings = [(count_obj, aggregators) for count_obj, aggregators, _ in self.scan_jobs]
+        new_source_partials = self.iter_source_partials(job_settings, source_jobs, workers=workers)
+        read_sources = {source for source, _ in source_jobs}
+        try:
+            for source in sources:
+                file_stat, new_job_partials, failed_job_indices = None, {}, set()
+                if source in read_sources:
+                    read_source, file_stat, new_job_partials, failed_job_indices = next(new_source_partials)
+                    assert read_source == source, 'The partials should be returned in the order of the files!'
+                for job_index, (_, aggregators, manifest) in enumerate(self.scan_jobs):
+                    if job_index in new_job_partials:
+                        partials = new_job_partials[job_index]
+                        # The ignored sources are read again by the next run
+                        if manifest is not None and job_index not in failed_job_indices:
+                            manifest.set_partials(source.path, file_stat, job_cache_keys[job_index], partials,
+                                                  row_group=source.row_group)
+                    else:
+                        partials = job_partials_dicts[job_index].pop(source)
+                    for aggregator, partial in zip(aggregators, partials):
+                        aggregator.merge_partial(partial)
+        finally:
+            new_source_partials.close()
+        return [aggregators for _, aggregators, _ in self.scan_jobs]
+
+    @staticmethod
+    def iter_source_partials(job_settings: list, source_jobs: list, workers: int = 1):
+        """
+        Compute the partial aggregates of the sources needing to be read
+        :param job_settings: a list of (count_obj, aggregators) tuples, one for each city
+        :param source_jobs: a list of (source, job_indices) tuples, in the order of the files
+        :param workers: the number of worker processes. If workers > 1, the sources are split into batches and
+        each worker process returns the partial aggregates of the sources in a batch
+        :return: a generator of (source, file_stat, job_partials, failed_job_indices) tuples, in the order of
+        source_jobs
+        """
+        if workers <= 1 or len(source_jobs) <= 1:
+            for source_job in source_jobs:
+                yield from scan_shared_tweet_sources(job_settings, [source_job])
+            return
+        source_batches = split_into_batches(source_jobs, batch_num=workers * batches_per_worker)
+        print('Scanning {} files with {} worker processes...'.format(len(source_jobs), workers))
+        pool = mp.Pool(processes=workers)
+        try:
+            # imap returns the batches in order, and each batch is released once its partials are merged
+            for batch_partials in pool.imap(functools.partial(scan_shared_tweet_sources, job_settings), source_batches):
+                yield from batch_partials
+        finally:
+            pool.close()
+            pool.join()
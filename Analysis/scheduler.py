@@ -0,0 +1,286 @@
+# encoding = 'utf-8'
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+
+from cities_bounds import cities_dict_foreign, cities_dict_china, open_space_saving_path
+from data_paths import raster_save_path
+from utils import group_cities_by_data_loc
+from spatial_analysis import main_foreign, main_china
+from count_tweets import main_count_tweets
+from count_weibos import main_count_weibos
+from extract_raster import main_foreign_raster, main_china_raster
+
+# The memory (MB) reserved for each stage of one city. Used to limit the number of concurrent tasks, and passed to
+# the stage functions reading the hourly files in chunks as their memory ceiling
+stage_memory_mb = {'open_space': 8000, 'count': 6000, 'raster': 3000}
+
+# The default memory budget (MB) shared by all the running tasks
+default_memory_budget_mb = 64000
+
+# The status of a task
+pending_status, running_status, done_status = 'pending', 'running', 'done'
+failed_status, skipped_status = 'failed', 'skipped'
+
+
+def run_task_function(function, kwargs: dict) -> None:
+    """
+    Run the function of a task in a worker process. The traceback is returned in the exception message
+    so that it can be recorded by the scheduler
+    :param function: a module level function, such as main_count_tweets
+    :param kwargs: the keyword arguments of the function
+    :return: None
+    """
+    try:
+        function(**kwargs)
+    except Exception:
+        raise RuntimeError(traceback.format_exc())
+
+
+class CityTask(object):
+    """
+    One stage of one city, such as counting the tweets posted in hong_kong
+    """
+
+    def __init__(self, city: str, stage: str, function, kwargs: dict, depends_on: list, memory_mb: int):
+        """
+        Initialize the task
+        :param city: the name of the city
+        :param stage: the name of the stage, such as 'open_space', 'count' or 'raster'
+        :param function: the module level function run by this task
+        :param kwargs: the keyword arguments of the function
+        :param depends_on: a list of (city, stage) tuples which should be done before this task starts
+        :param memory_mb: the estimated peak memory (MB) of this task
+        """
+        self.city = city
+        self.stage = stage
+        self.function = function
+        self.kwargs = kwargs
+        self.depends_on = depends_on
+        self.memory_mb = memory_mb
+        self.status = pending_status
+        self.start_time = None
+        self.end_time = None
+        self.error = ''
+
+    @property
+    def key(self) -> tuple:
+        return self.city, self.stage
+
+
+class CityJobScheduler(object):
+    """
+    Run the city x stage tasks with a pool of worker processes. A task starts when its dependencies are done and
+    the estimated memory of the running tasks stays within the memory budget
+    """
+
+    def __init__(self, max_workers: int = 4, memory_budget_mb: int = default_memory_budget_mb,
+                 status_path: str = None):
+        """
+        Initialize the scheduler
+        :param max_workers: the maximum number of tasks running at the same time
+        :param memory_budget_mb: the memory budget (MB) shared by the running tasks. A task whose estimated
+        memory exceeds the budget still runs, but only when no other task is running
+        :param status_path: the csv file used to save the status of the tasks. None means not saving
+        """
+        self.max_workers = max_workers
+        self.memory_budget_mb = memory_budget_mb
+        self.status_path = status_path
+        self.tasks = OrderedDict()
+
+    def add_task(self, city: str, stage: str, function, kwargs: dict, depends_on: list = None,
+                 memory_mb: int = None) -> CityTask:
+        """
+        Add a task to the scheduler
+        :param city: the name of the city
+        :param stage: the name of the stage
+        :param function: the module level function run by this task
+        :param kwargs: the keyword arguments of the function
+        :param depends_on: a list of (city, stage) tuples which should be done before this task starts
+        :param memory_mb: the estimated peak memory (MB) of this task. Use stage_memory_mb if not given
+        :return: the added task
+        """
+        if depends_on is None:
+            depends_on = []
+        if memory_mb is None:
+            memory_mb = stage_memory_mb.get(stage, 0)
+        for dependency in depends_on:
+            assert dependency in self.tasks, 'The dependency {} should be added first'.format(dependency)
+        task = CityTask(city=city, stage=stage, function=function, kwargs=kwargs, depends_on=depends_on,
+                        memory_mb=memory_mb)
+        self.tasks[task.key] = task
+        return task
+
+    def get_ready_tasks(self) -> list:
+        """
+        Get the pending tasks whose dependencies are all done. The pending tasks depending on a failed or
+        skipped task are marked as skipped
+        :return: a list of tasks which can start now
+        """
+        ready_tasks = []
+        for task in self.tasks.values():
+            if task.status != pending_status:
+                continue
+            dependency_status = [self.tasks[dependency].status for dependency in task.depends_on]
+            if any(status in (failed_status, skipped_status) for status in dependency_status):
+                task.status = skipped_status
+                task.error = 'Dependency not done'
+                print('Skip the task {}: a dependency is not done'.format(task.key))
+            elif all(status == done_status for status in dependency_status):
+                ready_tasks.append(task)
+        return ready_tasks
+
+    def run(self) -> pd.DataFrame:
+        """
+        Run all the tasks
+        :return: a pandas dataframe saving the status of each task
+        """
+        running = {}
+        memory_in_use = 0
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                for task in self.get_ready_tasks():
+                    if len(running) >= self.max_workers:
+                        break
+                    if running and memory_in_use + task.memory_mb > self.memory_budget_mb:
+                        continue
+                    task.status = running_status
+                    task.start_time = time.time()
+                    memory_in_use += task.memory_mb
+                    print('Start the task {} (estimated memory: {} MB, in use: {} MB)'.format(
+                        task.key, task.memory_mb, memory_in_use))
+                    running[executor.submit(run_task_function, task.function, task.kwargs)] = task
+                if not running:
+                    break
+                finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    memory_in_use -= task.memory_mb
+                    task.end_time = time.time()
+                    try:
+                        future.result()
+                        task.status = done_status
+                        print('The task {} is done in {:.1f} seconds'.format(
+                            task.key, task.end_time - task.start_time))
+                    except Exception as error:
+                        task.status = failed_status
+                        task.error = str(error)
+                        print('The task {} failed: {}'.format(task.key, task.error))
+                self.save_status()
+        # Tasks never started, e.g., the dependencies are not in this scheduler
+        for task in self.tasks.values():
+            if task.status == pending_status:
+                task.status = skipped_status
+        self.save_status()
+        return self.get_status_dataframe()
+
+    def get_status_dataframe(self) -> pd.DataFrame:
+        """
+        Get the status of each task
+        :return: a pandas dataframe saving the city, stage, status, running time and error of each task
+        """
+        status_dataframe = pd.DataFrame(columns=['city', 'stage', 'status', 'seconds', 'error'])
+        status_dataframe['city'] = [task.city for task in self.tasks.values()]
+        status_dataframe['stage'] = [task.stage for task in self.tasks.values()]
+        status_dataframe['status'] = [task.status for task in self.tasks.values()]
+        status_dataframe['seconds'] = [task.end_time - task.start_time if task.end_time is not None else None
+                                       for task in self.tasks.values()]
+        status_dataframe['error'] = [task.error for task in self.tasks.values()]
+        return status_dataframe
+
+    def save_status(self) -> None:
+        """
+        Save the status of each task to the local directory
+        :return: None
+        """
+        if self.status_path is not None:
+            self.get_status_dataframe().to_csv(self.status_path, encoding='utf-8')
+
+
+def schedule_foreign_cities(considered_cities: set, cities_profile: dict = cities_dict_foreign,
+                            max_workers: int = 4, memory_budget_mb: int = default_memory_budget_mb,
+                            count_in_utc: bool = True, save_threshold: int = 30000,
+                            status_path: str = None) -> CityJobScheduler:
+    """
+    Create the scheduler finding the tweets posted in open space, counting the tweets and computing the raster
+    values for the foreign cities. The three stages of one city run in this order. The cities sharing one data
+    directory are found and counted by the same tasks
+    :param considered_cities: a python set saving the name of the cities you want to process
+    :param cities_profile: a python dictionary saving the profile of each city
+    :param max_workers: the maximum number of tasks running at the same time
+    :param memory_budget_mb: the memory budget (MB) shared by the running tasks
+    :param count_in_utc: count the tweets in UTC time or not
+    :param save_threshold: a threshold that let the program save the tweets posted in open space
+    :param status_path: the csv file used to save the status of the tasks
+    :return: a CityJobScheduler. Call its run method to process the cities
+    """
+    scheduler = CityJobScheduler(max_workers=max_workers, memory_budget_mb=memory_budget_mb,
+                                 status_path=status_path)
+    # The cities sharing one data directory share the open space and count tasks, so that their tweet files are
+    # read once. The raster task is still run for each city
+    for city_group in group_cities_by_data_loc(considered_cities, cities_profile):
+        group_name = '+'.join(city_group)
+        open_space_memory_mb = stage_memory_mb['open_space'] * len(city_group)
+        count_memory_mb = stage_memory_mb['count'] * len(city_group)
+        # The reserved memory is enforced by reading the hourly files chunk by chunk under it
+        scheduler.add_task(group_name, 'open_space', main_foreign,
+                           kwargs=dict(considered_cities=set(city_group), cities_profile=cities_profile,
+                                       save_threshold=save_threshold,
+                                       open_space_save_path=open_space_saving_path,
+                                       memory_limit_mb=open_space_memory_mb),
+                           memory_mb=open_space_memory_mb)
+        scheduler.add_task(group_name, 'count', main_count_tweets,
+                           kwargs=dict(count_in_utc=count_in_utc, considered_city_names=set(city_group),
+                                       cities_profile=cities_profile, memory_limit_mb=count_memory_mb),
+                           depends_on=[(group_name, 'open_space')],
+                           memory_mb=count_memory_mb)
+        for city in city_group:
+            scheduler.add_task(city, 'raster', main_foreign_raster,
+                               kwargs=dict(save_path=raster_save_path, considered_cities={city},
+                                           city_profile=cities_profile),
+                               depends_on=[(group_name, 'count')])
+    return scheduler
+
+
+def schedule_china_cities(considered_cities: set, cities_profile: dict = cities_dict_china,
+                          max_workers: int = 4, memory_budget_mb: int = default_memory_budget_mb,
+                          count_in_utc: bool = True, save_threshold: int = 30000,
+                          status_path: str = None) -> CityJobScheduler:
+    """
+    Create the scheduler finding the Weibos posted in open space, counting the Weibos and computing the raster
+    values for the Chinese cities. The three stages of one city run in this order
+    :param considered_cities: a python set saving the name of the cities you want to process
+    :param cities_profile: a python dictionary saving the profile of each city
+    :param max_workers: the maximum number of tasks running at the same time
+    :param memory_budget_mb: the memory budget (MB) shared by the running tasks
+    :param count_in_utc: count the Weibos in UTC time or not
+    :param save_threshold: a threshold that let the program save the Weibos posted in open space
+    :param status_path: the csv file used to save the status of the tasks
+    :return: a CityJobScheduler. Call its run method to process the cities
+    """
+    scheduler = CityJobScheduler(max_workers=max_workers, memory_budget_mb=memory_budget_mb,
+                                 status_path=status_path)
+    for city in cities_profile:
+        if city not in considered_cities:
+            continue
+        scheduler.add_task(city, 'open_space', main_china,
+                           kwargs=dict(considered_cities={city}, cities_profile=cities_profile,
+                                       save_threshold=save_threshold,
+                                       open_space_save_path=open_space_saving_path))
+        scheduler.add_task(city, 'count', main_count_weibos,
+                           kwargs=dict(count_in_utc=count_in_utc, count_cities_mainland={city}),
+                           depends_on=[(city, 'open_space')])
+        scheduler.add_task(city, 'raster', main_china_raster,
+                           kwargs=dict(save_path=raster_save_path, considered_cities={city},
+                                       city_profile=cities_profile),
+                           depends_on=[(city, 'count')])
+    return scheduler
+
+
+if __name__ == '__main__':
+    foreign_scheduler = schedule_foreign_cities(considered_cities={'hong_kong'}, max_workers=4,
+                                                status_path=os.path.join(os.getcwd(), 'foreign_task_status.csv'))
+    print(foreign_scheduler.run())
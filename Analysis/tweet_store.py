@@ -0,0 +1,471 @@
+# encoding = 'utf-8'
+import os
+import json
+from collections import namedtuple, defaultdict
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cities_bounds import happyplaces_parquet_path, cities_dict_foreign
+from utils import column_dtype_dict, sanitize_coordinates
+from id_index import create_id_index, save_id_index, load_id_index, update_csv_id_index
+
+# Used column names and data types when reading the raw csv files
+considered_colnames = list(column_dtype_dict.keys())
+dtype_dict = {'user_id_str': str, 'id_str': str, 'text': str,
+              'created_at': str, 'verified': str, 'lang': str, 'url': str}
+
+# The typed schema of the parquet mirror. Coordinates are saved as float64 so that readers never
+# need to cope with the bad latitude and longitude strings again
+parquet_schema = pa.schema([('user_id_str', pa.string()), ('id_str', pa.string()), ('text', pa.string()),
+                            ('created_at', pa.string()), ('lat', pa.float64()), ('lon', pa.float64()),
+                            ('place_lat', pa.float64()), ('place_lon', pa.float64()),
+                            ('verified', pa.string()), ('lang', pa.string()), ('url', pa.string())])
+partition_filename = 'tweets.parquet'
+# The csv files converted to a partition are recorded next to it
+sources_filename = 'sources.json'
+# The id index mapping the tweet ids and user ids to the row groups of a partition is saved next to it
+partition_id_index_filename = 'id_index.pkl'
+
+# The compact in-memory schema of the tweets and Weibos: the ids are int64, the users and languages are
+# categorical, verified is boolean and the coordinates are float64. The text columns are only read by the stages
+# saving the tweets themselves
+text_colnames = ['text', 'url']
+compact_colnames = [colname for colname in considered_colnames if colname not in text_colnames]
+coordinate_colname_pairs = [('lat', 'lon'), ('place_lat', 'place_lon')]
+categorical_colnames = ['user_id_str', 'lang']
+# The Weibo columns mapped onto the tweet schema
+weibo_rename_dict = {'latitude': 'lat', 'longitude': 'lon', 'weibo_id': 'id_str', 'author_id': 'user_id_str'}
+max_int64_string = str(np.iinfo(np.int64).max)
+
+# The estimated memory (bytes) taken by one tweet row in a pandas dataframe. Used to turn a memory ceiling
+# into the number of rows read at a time
+estimated_row_bytes = 4096
+
+# A tweet source is either a raw csv file (row_group is None) or one row group of a parquet partition.
+# Each row group of a partition is converted from exactly one raw csv file, whose name is saved in name
+TweetSource = namedtuple('TweetSource', ['path', 'row_group', 'name'])
+
+
+def get_csv_file_month(csv_file: str) -> int:
+    """
+    Get the month of an hourly csv file based on its filename
+    :param csv_file: the name of the hourly csv file, such as HongKong_2018050112.csv
+    :return: the month of the file. 0 is returned if the filename does not contain the month information
+    """
+    try:
+        month = int(csv_file[-12:-10])
+    except ValueError:
+        return 0
+    return month if 1 <= month <= 12 else 0
+
+
+def get_parquet_city_path(data_loc: str, parquet_path: str = happyplaces_parquet_path) -> str:
+    """
+    Get the path saving the parquet partitions of one raw data directory
+    :param data_loc: the raw data directory of a city, such as happyplaces_path/HongKong
+    :param parquet_path: the root path of the parquet mirror
+    :return: the path saving the parquet partitions of this data directory
+    """
+    return os.path.join(parquet_path, os.path.basename(os.path.normpath(data_loc)))
+
+
+def read_raw_csv(csv_file_path: str, usecols: list = None, dtype: dict = None) -> pd.DataFrame:
+    """
+    Read a raw hourly csv file, ignoring the characters which could not be decoded
+    :param csv_file_path: the full path to the csv file
+    :param usecols: the considered columns
+    :param dtype: the datatype of the considered columns
+    :return: a pandas dataframe saving the tweets
+    """
+    if usecols is None:
+        usecols = considered_colnames
+    if dtype is None:
+        dtype = dtype_dict
+    with open(csv_file_path, encoding='utf-8', errors='ignore') as csv_file:
+        dataframe = pd.read_csv(csv_file, usecols=usecols, dtype=dtype)
+    return dataframe
+
+
+def get_chunksize(memory_limit_mb: float = None):
+    """
+    Get the number of rows read at a time under a memory ceiling
+    :param memory_limit_mb: the memory ceiling (MB) of one chunk. None means reading each file at once
+    :return: the number of rows of one chunk. None if memory_limit_mb is None
+    """
+    if memory_limit_mb is None:
+        return None
+    return max(1, int(memory_limit_mb * 1024 * 1024 / estimated_row_bytes))
+
+
+def to_parquet_table(dataframe: pd.DataFrame) -> pa.Table:
+    """
+    Convert a raw tweet dataframe to a pyarrow table following the parquet schema
+    :param dataframe: a tweet dataframe read from a raw csv file
+    :return: a pyarrow table
+    """
+    for lat_colname, lon_colname in coordinate_colname_pairs:
+        dataframe = sanitize_coordinates(dataframe, lat_colname=lat_colname, lon_colname=lon_colname,
+                                         drop_invalid=False)
+    dataframe_typed = pd.DataFrame(index=dataframe.index)
+    for field in parquet_schema:
+        if pa.types.is_floating(field.type):
+            # Bad latitude and longitude strings are saved as NaN
+            dataframe_typed[field.name] = pd.to_numeric(dataframe[field.name], errors='coerce')
+        else:
+            dataframe_typed[field.name] = dataframe[field.name].astype(object).where(
+                ~dataframe[field.name].isnull(), None)
+    return pa.Table.from_pandas(dataframe_typed, schema=parquet_schema, preserve_index=False)
+
+
+def to_compact_dataframe(dataframe: pd.DataFrame, keep_text: bool = False) -> pd.DataFrame:
+    """
+    Convert a tweet or Weibo dataframe to the compact schema. The Weibo columns are renamed first. The rows
+    whose id is not an integer are dropped and the bad or out of range coordinates are saved as NaN
+    :param dataframe: a tweet dataframe read from a raw csv file or a parquet partition, or a Weibo dataframe
+    :param keep_text: keep the text columns or not
+    :return: a pandas dataframe following the compact schema
+    """
+    compact_dataframe = dataframe.rename(columns=weibo_rename_dict)
+    if not keep_text:
+        compact_dataframe = compact_dataframe.drop(
+            columns=[colname for colname in text_colnames if colname in compact_dataframe])
+    if 'id_str' in compact_dataframe:
+        id_strings = compact_dataframe['id_str'].astype(str).str.strip()
+        valid_id = id_strings.str.fullmatch(r'\d{1,19}') & (
+            (id_strings.str.len() < len(max_int64_string)) | (id_strings <= max_int64_string))
+        compact_dataframe = compact_dataframe.loc[valid_id.values].copy()
+        compact_dataframe['id_str'] = id_strings.loc[valid_id.values].astype(np.int64).values
+    for lat_colname, lon_colname in coordinate_colname_pairs:
+        if (lat_colname in compact_dataframe) and (lon_colname in compact_dataframe):
+            compact_dataframe = sanitize_coordinates(compact_dataframe, lat_colname=lat_colname,
+                                                     lon_colname=lon_colname, drop_invalid=False)
+    for colname in categorical_colnames:
+        if colname in compact_dataframe:
+            compact_dataframe[colname] = compact_dataframe[colname].astype('category')
+    if 'verified' in compact_dataframe:
+        compact_dataframe['verified'] = compact_dataframe['verified'].astype(str).str.lower().isin(['true', 't'])
+    return compact_dataframe
+
+
+def write_month_partition(csv_entries: list, partition_file: str, compression: str = 'zstd') -> int:
+    """
+    Write the tweets saved in the hourly csv files of one month to a parquet partition. Each csv file is
+    saved as one row group. The id index of the partition is written at the same time
+    :param csv_entries: a list of (csv file path, size, mtime) tuples sorted by the filename
+    :param partition_file: the path of the parquet partition
+    :param compression: the compression codec
+    :return: the number of tweets written to the partition
+    """
+    source_files = []
+    tweet_num = 0
+    row_groups, id_values_dict = [], {'message': [], 'user': []}
+    os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+    temporary_file = partition_file + '.tmp'
+    with pq.ParquetWriter(temporary_file, schema=parquet_schema, compression=compression) as writer:
+        row_group = 0
+        for csv_file_path, size, mtime in csv_entries:
+            csv_file = os.path.basename(csv_file_path)
+            try:
+                dataframe = read_raw_csv(csv_file_path)
+            except KeyError:
+                print('The csv file: {} does not have any column names. Ignore'.format(csv_file))
+                dataframe = None
+            except ValueError:
+                print('ValueError occurs for file: {}. Ignore.'.format(csv_file))
+                dataframe = None
+            except pd.errors.ParserError:
+                print('Parser error occurred in file: {}. Ignore.'.format(csv_file))
+                dataframe = None
+            if (dataframe is None) or (dataframe.shape[0] == 0):
+                source_files.append([csv_file, size, mtime, -1])
+                continue
+            writer.write_table(to_parquet_table(dataframe), row_group_size=dataframe.shape[0])
+            source_files.append([csv_file, size, mtime, row_group])
+            row_groups.append(row_group)
+            id_values_dict['message'].append(dataframe['id_str'].values)
+            id_values_dict['user'].append(dataframe['user_id_str'].values)
+            row_group += 1
+            tweet_num += dataframe.shape[0]
+    os.replace(temporary_file, partition_file)
+    with open(os.path.join(os.path.dirname(partition_file), sources_filename), 'w', encoding='utf-8') as sources_file:
+        json.dump(source_files, sources_file)
+    save_id_index(create_id_index(row_groups, id_values_dict),
+                  os.path.join(os.path.dirname(partition_file), partition_id_index_filename))
+    return tweet_num
+
+
+def read_partition_sources(partition_file: str) -> list:
+    """
+    Read the source csv files recorded in a parquet partition
+    :param partition_file: the path of the parquet partition
+    :return: a list of [csv filename, size, mtime, row group] lists. The row group is -1 if the csv file is empty
+    """
+    sources_file_path = os.path.join(os.path.dirname(partition_file), sources_filename)
+    if not os.path.exists(sources_file_path):
+        return []
+    with open(sources_file_path, encoding='utf-8') as sources_file:
+        return json.load(sources_file)
+
+
+def convert_city_to_parquet(data_loc: str, considered_year_list: list,
+                            parquet_path: str = happyplaces_parquet_path, compression: str = 'zstd') -> None:
+    """
+    Convert the hourly csv files of one data directory to a parquet dataset partitioned by year and month.
+    Only the month partitions whose csv files are new or modified are rewritten, so this function can be
+    called again to refresh the dataset incrementally
+    :param data_loc: the raw data directory of a city, such as happyplaces_path/HongKong
+    :param considered_year_list: a list of considered years, such as ['2016', '2017']
+    :param parquet_path: the root path of the parquet mirror
+    :param compression: the compression codec
+    :return: None. The parquet partitions are saved to parquet_path/<city>/year=<year>/month=<month>
+    """
+    city_parquet_path = get_parquet_city_path(data_loc, parquet_path)
+    for year in considered_year_list:
+        csv_path = os.path.join(data_loc, year)
+        if not os.path.exists(csv_path):
+            print('There is no {} folder in local'.format(str(year)))
+            continue
+        month_entries = defaultdict(list)
+        for csv_file in sorted(os.listdir(csv_path)):
+            if not csv_file.endswith('.csv'):
+                continue
+            file_stat = os.stat(os.path.join(csv_path, csv_file))
+            month_entries[get_csv_file_month(csv_file)].append(
+                (os.path.join(csv_path, csv_file), file_stat.st_size, file_stat.st_mtime))
+        for month in sorted(month_entries):
+            partition_file = os.path.join(city_parquet_path, 'year={}'.format(year),
+                                          'month={:02d}'.format(month), partition_filename)
+            csv_records = [[os.path.basename(path), size, mtime] for path, size, mtime in month_entries[month]]
+            if os.path.exists(partition_file):
+                saved_records = [record[:3] for record in read_partition_sources(partition_file)]
+                if saved_records == csv_records:
+                    print('The partition {}-{:02d} is up to date'.format(year, month))
+                    continue
+            print('Converting the tweets posted in {}-{:02d}...'.format(year, month))
+            tweet_num = write_month_partition(month_entries[month], partition_file, compression=compression)
+            print('Done! {} tweets are saved to {}'.format(tweet_num, partition_file))
+
+
+def list_tweet_sources(data_loc: str, considered_year_list: list,
+                       parquet_path: str = happyplaces_parquet_path) -> list:
+    """
+    List the tweet sources of a data directory. The parquet partitions are used for the years which have
+    been converted. Otherwise, the raw csv files are used
+    :param data_loc: the raw data directory of a city, such as happyplaces_path/HongKong
+    :param considered_year_list: a list of considered years, such as ['2016', '2017']
+    :param parquet_path: the root path of the parquet mirror. Set it to None to always read the csv files
+    :return: a list of TweetSource
+    """
+    sources = []
+    for year in considered_year_list:
+        year_parquet_path = None
+        if parquet_path is not None:
+            year_parquet_path = os.path.join(get_parquet_city_path(data_loc, parquet_path), 'year={}'.format(year))
+        if (year_parquet_path is not None) and os.path.exists(year_parquet_path):
+            for month_folder in sorted(os.listdir(year_parquet_path)):
+                partition_file = os.path.join(year_parquet_path, month_folder, partition_filename)
+                if not os.path.exists(partition_file):
+                    continue
+                for csv_file, _, _, row_group in read_partition_sources(partition_file):
+                    if row_group >= 0:
+                        sources.append(TweetSource(path=partition_file, row_group=row_group, name=csv_file))
+        else:
+            csv_path = os.path.join(data_loc, year)
+            try:
+                for csv_file in os.listdir(csv_path):
+                    sources.append(TweetSource(path=os.path.join(csv_path, csv_file), row_group=None,
+                                               name=csv_file))
+            except FileNotFoundError:
+                print('There is no {} folder in local'.format(str(year)))
+    return sources
+
+
+def find_id_sources(data_loc: str, considered_year_list: list, id_values, id_type: str = 'message',
+                    parquet_path: str = happyplaces_parquet_path) -> list:
+    """
+    Find the tweet sources saving the given tweet ids or user ids with the id indexes, instead of reading all the
+    tweets. The id index of each parquet partition is written by write_month_partition. For the years which have
+    not been converted, the id index of the csv files is updated with the new or modified files first
+    :param data_loc: the raw data directory of a city, such as happyplaces_path/HongKong
+    :param considered_year_list: a list of considered years, such as ['2016', '2017']
+    :param id_values: the ids, such as a python set of tweet ids
+    :param id_type: 'message' for the tweet ids or 'user' for the user ids
+    :param parquet_path: the root path of the parquet mirror. Set it to None to always read the csv files
+    :return: a list of TweetSource
+    """
+    sources = []
+    for year in considered_year_list:
+        year_parquet_path = None
+        if parquet_path is not None:
+            year_parquet_path = os.path.join(get_parquet_city_path(data_loc, parquet_path), 'year={}'.format(year))
+        if (year_parquet_path is not None) and os.path.exists(year_parquet_path):
+            for month_folder in sorted(os.listdir(year_parquet_path)):
+                partition_file = os.path.join(year_parquet_path, month_folder, partition_filename)
+                if not os.path.exists(partition_file):
+                    continue
+                index_file = os.path.join(year_parquet_path, month_folder, partition_id_index_filename)
+                found_row_groups = None
+                if os.path.exists(index_file):
+                    found_row_groups = set(load_id_index(index_file).find_sources(id_values, id_type=id_type))
+                else:
+                    print('The partition {} does not have an id index. Read all its row groups'.format(partition_file))
+                for csv_file, _, _, row_group in read_partition_sources(partition_file):
+                    if row_group >= 0 and (found_row_groups is None or row_group in found_row_groups):
+                        sources.append(TweetSource(path=partition_file, row_group=row_group, name=csv_file))
+        else:
+            csv_path = os.path.join(data_loc, year)
+            if not os.path.exists(csv_path):
+                print('There is no {} folder in local'.format(str(year)))
+                continue
+            for csv_file, _, _ in update_csv_id_index(csv_path).find_sources(id_values, id_type=id_type):
+                sources.append(TweetSource(path=os.path.join(csv_path, csv_file), row_group=None, name=csv_file))
+    return sources
+
+
+def read_tweet_source(source: TweetSource, usecols: list = None, dtype: dict = None) -> pd.DataFrame:
+    """
+    Read the tweets saved in one tweet source
+    :param source: a TweetSource
+    :param usecols: the considered columns. Only these columns are read from the parquet partitions
+    :param dtype: the datatype of the considered columns. Only used for the csv files
+    :return: a pandas dataframe saving the tweets
+    """
+    if usecols is None:
+        usecols = considered_colnames
+    if source.row_group is None:
+        return read_raw_csv(source.path, usecols=usecols, dtype=dtype)
+    parquet_file = pq.ParquetFile(source.path)
+    return parquet_file.read_row_group(source.row_group, columns=list(usecols)).to_pandas()
+
+
+def read_tweet_source_chunks(source: TweetSource, chunksize: int, usecols: list = None, dtype: dict = None):
+    """
+    Read the tweets saved in one tweet source chunk by chunk
+    :param source: a TweetSource
+    :param chunksize: the number of rows of one chunk
+    :param usecols: the considered columns
+    :param dtype: the datatype of the considered columns. Only used for the csv files
+    :return: a generator of pandas dataframes, each saving at most chunksize tweets
+    """
+    if usecols is None:
+        usecols = considered_colnames
+    if source.row_group is None:
+        if dtype is None:
+            dtype = dtype_dict
+        with open(source.path, encoding='utf-8', errors='ignore') as csv_file:
+            for chunk in pd.read_csv(csv_file, usecols=usecols, dtype=dtype, chunksize=chunksize):
+                yield chunk
+    else:
+        parquet_file = pq.ParquetFile(source.path)
+        for record_batch in parquet_file.iter_batches(batch_size=chunksize, row_groups=[source.row_group],
+                                                      columns=list(usecols)):
+            yield record_batch.to_pandas()
+
+
+def iter_source_chunks(source: TweetSource, usecols: list = None, dtype: dict = None, chunksize: int = None,
+                       compact: bool = False):
+    """
+    Iterate over the tweet dataframes saved in one tweet source. In the streaming mode (chunksize is not None),
+    the source is read chunk by chunk and the tweets whose id_str has been seen in the previous chunks are dropped.
+    The errors of reading the source are raised, so the caller can discard the chunks it has got
+    :param source: a TweetSource
+    :param usecols: the considered columns
+    :param dtype: the datatype of the considered columns. Only used for the csv files
+    :param chunksize: the number of rows of one chunk. None means reading the source at once
+    :param compact: convert the dataframes to the compact schema or not. The text columns are kept only if
+    they are in usecols
+    :return: a generator of tweet dataframes
+    """
+    if chunksize is None:
+        dataframe = read_tweet_source(source, usecols=usecols, dtype=dtype)
+        yield to_compact_dataframe(dataframe, keep_text=True) if compact else dataframe
+        return
+    seen_id_set = set()
+    for chunk in read_tweet_source_chunks(source, chunksize=chunksize, usecols=usecols, dtype=dtype):
+        if compact:
+            chunk = to_compact_dataframe(chunk, keep_text=True)
+        if 'id_str' in chunk:
+            chunk = chunk.loc[~chunk['id_str'].isin(seen_id_set)]
+            seen_id_set.update(chunk['id_str'])
+        yield chunk
+
+
+def iter_source_dataframes(sources: list, usecols: list = None, dtype: dict = None, chunksize: int = None,
+                           compact: bool = False):
+    """
+    Iterate over the tweet dataframes saved in a list of tweet sources, one dataframe for each hourly file.
+    In the streaming mode (chunksize is not None), each hourly file is read chunk by chunk and the tweets whose
+    id_str has been seen in the previous chunks of the same file are dropped. If reading a file fails, the rest
+    of it is ignored
+    :param sources: a list of TweetSource, such as the output of list_tweet_sources
+    :param usecols: the considered columns
+    :param dtype: the datatype of the considered columns. Only used for the csv files
+    :param chunksize: the number of rows of one chunk. None means reading each file at once
+    :param compact: convert the dataframes to the compact schema or not. The text columns are kept only if
+    they are in usecols
+    :return: a generator of (filename, tweet dataframe) tuples
+    """
+    for source in sources:
+        print('Coping with the file: {}'.format(source.name))
+        try:
+            for dataframe in iter_source_chunks(source, usecols=usecols, dtype=dtype, chunksize=chunksize,
+                                                compact=compact):
+                yield source.name, dataframe
+        except KeyError:
+            print('The csv file: {} does not have any column names. Ignore'.format(source.name))
+            continue
+        except ValueError:
+            print('ValueError occurs for file: {}. Ignore.'.format(source.name))
+            continue
+        except pd.errors.ParserError:
+            print('Parser error occurred in file: {}. Ignore.'.format(source.name))
+            continue
+
+
+def iter_tweet_dataframes(data_loc: str, considered_year_list: list, usecols: list = None, dtype: dict = None,
+                          parquet_path: str = happyplaces_parquet_path, chunksize: int = None,
+                          compact: bool = False):
+    """
+    Iterate over the tweet dataframes saved in a data directory, one dataframe for each hourly file
+    :param data_loc: the raw data directory of a city, such as happyplaces_path/HongKong
+    :param considered_year_list: a list of considered years, such as ['2016', '2017']
+    :param usecols: the considered columns
+    :param dtype: the datatype of the considered columns. Only used for the csv files
+    :param parquet_path: the root path of the parquet mirror. Set it to None to always read the csv files
+    :param chunksize: the number of rows of one chunk. None means reading each file at once. See get_chunksize
+    :param compact: convert the dataframes to the compact schema or not. See to_compact_dataframe
+    :return: a generator of (filename, tweet dataframe) tuples
+    """
+    sources = list_tweet_sources(data_loc, considered_year_list, parquet_path=parquet_path)
+    return iter_source_dataframes(sources, usecols=usecols, dtype=dtype, chunksize=chunksize, compact=compact)
+
+
+def main_convert_parquet(considered_cities: set, cities_profile: dict = cities_dict_foreign,
+                         considered_year_list: list = None) -> None:
+    """
+    Convert the raw csv files of the considered cities to the parquet mirror. The cities sharing the same data
+    directory are only converted once
+    :param considered_cities: a python set saving the name of the cities you want to process
+    :param cities_profile: a python dictionary saving the profile of each city
+    :param considered_year_list: a list of considered years
+    :return: None. The parquet partitions are saved to happyplaces_parquet_path
+    """
+    if considered_year_list is None:
+        considered_year_list = [str(year) for year in range(2016, 2022)]
+    converted_locs = set()
+    for city in cities_profile:
+        if city not in considered_cities:
+            continue
+        data_loc = cities_profile[city][2]
+        if data_loc in converted_locs:
+            print('The data directory of {} has been converted'.format(city))
+            continue
+        print('Converting the tweets saved in {} for {}...'.format(data_loc, city))
+        convert_city_to_parquet(data_loc, considered_year_list=considered_year_list)
+        converted_locs.add(data_loc)
+
+
+if __name__ == '__main__':
+    main_convert_parquet(considered_cities={'hong_kong'})
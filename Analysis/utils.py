@@ -13,6 +13,14 @@ column_dtype_dict = {'user_id_str': str, 'id_str': str, 'text': str,
                      'place_lon': np.float64, 'verified': str, 'lang': str, 'url': str}
 
 
+# The format of the created_at time string of tweets and Weibos, such as 'Wed Oct 10 20:19:24 +0000 2018'
+created_at_format = '%a %b %d %H:%M:%S %z %Y'
+created_at_format_without_offset = '%a %b %d %H:%M:%S %Y'
+
+# The number of file batches handed to each worker process. Smaller batches balance the load between workers
+batches_per_worker = 4
+
+
 def transform_datetime_string_time_to_datetime(string, timezone_info):
     """
     :param string: the string which records the time of the posted tweets(this string's timezone is HK time)
@@ -40,6 +48,43 @@ def transform_string_time_to_datetime(time_string, target_time_zone, convert_utc
     return final_time_object
 	
 	
+def transform_time_string_to_utc_time(time_string):
+    """
+    Transform the string time to the datetime object in UTC time
+    :param time_string: a time string, such as 'Wed Oct 10 20:19:24 +0000 2018'
+    :return: a datetime object in UTC time
+    """
+    return transform_string_time_to_datetime(time_string, target_time_zone=pytz.utc, convert_utc_time=False)
+
+
+def parse_created_at(time_strings: pd.Series, target_time_zone, convert_utc_time=True) -> pd.Series:
+    """
+    Transform the created_at time strings to the datetime objects. A vectorized version of
+    transform_string_time_to_datetime: each distinct time string is only parsed once, which helps a lot as
+    many tweets posted in the same second share the same time string
+    :param time_strings: a pandas series saving the time strings, such as 'Wed Oct 10 20:19:24 +0000 2018'
+    :param target_time_zone: the target time zone
+    :param convert_utc_time: if True, the offset in the time string is ignored and the time is regarded as the
+    UTC time, which is the same as transform_string_time_to_datetime(convert_utc_time=True)
+    :return: a pandas series of datetime64 in the target time zone. The malformed strings are set to NaT
+    """
+    codes, unique_strings = pd.factorize(time_strings)
+    unique_strings = pd.Series(unique_strings, dtype=object)
+    if convert_utc_time:
+        unique_strings = unique_strings.str.replace(r' [+-]\d{4} ', ' ', regex=True)
+        unique_times = pd.to_datetime(unique_strings, format=created_at_format_without_offset,
+                                      errors='coerce').dt.tz_localize(pytz.utc)
+    else:
+        unique_times = pd.to_datetime(unique_strings, format=created_at_format, errors='coerce', utc=True)
+    unique_time_index = pd.DatetimeIndex(unique_times)
+    if unique_time_index.tz is None:
+        unique_time_index = unique_time_index.tz_localize(pytz.utc)  # to_datetime returns naive times for no string
+    unique_time_index = unique_time_index.tz_convert(target_time_zone)
+    # codes is -1 for the missing time strings
+    return pd.Series(unique_time_index.take(codes, allow_fill=True, fill_value=pd.NaT),
+                     index=time_strings.index)
+
+
 def get_time_attributes(dataframe: pd.DataFrame, datetime_obj_colname: str):
     """
     Get the time attributes based on the time object saved in dataframe
@@ -48,13 +93,14 @@ def get_time_attributes(dataframe: pd.DataFrame, datetime_obj_colname: str):
     :return: a dataframe with time attributes for each tweet, including year, month, day, weekday, hour, minute, and second
     """
     dataframe_copy = dataframe.copy()
-    dataframe_copy['year'] = dataframe_copy.apply(lambda row: row[datetime_obj_colname].year, axis=1)
-    dataframe_copy['month'] = dataframe_copy.apply(lambda row: row[datetime_obj_colname].month, axis=1)
-    dataframe_copy['day'] = dataframe_copy.apply(lambda row: row[datetime_obj_colname].day, axis=1)
-    dataframe_copy['weekday'] = dataframe_copy.apply(lambda row: row[datetime_obj_colname].weekday(), axis=1)
-    dataframe_copy['hour'] = dataframe_copy.apply(lambda row: row[datetime_obj_colname].hour, axis=1)
-    dataframe_copy['minute'] = dataframe_copy.apply(lambda row: row[datetime_obj_colname].minute, axis=1)
-    dataframe_copy['second'] = dataframe_copy.apply(lambda row: row[datetime_obj_colname].second, axis=1)
+    time_series = pd.to_datetime(dataframe_copy[datetime_obj_colname])
+    dataframe_copy['year'] = time_series.dt.year
+    dataframe_copy['month'] = time_series.dt.month
+    dataframe_copy['day'] = time_series.dt.day
+    dataframe_copy['weekday'] = time_series.dt.weekday
+    dataframe_copy['hour'] = time_series.dt.hour
+    dataframe_copy['minute'] = time_series.dt.minute
+    dataframe_copy['second'] = time_series.dt.second
     return dataframe_copy
 
 
@@ -101,6 +147,58 @@ def rename_dataframe(dataframe: pd.DataFrame, rename_dict: dict) -> pd.DataFrame
     return dataframe_renamed
 
 
+# The pattern of a decimal number, such as '22.3', '-0.5' or '1e-3'
+number_pattern = r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*'
+
+
+def parse_coordinate_column(values: pd.Series) -> pd.Series:
+    """
+    Parse a latitude or longitude column to float64. The strings which are not numbers are parsed as NaN. Each
+    number string is parsed exactly, so the same coordinate always gives the same float
+    :param values: a pandas series saving the latitude or longitude
+    :return: a float64 pandas series
+    """
+    if values.dtype == np.float64:
+        return values
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return values.astype(np.float64)
+    value_strings = values.astype(str)
+    is_number = value_strings.str.fullmatch(number_pattern).fillna(False).values
+    parsed_values = pd.Series(np.nan, index=values.index, dtype=np.float64)
+    parsed_values.loc[is_number] = value_strings.loc[is_number].astype(np.float64)
+    return parsed_values
+
+
+def sanitize_coordinates(dataframe: pd.DataFrame, lat_colname: str = 'lat', lon_colname: str = 'lon',
+                         drop_invalid: bool = True) -> pd.DataFrame:
+    """
+    Parse the latitude and longitude columns to float64 in one vectorized pass. The values which are not numbers
+    or out of the valid range are rejected. The dataframe is returned as it is if the coordinates are already
+    clean float64 values
+    :param dataframe: a pandas dataframe saving the tweets
+    :param lat_colname: the column name of the latitude, such as 'lat' or 'place_lat'
+    :param lon_colname: the column name of the longitude, such as 'lon' or 'place_lon'
+    :param drop_invalid: drop the rows whose coordinates are missing or rejected if True. Otherwise, the rejected
+    coordinates are set to NaN and all the rows are kept
+    :return: a pandas dataframe saving float64 latitude and longitude
+    """
+    lat_values = parse_coordinate_column(dataframe[lat_colname])
+    lon_values = parse_coordinate_column(dataframe[lon_colname])
+    valid_lat, valid_lon = lat_values.between(-90, 90), lon_values.between(-180, 180)
+    valid = valid_lat & valid_lon
+    rejected = (dataframe[lat_colname].notnull() & ~valid_lat) | (dataframe[lon_colname].notnull() & ~valid_lon)
+    rejected_num = int(rejected.sum())
+    if rejected_num > 0:
+        print('{} rows with bad {} or {} values are rejected'.format(rejected_num, lat_colname, lon_colname))
+    float_dtypes = (dataframe[lat_colname].dtype == np.float64) and (dataframe[lon_colname].dtype == np.float64)
+    if float_dtypes and (rejected_num == 0) and (valid.all() or not drop_invalid):
+        return dataframe
+    if drop_invalid:
+        return dataframe.loc[valid.values].assign(**{lat_colname: lat_values.loc[valid.values],
+                                                     lon_colname: lon_values.loc[valid.values]})
+    return dataframe.assign(**{lat_colname: lat_values.where(valid), lon_colname: lon_values.where(valid)})
+
+
 def merge_dict(sum_dict, a_dict: Counter):
     """
     Merge a sum dictionary and a dictionary for a csv file
@@ -119,42 +217,144 @@ def merge_dict(sum_dict, a_dict: Counter):
     return sum_dict
 
 
-def create_dataframe_from_dict(dict_data):
-    """
-    Create the hourly tweet count dataframe
-    :param dict_data: a python dict saving the number of tweets posted in each hour in a city
-    :return: a pandas dataframe saving the number of tweets
-    """
-    keys = list(dict_data.keys())
-    vals = [dict_data[key] for key in keys]
-    dataframe = pd.DataFrame(columns=['time', 'total_count'])
-    dataframe['time'] = keys
-    dataframe['total_count'] = vals
-    dataframe['year'] = dataframe.apply(lambda row: np.int(row['time'].split('_')[0]), axis=1)
-    dataframe['month'] = dataframe.apply(lambda row: np.int(row['time'].split('_')[1]), axis=1)
-    dataframe['day'] = dataframe.apply(lambda row: np.int(row['time'].split('_')[2]), axis=1)
-    dataframe['hour'] = dataframe.apply(lambda row: np.int(row['time'].split('_')[3]), axis=1)
-    dataframe['weekday'] = dataframe.apply(lambda row: np.int(row['time'].split('_')[4]), axis=1)
-    dataframe['datetime'] = dataframe.apply(
-        lambda row: datetime(int(row['year']), int(row['month']), int(row['day']), int(row['hour'])), axis=1)
-    dataframe_sorted = dataframe.sort_values(by='datetime')
-    dataframe_final = dataframe_sorted.drop(['datetime', 'time'], axis=1)
-    return dataframe_final
-
-
-def sum_dataframe_list_count(dataframe_list: list) -> pd.DataFrame:
-    """
-    Create the sum dataframe for the open space tweet count pandas dataframes
-    :param dataframe_list: a python list containing the pandas tweet dataframe
-    :return: a dataframe saving the number of tweets posted in each hour
-    """
-    for dataframe in dataframe_list:
-        assert 'open_space_count' in dataframe, 'The dataframe should contain the count of tweets in open space'
-    combined_dataframe = dataframe_list[0][['year', 'month', 'day', 'hour', 'weekday']]
-    sum_dataframes_list = [dataframe[['open_space_count']] for dataframe in dataframe_list]
-    sum_dataframe = sum(sum_dataframes_list)
-    result_dataframe = pd.concat([combined_dataframe, sum_dataframe], axis=1)
-    return result_dataframe
+def split_into_batches(item_list: list, batch_num: int) -> list:
+    """
+    Split a list into contiguous batches of nearly equal size. The order of the items is kept
+    :param item_list: a python list, such as the csv files saving the tweets
+    :param batch_num: the number of batches
+    :return: a list of non-empty batches
+    """
+    batch_num = max(1, min(batch_num, len(item_list)))
+    batch_size, remainder = divmod(len(item_list), batch_num)
+    batches, start = [], 0
+    for batch_index in range(batch_num):
+        end = start + batch_size + (1 if batch_index < remainder else 0)
+        batches.append(item_list[start:end])
+        start = end
+    return [batch for batch in batches if len(batch) > 0]
+
+
+def group_cities_by_data_loc(city_names, cities_profile: dict) -> list:
+    """
+    Group the cities whose profiles point at the same data directory, such as a city and the metropolitan area
+    around it, so that the tweet files of each directory are read once for all of them
+    :param city_names: the names of the considered cities
+    :param cities_profile: a dict saving the profile of each city, with the data directory at the position 2
+    :return: a list of city name lists, following the order of cities_profile
+    """
+    city_groups = {}
+    for city in cities_profile:
+        if city in city_names:
+            city_groups.setdefault(cities_profile[city][2], []).append(city)
+    return list(city_groups.values())
+
+
+# The hour calendars created for each (start time, end time, timezone)
+hour_calendar_cache = {}
+
+
+def create_hour_calendar(start_time: datetime, end_time: datetime) -> pd.DataFrame:
+    """
+    Create the calendar of each hour in the study time. The calendar is created once for each start time, end time
+    and timezone, and a copy is returned for each call
+    :param start_time: the start time of the study time
+    :param end_time: the end time of the study time (not included)
+    :return: a pandas dataframe indexed by the wall clock time of each hour, with the year (int16), month, day,
+    hour and weekday (int8) columns
+    """
+    naive_start, naive_end = start_time.replace(tzinfo=None), end_time.replace(tzinfo=None)
+    cache_key = (naive_start, naive_end, str(start_time.tzinfo))
+    if cache_key not in hour_calendar_cache:
+        hour_num = int((np.datetime64(naive_end, 'h') - np.datetime64(naive_start, 'h')).astype(np.int64))
+        hours = pd.date_range(start=naive_start, periods=hour_num, freq='H', name='time')
+        calendar = pd.DataFrame(index=hours)
+        calendar['year'] = np.asarray(hours.year, dtype=np.int16)
+        calendar['month'] = np.asarray(hours.month, dtype=np.int8)
+        calendar['day'] = np.asarray(hours.day, dtype=np.int8)
+        calendar['hour'] = np.asarray(hours.hour, dtype=np.int8)
+        calendar['weekday'] = np.asarray(hours.weekday, dtype=np.int8)
+        hour_calendar_cache[cache_key] = calendar
+    return hour_calendar_cache[cache_key].copy()
+
+
+class HourlyCountAccumulator(object):
+    """
+    Count the messages posted in each hour of the study time with a dense array indexed by the number of hours
+    since the start time. The hours follow the wall clock of the start time, the same as create_hour_calendar
+    """
+
+    def __init__(self, start_time: datetime, end_time: datetime):
+        """
+        Initialize the accumulator
+        :param start_time: the start time of the study time
+        :param end_time: the end time of the study time (not included)
+        """
+        self.start_time = start_time
+        self.end_time = end_time
+        self.start_hour = np.datetime64(start_time.replace(tzinfo=None), 'h')
+        self.hour_num = int((np.datetime64(end_time.replace(tzinfo=None), 'h') - self.start_hour).astype(np.int64))
+        self.counts = np.zeros(self.hour_num, dtype=np.int64)
+
+    def get_hour_index(self, time_series: pd.Series) -> np.ndarray:
+        """
+        Get the number of hours since the start time for each time
+        :param time_series: a pandas series of datetime64, such as the output of parse_created_at. The wall clock
+        time is used if the times are timezone aware
+        :return: a numpy array saving the hour index of each time
+        """
+        if getattr(time_series.dt, 'tz', None) is not None:
+            time_series = time_series.dt.tz_localize(None)
+        return (time_series.values.astype('datetime64[h]') - self.start_hour).astype(np.int64)
+
+    def add_times(self, time_series: pd.Series) -> None:
+        """
+        Count the messages posted at the given times. The times outside the study time are ignored
+        :param time_series: a pandas series of datetime64 without missing values
+        :return: None
+        """
+        if len(time_series) == 0:
+            return
+        hour_index = self.get_hour_index(time_series)
+        hour_index = hour_index[(hour_index >= 0) & (hour_index < self.hour_num)]
+        self.counts += np.bincount(hour_index, minlength=self.hour_num)
+
+    def add_counts(self, counts: np.ndarray) -> None:
+        """
+        Add the counts of another accumulator with the same study time
+        :param counts: a numpy array saving the number of messages posted in each hour
+        :return: None
+        """
+        assert len(counts) == self.hour_num, 'The study time of the counts does not match!'
+        self.counts += counts
+
+    def get_sparse_counts(self) -> tuple:
+        """
+        Get the counts of the hours in which messages are posted. One hourly file only covers a few hours of the
+        study time, so the sparse counts are much smaller than the dense array
+        :return: a tuple of two numpy arrays: the hour indices and the number of messages posted in these hours
+        """
+        hour_index = np.flatnonzero(self.counts)
+        return hour_index, self.counts[hour_index]
+
+    def add_sparse_counts(self, hour_index: np.ndarray, counts: np.ndarray) -> None:
+        """
+        Add the sparse counts of another accumulator with the same study time
+        :param hour_index: the hour indices returned by get_sparse_counts
+        :param counts: the number of messages posted in these hours
+        :return: None
+        """
+        np.add.at(self.counts, hour_index, counts)
+
+    def to_dataframe(self, count_colname: str = 'total_count') -> pd.DataFrame:
+        """
+        Create the hourly count dataframe
+        :param count_colname: the name of the count column
+        :return: a pandas dataframe indexed by the wall clock time of each hour, saving the number of messages
+        posted in each hour of the study time
+        """
+        result_dataframe = create_hour_calendar(self.start_time, self.end_time)
+        result_dataframe[count_colname] = self.counts
+        return result_dataframe
 
 
 def combine_total_and_open_space_count(total_df: pd.DataFrame, open_space_df: pd.DataFrame):